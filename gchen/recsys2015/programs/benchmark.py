@@ -0,0 +1,257 @@
+#coding=utf8
+#
+# Filename:    benchmark.py
+#
+# Benchmark ingestion, model creation, prediction and evaluation of
+# both methods on a synthetic data tier. Every stage runs in a fresh
+# process, its wall time, sessions/sec, peak RSS and the instrumented
+# sub-stages are written to a JSON file, and two such files can be
+# compared across commits.
+#
+# usage: python benchmark.py --tier small --output bench-small.json
+#        python benchmark.py --compare bench-old.json bench-new.json
+#        python benchmark.py --tier small --time-compare
+#
+# @classes
+# --------
+#     Benchmark: generate the data of a tier and run every stage
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from synthetic_data import SyntheticData, TIERS
+
+MODELS = [ 'sequence', 'naive_bayes' ]
+STAGES = [ 'create', 'predict', 'evaluate' ]
+
+
+def run_stage( stage, model, work_dir ):
+    """ Run one stage in this process and return its measures
+    """
+    from instrumentation import METRICS
+    from models import CREATION, PARAMS_FILES, PREDICTION
+    from results_evaluation import ResultsEvaluation
+    from session_store import SessionIngestion, SessionStore
+
+    data_dir = work_dir + os.sep + 'data'
+    train_store_dir = work_dir + os.sep + 'training_store'
+    tests_store_dir = work_dir + os.sep + 'tests_store'
+
+    start = time.time()
+    score = None
+    if stage == 'ingest':
+        SessionIngestion( data_dir + os.sep + 'yoochoose-clicks.dat',
+                          data_dir + os.sep + 'yoochoose-buys.dat' ).ingest( train_store_dir )
+        SessionIngestion( data_dir + os.sep + 'yoochoose-test.dat',
+                          data_dir + os.sep + 'yoochoose-test-buys.dat' ).ingest( tests_store_dir )
+        sessions = len( SessionStore( train_store_dir ) ) + len( SessionStore( tests_store_dir ) )
+    elif stage == 'create':
+        model_creation = CREATION[ model ]( train_store_dir )
+        model_creation.create()
+        model_creation.store_params( work_dir )
+        sessions = len( SessionStore( train_store_dir ) )
+    elif stage == 'predict':
+        model_prediction = PREDICTION[ model ]( work_dir + os.sep + PARAMS_FILES[ model ],
+                                                tests_store_dir )
+        model_prediction.load_params()
+        model_prediction.do_task( work_dir )
+        sessions = len( SessionStore( tests_store_dir ) )
+    elif stage == 'evaluate':
+        results_name = PREDICTION[ model ]( None, None ).results_name
+        store = SessionStore( tests_store_dir )
+        evaluation = ResultsEvaluation( work_dir + os.sep + results_name, store,
+                                        total_sessions=len( store ) )
+        score = evaluation.cal_score()
+        sessions = len( store )
+    else:
+        raise ValueError( 'Unknown stage ' + stage )
+    elapsed = time.time() - start
+
+    return { 'stage': stage,
+             'model': model,
+             'wall_seconds': elapsed,
+             'sessions': sessions,
+             'sessions_per_sec': sessions / max( elapsed, 1e-9 ),
+             'peak_rss_mb': resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0,
+             'score': score,
+             'stages': METRICS.stages,
+             'gauges': METRICS.gauges }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output( [ 'git', 'rev-parse', 'HEAD' ],
+                                        stderr=open( os.devnull, 'w' ) ).strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+
+class Benchmark:
+
+    def __init__( self, tier, work_dir, seed=2015 ):
+        self.tier = tier
+        self.work_dir = work_dir
+        self.seed = seed
+
+    def prepare( self ):
+        """ Generate the data of the tier unless it is there
+        """
+        data_dir = self.work_dir + os.sep + 'data'
+        if not os.path.exists( data_dir + os.sep + 'yoochoose-test-buys.dat' ):
+            SyntheticData( TIERS[ self.tier ], seed=self.seed ).generate( data_dir )
+
+    def run_child( self, stage, model ):
+        """ Run a stage in a new process, so peak RSS is the stage's own
+        """
+        command = [ sys.executable, os.path.abspath( __file__ ), '--run-stage', stage,
+                    '--model', model or '', '--work-dir', self.work_dir ]
+        output = subprocess.check_output( command, cwd=os.path.dirname( os.path.abspath( __file__ ) ) )
+        lines = [ line for line in output.splitlines() if line.startswith( 'RESULT ' ) ]
+        return json.loads( lines[-1][ len( 'RESULT ' ): ] )
+
+    def run( self, output_file ):
+        """ Run every stage of both models and write the measures
+        """
+        self.prepare()
+        report = { 'tier': self.tier,
+                   'seed': self.seed,
+                   'commit': git_commit(),
+                   'date': time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                   'results': [] }
+        tasks = [ ( 'ingest', None ) ] + [ ( stage, model ) for model in MODELS
+                                                            for stage in STAGES ]
+        for stage, model in tasks:
+            print "\t Start", stage, model or ''
+            result = self.run_child( stage, model )
+            report[ 'results' ].append( result )
+            print "\t\t %.2f s, %.0f sessions/sec, %.0f MB peak" \
+                  % ( result[ 'wall_seconds' ], result[ 'sessions_per_sec' ],
+                      result[ 'peak_rss_mb' ] )
+        with open( output_file, 'w' ) as fstream:
+            json.dump( report, fstream, indent=2, sort_keys=True )
+        print "\t Benchmark written to", output_file
+        return report
+
+
+def compare( old_file, new_file ):
+    """ Print the wall time and peak RSS of two benchmark files side
+    by side, ratios below 1 mean the new one is better
+    """
+    with open( old_file ) as fstream:
+        old = json.load( fstream )
+    with open( new_file ) as fstream:
+        new = json.load( fstream )
+    old_results = dict( ( ( r[ 'stage' ], r[ 'model' ] ), r ) for r in old[ 'results' ] )
+
+    print "\t %-22s %10s %10s %7s %9s %9s %7s" % ( 'stage', 'old s', 'new s', 'ratio',
+                                                   'old MB', 'new MB', 'ratio' )
+    for result in new[ 'results' ]:
+        key = ( result[ 'stage' ], result[ 'model' ] )
+        if key not in old_results:
+            continue
+        before = old_results[ key ]
+        print "\t %-22s %10.2f %10.2f %7.2f %9.0f %9.0f %7.2f" % (
+                result[ 'stage' ] + ' ' + ( result[ 'model' ] or '' ),
+                before[ 'wall_seconds' ], result[ 'wall_seconds' ],
+                result[ 'wall_seconds' ] / max( before[ 'wall_seconds' ], 1e-9 ),
+                before[ 'peak_rss_mb' ], result[ 'peak_rss_mb' ],
+                result[ 'peak_rss_mb' ] / max( before[ 'peak_rss_mb' ], 1e-9 ) )
+
+
+def time_compare( store_dir ):
+    """ Time click matching and dwell times on the ISO strings of the
+    csv files ( as the old pickled dicts held them ) against the
+    int64 epoch milliseconds and the time index of the store
+    """
+    import datetime
+    import numpy
+    from sequence_method import SequenceModelCreation
+    from session_store import SessionStore, TimeIndex
+
+    store = SessionStore( store_dir )
+    model = SequenceModelCreation( store_dir )
+    # the same records with both kinds of times
+    sessions, int_sessions = [], []
+    for _, clicks, buys in store:
+        sessions.append( tuple( [ { 'item': int( item ), 'time': time + 'Z' } for item, time in
+                                  zip( view.items, numpy.datetime_as_string(
+                                           view.times.astype( 'datetime64[ms]' ) ) ) ]
+                                for view in ( clicks, buys ) ) )
+        int_sessions.append( tuple( [ { 'item': record.item, 'time': record.time } for record in view ]
+                                    for view in ( clicks, buys ) ) )
+    timings = []
+
+    start = time.time()
+    string_labels = [ model.match_clicks_buys( clicks, buys )[1] for clicks, buys in sessions ]
+    timings.append( ( 'match, string times', time.time() - start ) )
+    start = time.time()
+    int_labels = [ model.match_clicks_buys( clicks, buys )[1] for clicks, buys in int_sessions ]
+    timings.append( ( 'match, int64 times', time.time() - start ) )
+    start = time.time()
+    batch_labels = model.match_clicks_buys_batch( store )
+    timings.append( ( 'match, batch', time.time() - start ) )
+    assert string_labels == int_labels, 'String and int64 matching differ'
+    assert sum( int_labels, [] ) == batch_labels.tolist(), 'Batch matching differs'
+
+    start = time.time()
+    string_dwell = []
+    for clicks, _ in sessions:
+        parsed = [ datetime.datetime.strptime( record[ 'time' ], '%Y-%m-%dT%H:%M:%S.%fZ' )
+                   for record in clicks ]
+        string_dwell += [ ( after - before ).total_seconds() for before, after in
+                          zip( sorted( parsed ), sorted( parsed )[ 1: ] ) ]
+    timings.append( ( 'dwell, string times', time.time() - start ) )
+    start = time.time()
+    index = TimeIndex.build( store )
+    timings.append( ( 'dwell, index build', time.time() - start ) )
+    start = time.time()
+    index = store.time_index()
+    dwell = numpy.asarray( index.dwell )
+    long_dwells = ( dwell > 60000 ).sum()
+    timings.append( ( 'dwell, stored index', time.time() - start ) )
+    assert ( numpy.asarray( string_dwell ) > 60 ).sum() == long_dwells, 'Dwell times differ'
+
+    print "\n\t %-22s %10s %9s" % ( 'task', 'seconds', 'speedup' )
+    for name, seconds in timings:
+        reference = timings[0][1] if name.startswith( 'match' ) else timings[3][1]
+        print "\t %-22s %10.3f %9.1f" % ( name, seconds, reference / max( seconds, 1e-9 ) )
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Benchmark both methods on synthetic data' )
+    parser.add_argument( '--tier', choices=sorted( TIERS ), default='small' )
+    parser.add_argument( '--seed', type=int, default=2015 )
+    parser.add_argument( '--work-dir', default=None )
+    parser.add_argument( '--output', default=None )
+    parser.add_argument( '--compare', nargs=2, metavar=( 'OLD', 'NEW' ) )
+    parser.add_argument( '--time-compare', action='store_true',
+                         help='time string against int64 time handling on the tier' )
+    parser.add_argument( '--run-stage', help=argparse.SUPPRESS )
+    parser.add_argument( '--model', help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare( *args.compare )
+    elif args.time_compare:
+        work_dir = os.path.abspath( args.work_dir or "../synthetic_datasets/" + args.tier )
+        benchmark = Benchmark( args.tier, work_dir, args.seed )
+        benchmark.prepare()
+        if not os.path.exists( work_dir + os.sep + 'training_store' ):
+            benchmark.run_child( 'ingest', None )
+        time_compare( work_dir + os.sep + 'training_store' )
+    elif args.run_stage:
+        result = run_stage( args.run_stage, args.model or None, args.work_dir )
+        print 'RESULT ' + json.dumps( result )
+    else:
+        work_dir = os.path.abspath( args.work_dir or "../synthetic_datasets/" + args.tier )
+        Benchmark( args.tier, work_dir, args.seed ).run( args.output or 'bench-%s.json' % args.tier )
+
+
+if __name__ == "__main__":
+    main()
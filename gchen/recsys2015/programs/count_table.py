@@ -0,0 +1,257 @@
+#coding=utf8
+#
+# Filename:    count_table.py
+#
+# Additive count tables keyed by sorted int64 keys, and count-min
+# sketches holding the pruned long tail of a table in fixed memory.
+# Keys are item ids, packed item pairs or hashed contexts of longer
+# item sequences ( context_keys )
+#
+# @classes
+# --------
+#     CountTable:     sorted unique int64 keys with one count row
+#                     per key, e.g. [2] counts of an item or [2,2]
+#                     counts of an item pair
+#     CountMinSketch: depth x width cells of count rows, a key adds
+#                     to one cell per depth, its estimate is the
+#                     cellwise minimum ( never below the true count )
+
+import numpy
+
+PAIR_SHIFT = 32
+ITEM_MASK = 0xFFFFFFFF
+# rows processed at a time when deriving arrays from large tables
+BLOCK_ROWS = 1 << 20
+
+
+def pair_keys( first, second ):
+    """ Pack two int32 item ids into one sortable int64 key
+    """
+    return ( first.astype( numpy.int64 ) << PAIR_SHIFT ) \
+           + ( second.astype( numpy.int64 ) & ITEM_MASK )
+
+
+def split_pair_keys( keys ):
+    """ Inverse of pair_keys
+    """
+    return ( keys >> PAIR_SHIFT ).astype( numpy.int32 ), \
+           ( keys & ITEM_MASK ).astype( numpy.int32 )
+
+
+def mix_keys( keys ):
+    """ Bijective 64 bit mixing of int64 keys ( splitmix64 finalizer )
+    """
+    mixed = numpy.asarray( keys ).astype( numpy.uint64 )
+    mixed ^= mixed >> numpy.uint64( 30 )
+    mixed *= numpy.uint64( 0xBF58476D1CE4E5B9 )
+    mixed ^= mixed >> numpy.uint64( 27 )
+    mixed *= numpy.uint64( 0x94D049BB133111EB )
+    mixed ^= mixed >> numpy.uint64( 31 )
+    return mixed.astype( numpy.int64 )
+
+
+def context_keys( items, order ):
+    """ Keys of the contexts of order consecutive items, one per
+    end position from order - 1 on: pair_keys for order 2, longer
+    contexts hash the key of the shorter one with the item before.
+    Two distinct contexts collide with a chance of about 2^-64
+    """
+    items = numpy.asarray( items )
+    keys = pair_keys( items[ :-1 ], items[ 1: ] )
+    for length in xrange( 3, order + 1 ):
+        before = items[ :max( len( items ) - length + 1, 0 ) ].astype( numpy.int64 ) & ITEM_MASK
+        keys = mix_keys( mix_keys( keys[ 1: ] ) ^ before )
+    return keys
+
+
+def find_keys( keys, query ):
+    """ Binary search query in the sorted keys array, return
+    ( rows, found ), rows[i] is the row of query[i] when found[i]
+    """
+    rows = numpy.searchsorted( keys, query )
+    if len( keys ) == 0:
+        return rows, numpy.zeros( numpy.shape( rows ), dtype=bool )
+    rows = numpy.minimum( rows, len( keys ) - 1 )
+    return rows, keys[ rows ] == query
+
+
+def new_array( shape, dtype, path=None ):
+    """ Return an uninitialized array, memory mapped to a new .npy
+    file when path is given
+    """
+    if path is None:
+        return numpy.empty( shape, dtype=dtype )
+    return numpy.lib.format.open_memmap( path, mode='w+', dtype=dtype, shape=shape )
+
+
+def min_support_for( support, max_keys, min_support=1 ):
+    """ Return the smallest support threshold >= min_support that
+    keeps at most max_keys of the keys with the given supports
+    """
+    if max_keys is None or numpy.sum( support >= min_support ) <= max_keys:
+        return min_support
+    if max_keys <= 0:
+        return int( support.max() ) + 1
+    # the max_keys-th largest support is kept, unless it ties with
+    # the next one
+    ranked = numpy.sort( support )[ ::-1 ]
+    threshold = ranked[ max_keys - 1 ]
+    if ranked[ max_keys ] == threshold:
+        threshold += 1
+    return max( int( threshold ), min_support )
+
+
+def save_tables( path, tables ):
+    """ Save a dict of CountTable to one .npz file
+    """
+    arrays = {}
+    for name in tables:
+        arrays[ name + '_keys' ] = tables[ name ].keys
+        arrays[ name + '_counts' ] = tables[ name ].counts
+    with open( path, 'wb' ) as fstream:
+        numpy.savez( fstream, **arrays )
+
+
+def load_tables( path ):
+    """ Load a dict of CountTable saved by save_tables
+    """
+    arrays = numpy.load( path )
+    return dict( ( name[ :-len( '_keys' ) ],
+                   CountTable( arrays[ name ], arrays[ name[ :-len( '_keys' ) ] + '_counts' ] ) )
+                 for name in arrays.files if name.endswith( '_keys' ) )
+
+
+class CountTable:
+
+    def __init__( self, keys, counts ):
+        """ keys: sorted unique int64 array
+        counts: array with len( keys ) rows
+        """
+        self.keys = keys
+        self.counts = counts
+
+    def __len__( self ):
+        return len( self.keys )
+
+    @staticmethod
+    def empty( shape ):
+        return CountTable( numpy.zeros( 0, dtype=numpy.int64 ),
+                           numpy.zeros( ( 0, ) + tuple( shape ), dtype=numpy.int64 ) )
+
+    @staticmethod
+    def accumulate( keys, cells, shape, weights=None ):
+        """ Count events in bulk, event i adds 1 ( or weights[i] )
+        to the flat cell cells[i] of the row keyed by keys[i]
+        """
+        size = int( numpy.prod( shape ) )
+        unique_keys, inverse = numpy.unique( keys, return_inverse=True )
+        counts = numpy.bincount( inverse * size + cells, weights=weights,
+                                 minlength=len( unique_keys ) * size )
+        return CountTable( unique_keys.astype( numpy.int64 ),
+                           counts.reshape( ( len( unique_keys ), ) + tuple( shape ) ) \
+                                 .astype( numpy.int64 ) )
+
+    def merge( self, other ):
+        """ Return a new table with the counts of both tables added
+        """
+        if len( other ) == 0:
+            return CountTable( self.keys, self.counts.copy() )
+        if len( self ) == 0:
+            return CountTable( other.keys, other.counts.copy() )
+        keys = numpy.concatenate( ( self.keys, other.keys ) )
+        unique_keys, inverse = numpy.unique( keys, return_inverse=True )
+        counts = numpy.zeros( ( len( unique_keys ), ) + self.counts.shape[1:],
+                              dtype=self.counts.dtype )
+        # keys are unique inside each table, so no index repeats
+        counts[ inverse[ :len( self ) ] ] += self.counts
+        counts[ inverse[ len( self ): ] ] += other.counts
+        return CountTable( unique_keys, counts )
+
+    def subtract( self, other ):
+        """ Return a new table with the counts of other taken away,
+        every key of other must be in this table. Keys left without
+        counts are dropped, so the result equals the table counted
+        without the events of other
+        """
+        rows, found = self.lookup( other.keys )
+        assert found.all(), 'Subtracted keys missing from the table'
+        counts = numpy.array( self.counts )
+        counts[ rows ] -= other.counts
+        table = CountTable( self.keys, counts )
+        return table.select( table.support() > 0 )
+
+    def lookup( self, keys ):
+        """ Return ( rows, found ) of keys in the table
+        """
+        return find_keys( self.keys, keys )
+
+    def support( self ):
+        """ Total count of every key, e.g. the clicks on an item
+        """
+        return self.counts.reshape( len( self ), int( numpy.prod( self.counts.shape[1:] ) ) ).sum( axis=1 )
+
+    def select( self, rows ):
+        """ Return a table with the given rows ( a sorted index or a
+        mask ), keys stay sorted
+        """
+        return CountTable( numpy.asarray( self.keys[ rows ] ), numpy.asarray( self.counts[ rows ] ) )
+
+
+class CountMinSketch:
+
+    def __init__( self, counts, hashes ):
+        """ counts: [ depth, width, ... ] cells, width a power of 2
+        hashes: [ depth ] odd uint64 multipliers of the rows
+        """
+        self.counts = counts
+        self.hashes = hashes
+        self.shift = numpy.uint64( 64 - int( numpy.log2( counts.shape[1] ) ) )
+
+    @staticmethod
+    def empty( width, depth, shape, seed=2015 ):
+        random = numpy.random.RandomState( seed )
+        hashes = random.randint( 0, 1 << 62, depth ).astype( numpy.uint64 ) * numpy.uint64( 4 ) \
+                 + numpy.uint64( 1 )
+        return CountMinSketch( numpy.zeros( ( depth, width ) + tuple( shape ), dtype=numpy.int64 ),
+                               hashes )
+
+    @staticmethod
+    def for_bytes( n_bytes, shape, depth=4 ):
+        """ Return the widest empty sketch of at most n_bytes, hashes
+        included
+        """
+        row_bytes = 8 * int( numpy.prod( shape ) ) * depth
+        width = 1 << max( int( numpy.log2( max( ( n_bytes - 8 * depth ) // row_bytes, 1 ) ) ), 1 )
+        return CountMinSketch.empty( width, depth, shape )
+
+    def nbytes( self ):
+        return self.counts.nbytes + self.hashes.nbytes
+
+    def columns( self, keys ):
+        """ Multiply-shift hash of the keys for every depth, [ depth, n ]
+        """
+        keys = numpy.asarray( keys ).astype( numpy.uint64 )
+        return ( ( keys[ None, : ] * self.hashes[ :, None ] ) >> self.shift ).astype( numpy.int64 )
+
+    def add( self, keys, counts ):
+        """ Add the count rows of keys ( e.g. a pruned CountTable )
+        """
+        if len( keys ) == 0:
+            return
+        width = self.counts.shape[1]
+        flat = numpy.asarray( counts ).reshape( len( keys ), -1 )
+        for depth, columns in enumerate( self.columns( keys ) ):
+            cells = self.counts[ depth ].reshape( width, -1 )
+            for cell in xrange( flat.shape[1] ):
+                cells[ :, cell ] += numpy.bincount( columns, weights=flat[ :, cell ],
+                                                    minlength=width ).astype( numpy.int64 )
+
+    def estimate( self, keys ):
+        """ Return estimated count rows of keys, cellwise minimum
+        over the depths
+        """
+        columns = self.columns( keys )
+        estimate = self.counts[ 0 ][ columns[0] ]
+        for depth in xrange( 1, len( columns ) ):
+            estimate = numpy.minimum( estimate, self.counts[ depth ][ columns[ depth ] ] )
+        return estimate
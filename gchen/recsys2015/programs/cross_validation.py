@@ -0,0 +1,188 @@
+#coding=utf8
+#
+# Filename:    cross_validation.py
+#
+# K-fold cross-validation of both methods over one session store.
+# Sessions are hashed to k folds once. The store stays memory mapped
+# in the parent and the forked workers read the same pages. No fold
+# copies its training sessions, a worker only takes the sessions of
+# the fold it counts or scores:
+#     count:     every fold is matched and counted once, in parallel
+#     evaluate:  the model of fold f is the total counts minus the
+#                counts of fold f ( counts are additive ), it is
+#                unified, stored and scored on the sessions of fold
+#                f, every ( model, fold ) in its own worker
+# The mean and std of the challenge score and of the precision over
+# the folds are reported per model.
+#
+# usage: python cross_validation.py --folds 5 --models sequence,naive_bayes
+#
+# @classes
+# --------
+#     CrossValidation: count the folds and evaluate every model on
+#                      every fold in a process pool
+
+import argparse
+import json
+import multiprocessing
+import numpy
+import os
+
+from count_table import load_tables, save_tables
+from instrumentation import METRICS
+from models import CREATION, PARAMS_FILES, PREDICTION
+from results_evaluation import ResultsEvaluation
+from session_store import SessionStore, session_shards
+
+# cross validation shared with the forked workers
+VALIDATION = None
+
+
+def count_fold( args ):
+    """ Worker: count the sessions of one fold for one model
+    """
+    model, fold = args
+    METRICS.configure( live=False )
+    store = VALIDATION.fold_store( fold )
+    counts = VALIDATION.new_model( model ).count_params( store )
+    save_tables( VALIDATION.counts_file( model, fold ) + '.tmp', counts )
+    os.rename( VALIDATION.counts_file( model, fold ) + '.tmp',
+               VALIDATION.counts_file( model, fold ) )
+    return model, fold
+
+
+def evaluate_fold( args ):
+    """ Worker: train one model without a fold and score it on it
+    """
+    model, fold = args
+    METRICS.configure( live=False )
+    return VALIDATION.evaluate( model, fold )
+
+
+class CrossValidation:
+
+    def __init__( self, store_dir, n_folds, work_dir, models=( 'sequence', 'naive_bayes' ),
+                  order=2 ):
+        """ Models and fold files go to work_dir, order is the context
+        order of the sequence model
+        """
+        self.store_dir = store_dir
+        self.n_folds = n_folds
+        self.work_dir = work_dir
+        self.models = list( models )
+        self.order = order
+        self.store = SessionStore( store_dir )
+        # sorted session indexes of every fold
+        folds = session_shards( self.store.clicks.sessions, n_folds )
+        self.folds = [ numpy.flatnonzero( folds == fold ) for fold in xrange( n_folds ) ]
+
+    def new_model( self, model ):
+        if model == 'sequence':
+            return CREATION[ model ]( self.store_dir, order=self.order )
+        return CREATION[ model ]( self.store_dir )
+
+    def fold_store( self, fold ):
+        """ In-memory store of the sessions of one fold
+        """
+        return self.store.take( self.folds[ fold ] )
+
+    def counts_file( self, model, fold ):
+        return self.work_dir + os.sep + '%s_fold_%02d_of_%02d.npz' % ( model, fold, self.n_folds )
+
+    def total_file( self, model ):
+        return self.work_dir + os.sep + '%s_total_of_%02d.npz' % ( model, self.n_folds )
+
+    def evaluate( self, model, fold ):
+        """ Train model on the counts of all folds but fold, predict
+        the sessions of fold and score them against their buys
+        """
+        total, held_out = load_tables( self.total_file( model ) ), \
+                          load_tables( self.counts_file( model, fold ) )
+        creation = self.new_model( model )
+        creation.merge_params( dict( ( name, total[ name ].subtract( held_out[ name ] ) )
+                                     for name in total ) )
+        creation.unify_params()
+        model_dir = self.work_dir + os.sep + '%s_fold_%02d' % ( model, fold )
+        if not os.path.exists( model_dir ):
+            os.makedirs( model_dir )
+        creation.store_params( model_dir )
+
+        prediction = PREDICTION[ model ]( model_dir + os.sep + PARAMS_FILES[ model ], None )
+        prediction.load_params()
+        store = self.fold_store( fold )
+        sessions, items = [], []
+        for session, bought in prediction.predict_sessions( store.clicks, 0, len( store ) ):
+            sessions += [ session ] * len( bought )
+            items += bought
+        evaluation = ResultsEvaluation( None, store, total_sessions=len( store ) )
+        evaluation.set_results( numpy.array( sessions, dtype=numpy.int64 ),
+                                numpy.array( items, dtype=numpy.int32 ) )
+        return { 'model': model, 'fold': fold, 'sessions': len( store ),
+                 'score': evaluation.get_score(), 'precision': evaluation.cal_precision() }
+
+    def run( self, processes=None ):
+        """ Count and evaluate every fold of every model in a pool of
+        processes, return the per fold results and the summary
+        """
+        global VALIDATION
+        if not os.path.exists( self.work_dir ):
+            os.makedirs( self.work_dir )
+        VALIDATION = self
+        pool = multiprocessing.Pool( processes or min( multiprocessing.cpu_count(),
+                                                       self.n_folds * len( self.models ) ) )
+        try:
+            print "\n\t Start counting", self.n_folds, "folds"
+            with METRICS.stage( 'count' ):
+                tasks = [ ( model, fold ) for model in self.models for fold in xrange( self.n_folds ) ]
+                for done, _ in enumerate( pool.imap_unordered( count_fold, tasks ) ):
+                    METRICS.progress( done + 1, len( tasks ) )
+                for model in self.models:
+                    creation = self.new_model( model )
+                    for fold in xrange( self.n_folds ):
+                        creation.merge_params( load_tables( self.counts_file( model, fold ) ) )
+                    save_tables( self.total_file( model ), creation.parameters )
+            print "\n\t Counting folds Finished~~"
+
+            print "\n\t Start evaluating folds"
+            with METRICS.stage( 'evaluate' ):
+                results = pool.map( evaluate_fold, tasks )
+            print "\n\t Evaluating folds Finished~~"
+        finally:
+            pool.close()
+            pool.join()
+
+        summary = {}
+        print "\n\t %-12s %12s %10s %12s %10s" % ( 'model', 'score mean', 'score std',
+                                                   'prec mean', 'prec std' )
+        for model in self.models:
+            scores = numpy.array( [ r[ 'score' ] for r in results if r[ 'model' ] == model ] )
+            precisions = numpy.array( [ r[ 'precision' ] for r in results if r[ 'model' ] == model ] )
+            summary[ model ] = { 'score_mean': scores.mean(), 'score_std': scores.std(),
+                                 'precision_mean': precisions.mean(),
+                                 'precision_std': precisions.std() }
+            print "\t %-12s %12.4f %10.4f %12.6f %10.6f" % (
+                    model, scores.mean(), scores.std(), precisions.mean(), precisions.std() )
+        return { 'folds': results, 'summary': summary }
+
+
+def main():
+    parser = argparse.ArgumentParser( description='K-fold cross-validation of both methods' )
+    parser.add_argument( '--store', default="../median_datasets/training_store" )
+    parser.add_argument( '--folds', type=int, default=5 )
+    parser.add_argument( '--models', default='sequence,naive_bayes' )
+    parser.add_argument( '--order', type=int, default=2 )
+    parser.add_argument( '--processes', type=int, default=None )
+    parser.add_argument( '--work-dir', default="../median_datasets/cross_validation" )
+    parser.add_argument( '--output', default=None )
+    args = parser.parse_args()
+
+    validation = CrossValidation( args.store, args.folds, args.work_dir,
+                                  args.models.split( ',' ), args.order )
+    report = validation.run( args.processes )
+    if args.output:
+        with open( args.output, 'w' ) as fstream:
+            json.dump( report, fstream, indent=2, sort_keys=True )
+
+
+if __name__ == "__main__":
+    main()
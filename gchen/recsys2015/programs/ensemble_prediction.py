@@ -0,0 +1,149 @@
+#coding=utf8
+#
+# Filename:    ensemble_prediction.py
+#
+# Predict with the sequence and the naive bayes model in one pass
+# over the test sessions. Both models are loaded once, every block
+# of sessions is reduced once to its distinct ( session, item )
+# entries and both models score those entries:
+#     sequence:     greedy decoding, the score of an entry is the
+#                   largest P( buy ) - P( not buy ) of its clicks
+#     naive bayes:  tanh( ( buy - not buy log likelihood ) / 2 ),
+#                   P( buy ) - P( not buy ) under even priors
+# Both scores are in [ -1, 1 ] and a model alone buys an entry when
+# its score is above 0. They are combined into one results file:
+#     weighted:  buy when the weighted mean score is above threshold
+#     vote:      buy when the models buying the entry hold at least
+#                quorum of the total weight
+#
+# usage: python ensemble_prediction.py --weights 0.4,0.6 --combine weighted
+#
+# @classes
+# --------
+#     EnsemblePrediction: one pass predictor over both models
+
+import argparse
+import numpy
+import os
+import time
+
+from count_table import PAIR_SHIFT, find_keys, pair_keys
+from instrumentation import METRICS
+from naive_bayes_method import NaiveBayesPrediction
+from results_evaluation import ResultsEvaluation, predict_store
+from sequence_method import SequencePrediction
+from session_store import SessionStore
+
+
+class EnsemblePrediction:
+
+    def __init__( self, sequence_params, naive_bayes_params, test_store_dir,
+                  weights=( 0.5, 0.5 ), combine='weighted', threshold=0.0, quorum=0.5 ):
+        """ weights are those of the ( sequence, naive bayes ) scores,
+        combine is 'weighted' or 'vote'
+        """
+        assert combine in [ 'weighted', 'vote' ], 'Unknown combine ' + str( combine )
+        self.sequence = SequencePrediction( sequence_params, test_store_dir )
+        self.naive_bayes = NaiveBayesPrediction( naive_bayes_params, test_store_dir )
+        self.test_store_dir = test_store_dir
+        self.weights = numpy.asarray( weights, dtype=numpy.float64 )
+        self.combine = combine
+        self.threshold = threshold
+        self.quorum = quorum
+        # optional SessionFilter dropping sessions unlikely to buy
+        self.session_filter = None
+        self.results = {}
+        self.results_name = 'ensemble_results'
+
+    def load_params( self ):
+        self.sequence.load_params()
+        self.naive_bayes.load_params()
+
+    def score_block( self, table, start, end ):
+        """ Scores of both models for sessions start:end, return
+        ( sessions, items, scores [ n, 2 ] ) with one entry per
+        distinct ( session, item ), sessions relative to start
+        """
+        keys, counts = table.distinct_keys( start, end )
+        sessions, items = keys >> PAIR_SHIFT, table.key_items( keys )
+        scores = numpy.empty( ( len( items ), 2 ) )
+
+        # per click margins of the sequence model, max per entry
+        first, last = table.offsets[ start ], table.offsets[ end ]
+        margins = numpy.empty( last - first )
+        self.sequence.decode_batch( table, start, end, 'greedy', margins )
+        click_sessions = numpy.repeat( numpy.arange( end - start, dtype=numpy.int64 ),
+                                       numpy.diff( table.offsets[ start:end + 1 ] ) )
+        rows, _ = find_keys( keys, pair_keys( click_sessions, numpy.asarray( table.items[ first:last ] ) ) )
+        order = numpy.argsort( rows, kind='mergesort' )
+        bounds = numpy.flatnonzero( numpy.r_[ True, rows[ order ][1:] != rows[ order ][:-1] ] ) \
+                 if len( rows ) else numpy.zeros( 0, dtype=numpy.int64 )
+        if len( rows ):
+            scores[ :, 0 ] = numpy.maximum.reduceat( margins[ order ], bounds )
+
+        not_buy_scores, buy_scores = self.naive_bayes.score_batch( sessions, items, counts )
+        scores[ :, 1 ] = numpy.tanh( ( buy_scores - not_buy_scores ) / 2.0 )
+        return sessions, items, scores
+
+    def combine_scores( self, scores ):
+        """ Bought mask of the entries given both models' scores
+        """
+        if self.combine == 'weighted':
+            return scores.dot( self.weights ) / self.weights.sum() > self.threshold
+        return ( scores > 0 ).dot( self.weights ) >= self.quorum * self.weights.sum()
+
+    def predict_sessions( self, table, start, end, block_size=10000 ):
+        """ Predict sessions start:end of a clicks SessionTable block
+        by block, yield ( session id, bought items ) of sessions
+        with buys
+        """
+        for block_start in xrange( start, end, block_size ):
+            block_end = min( block_start + block_size, end )
+            sessions, items, scores = self.score_block( table, block_start, block_end )
+            bought = numpy.flatnonzero( self.combine_scores( scores ) )
+            METRICS.progress( block_end - start, end - start )
+            bounds = numpy.searchsorted( sessions[ bought ], numpy.arange( block_end - block_start + 1 ) )
+            for index in numpy.flatnonzero( numpy.diff( bounds ) ).tolist():
+                yield table.sessions[ block_start + index ], \
+                      items[ bought[ bounds[ index ]:bounds[ index + 1 ] ] ].tolist()
+
+    def do_task( self, dir_2_store, block_size=10000 ):
+        predict_store( self, dir_2_store, block_size )
+
+
+def main():
+    parser = argparse.ArgumentParser( description='One pass ensemble of both methods' )
+    parser.add_argument( '--sequence-params', default="../median_datasets/sequence_params.bin" )
+    parser.add_argument( '--naive-bayes-params', default="../median_datasets/naive_bayes_params.bin" )
+    parser.add_argument( '--store', default="../median_datasets/tests_store" )
+    parser.add_argument( '--weights', default='0.5,0.5', help='sequence,naive bayes' )
+    parser.add_argument( '--combine', choices=[ 'weighted', 'vote' ], default='weighted' )
+    parser.add_argument( '--threshold', type=float, default=0.0 )
+    parser.add_argument( '--quorum', type=float, default=0.5 )
+    parser.add_argument( '--output-dir', default="../results_datasets" )
+    parser.add_argument( '--compare', action='store_true',
+                         help='also time both models alone and score all three on the store' )
+    args = parser.parse_args()
+
+    weights = [ float( weight ) for weight in args.weights.split( ',' ) ]
+    ensemble = EnsemblePrediction( args.sequence_params, args.naive_bayes_params, args.store,
+                                   weights, args.combine, args.threshold, args.quorum )
+    predictions = [ ensemble ]
+    if args.compare:
+        predictions = [ SequencePrediction( args.sequence_params, args.store ),
+                        NaiveBayesPrediction( args.naive_bayes_params, args.store ), ensemble ]
+    for prediction in predictions:
+        start = time.time()
+        prediction.load_params()
+        prediction.do_task( args.output_dir )
+        seconds = time.time() - start
+        if args.compare:
+            store = SessionStore( args.store )
+            evaluation = ResultsEvaluation( args.output_dir + os.sep + prediction.results_name,
+                                            store, total_sessions=len( store ) )
+            print "\n\t %-20s %8.2f s  score %.2f" % ( prediction.results_name, seconds,
+                                                       evaluation.get_score() )
+
+
+if __name__ == "__main__":
+    main()
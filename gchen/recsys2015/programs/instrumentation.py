@@ -0,0 +1,190 @@
+#coding=utf8
+#
+# Filename:    instrumentation.py
+#
+# Lightweight stage timers, counters and memory samples shared by
+# the model modules. Stages ( load, match, generate, merge, unify,
+# store, predict, write, evaluate ) record wall and cpu time, memory
+# at start/end and the largest sample in between, and the counters
+# ( sessions, clicks, keys ) added while they run. Results go to a
+# JSON metrics file, progress lines show the live rate.
+#
+# Configured from the environment or with METRICS.configure:
+#     RS15_METRICS   path of the metrics file, none by default
+#     RS15_LIVE      0 to turn off progress lines
+#     RS15_PROFILE   stage name to run under cProfile, the stats go
+#                    to RS15_PROFILE_FILE ( <stage>.prof by default )
+#
+# @classes
+# --------
+#     Instrumentation: stage records, counters and gauges of one
+#                      process
+
+import cProfile
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+MB = 1024.0 * 1024.0
+PAGE_SIZE = os.sysconf( 'SC_PAGE_SIZE' ) if hasattr( os, 'sysconf' ) else 4096
+
+
+def peak_rss_mb():
+    """ Peak resident set size of the process so far
+    """
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+
+
+def rss_mb():
+    """ Current resident set size, the peak where /proc is missing
+    """
+    try:
+        with open( '/proc/self/statm' ) as fstream:
+            return int( fstream.read().split()[1] ) * PAGE_SIZE / MB
+    except IOError:
+        return peak_rss_mb()
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Instrumentation:
+
+    def __init__( self ):
+        self.stages = []
+        self.active = []
+        self.counters = {}
+        self.gauges = {}
+        self.pid = os.getpid()
+        self.metrics_file = os.environ.get( 'RS15_METRICS' ) or None
+        self.live = os.environ.get( 'RS15_LIVE', '1' ) != '0'
+        self.profile_stage = os.environ.get( 'RS15_PROFILE' ) or None
+        self.profile_file = os.environ.get( 'RS15_PROFILE_FILE' ) or None
+
+    def configure( self, metrics_file=None, live=None, profile_stage=None, profile_file=None ):
+        """ Override the settings taken from the environment
+        """
+        if metrics_file is not None:
+            self.metrics_file = metrics_file
+        if live is not None:
+            self.live = live
+        if profile_stage is not None:
+            self.profile_stage = profile_stage
+        if profile_file is not None:
+            self.profile_file = profile_file
+
+    @contextlib.contextmanager
+    def stage( self, name ):
+        """ Time a stage, stages may nest. The metrics file is
+        rewritten whenever an outermost stage ends
+        """
+        record = { 'stage': name,
+                   'parent': self.active[-1][ 'stage' ] if self.active else None,
+                   'counters': {},
+                   'rss_start_mb': rss_mb() }
+        record[ 'rss_max_mb' ] = record[ 'rss_start_mb' ]
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        self.active.append( record )
+        start, cpu_start = time.time(), cpu_seconds()
+        record[ 'start' ] = start
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats( self.profile_file or name + '.prof' )
+            record[ 'seconds' ] = time.time() - start
+            record[ 'cpu_seconds' ] = cpu_seconds() - cpu_start
+            self.sample()
+            record[ 'rss_end_mb' ] = rss_mb()
+            record[ 'peak_rss_mb' ] = peak_rss_mb()
+            self.active.pop()
+            self.add_record( record )
+            if not self.active and self.metrics_file:
+                self.write()
+
+    def add_record( self, record ):
+        """ Keep a finished stage, repeated stages under the same
+        parent ( e.g. counting chunk by chunk ) add up in one record
+        """
+        record[ 'calls' ] = 1
+        for other in self.stages:
+            if other[ 'stage' ] == record[ 'stage' ] and other[ 'parent' ] == record[ 'parent' ]:
+                break
+        else:
+            self.stages.append( record )
+            return
+        other[ 'calls' ] += 1
+        other[ 'seconds' ] += record[ 'seconds' ]
+        other[ 'cpu_seconds' ] += record[ 'cpu_seconds' ]
+        other[ 'rss_max_mb' ] = max( other[ 'rss_max_mb' ], record[ 'rss_max_mb' ] )
+        other[ 'rss_end_mb' ] = record[ 'rss_end_mb' ]
+        other[ 'peak_rss_mb' ] = record[ 'peak_rss_mb' ]
+        for name, n in record[ 'counters' ].items():
+            other[ 'counters' ][ name ] = other[ 'counters' ].get( name, 0 ) + n
+
+    def count( self, name, n=1 ):
+        """ Add n to a counter, globally and in every open stage
+        """
+        n = int( n )
+        self.counters[ name ] = self.counters.get( name, 0 ) + n
+        for record in self.active:
+            record[ 'counters' ][ name ] = record[ 'counters' ].get( name, 0 ) + n
+
+    def gauge( self, name, value ):
+        """ Record the latest value of a size, e.g. parameter keys
+        """
+        self.gauges[ name ] = value
+
+    def sample( self ):
+        """ Sample memory into the open stages
+        """
+        rss = rss_mb()
+        for record in self.active:
+            record[ 'rss_max_mb' ] = max( record[ 'rss_max_mb' ], rss )
+
+    def progress( self, done, total=None ):
+        """ Sample memory and show done ( of total ) with the rate
+        since the innermost stage started
+        """
+        self.sample()
+        if not self.live:
+            return
+        elapsed = time.time() - self.active[-1][ 'start' ] if self.active else 0.0
+        line = "\r\t\t progress:" + str( done )
+        if total:
+            line += "/" + str( total )
+        if elapsed > 0:
+            line += " ( %.0f/s )" % ( done / elapsed )
+        sys.stdout.write( line )
+        sys.stdout.flush()
+
+    def report( self ):
+        return { 'pid': os.getpid(),
+                 'argv': sys.argv,
+                 'stages': self.stages,
+                 'counters': self.counters,
+                 'gauges': self.gauges,
+                 'peak_rss_mb': peak_rss_mb() }
+
+    def write( self, path=None ):
+        """ Write the report as JSON, worker processes forked from the
+        configuring one add their pid to the file name
+        """
+        path = path or self.metrics_file
+        if os.getpid() != self.pid:
+            path = '%s.%d' % ( path, os.getpid() )
+        with open( path + '.tmp', 'w' ) as fstream:
+            json.dump( self.report(), fstream, indent=2, sort_keys=True )
+        os.rename( path + '.tmp', path )
+
+
+# instrumentation of this process
+METRICS = Instrumentation()
@@ -0,0 +1,142 @@
+#coding=utf8
+#
+# Filename:    model_format.py
+#
+# Compact binary file format for model parameters, opened with
+# mmap so that predictor processes share one physical copy
+#
+# File layout:
+#     8 bytes   magic 'RS15MODL'
+#     4 bytes   uint32 format version
+#     4 bytes   uint32 header length
+#     header    json { 'meta': {...}, 'arrays': [ { name, dtype,
+#               shape, offset } ] }, offsets relative to data start
+#     data      arrays in C order, every array aligned to 64 bytes
+#
+# Versioned models are written as <name>.v0001.bin, <name>.v0002.bin,
+# ... and <name>.bin is a hard link to the latest version, swapped
+# atomically
+#
+# @classes
+# --------
+#     ModelFile: read-only memory mapped model file
+
+import json
+import mmap
+import numpy
+import os
+import struct
+
+MAGIC = 'RS15MODL'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+# bytes written at a time, arrays may be memory mapped and larger
+# than memory
+WRITE_BLOCK = 1 << 24
+
+
+def padding( size ):
+    return ( ALIGNMENT - size % ALIGNMENT ) % ALIGNMENT
+
+
+def overhead_bytes( meta, names ):
+    """ Upper bound of the bytes of a model file with meta and arrays
+    of the given names that are not array data: the prefix, the
+    header and the alignment padding
+    """
+    descriptors = [ { 'name': name, 'dtype': '<f8', 'shape': [ 1 << 62 ] * 3,
+                      'offset': 1 << 62 } for name in names ]
+    header = json.dumps( { 'meta': dict( meta, model_version=1 << 62 ), 'arrays': descriptors } )
+    return 16 + len( header ) + ( len( names ) + 1 ) * ( ALIGNMENT - 1 )
+
+
+def write_array( fstream, array ):
+    """ Write array in C order a block at a time, contiguous arrays
+    are not copied as a whole
+    """
+    flat = numpy.ravel( array )
+    step = max( WRITE_BLOCK // flat.itemsize, 1 )
+    for start in xrange( 0, len( flat ), step ):
+        fstream.write( flat[ start:start + step ].tostring() )
+
+
+def save_model( path, meta, arrays ):
+    """ Write arrays ( list of ( name, numpy array ) ) and meta
+    dict to path. The file is written aside and renamed, so
+    readers never see a half written model.
+    """
+    descriptors, offset = [], 0
+    for name, array in arrays:
+        array = numpy.asanyarray( array )
+        descriptors.append( { 'name': name,
+                              'dtype': array.dtype.str,
+                              'shape': list( array.shape ),
+                              'offset': offset } )
+        offset += array.nbytes + padding( array.nbytes )
+    header = json.dumps( { 'meta': meta, 'arrays': descriptors } )
+    prefix = MAGIC + struct.pack( '<II', FORMAT_VERSION, len( header ) ) + header
+
+    temp_path = path + '.tmp'
+    with open( temp_path, 'wb' ) as fstream:
+        fstream.write( prefix + '\0' * padding( len( prefix ) ) )
+        for name, array in arrays:
+            array = numpy.asanyarray( array )
+            write_array( fstream, array )
+            fstream.write( '\0' * padding( array.nbytes ) )
+    os.rename( temp_path, path )
+
+
+def version_path( path, model_version ):
+    root, extension = os.path.splitext( path )
+    return '%s.v%04d%s' % ( root, model_version, extension )
+
+
+def save_model_version( path, model_version, meta, arrays ):
+    """ Save one version of a model next to path and point path to
+    it. Readers opening path see the old or the new version, never
+    a mix, and readers that mapped the old version keep it.
+    """
+    meta = dict( meta, model_version=model_version )
+    save_model( version_path( path, model_version ), meta, arrays )
+    temp_path = path + '.tmp'
+    if os.path.exists( temp_path ):
+        os.remove( temp_path )
+    os.link( version_path( path, model_version ), temp_path )
+    os.rename( temp_path, path )
+
+
+class ModelFile:
+
+    def __init__( self, path ):
+        """ Map the model file and expose its arrays as read-only
+        numpy views on the mapping, nothing is copied
+        """
+        self.path = path
+        with open( path, 'rb' ) as fstream:
+            self.buffer = mmap.mmap( fstream.fileno(), 0, access=mmap.ACCESS_READ )
+        assert self.buffer[ :8 ] == MAGIC, path + ' is not a model file'
+        self.version, header_length = struct.unpack( '<II', self.buffer[ 8:16 ] )
+        assert self.version <= FORMAT_VERSION, \
+                'Model format version %d is not supported' % self.version
+        header = json.loads( self.buffer[ 16:16 + header_length ] )
+        data_start = 16 + header_length + padding( 16 + header_length )
+
+        self.meta = header[ 'meta' ]
+        self.arrays = {}
+        for descriptor in header[ 'arrays' ]:
+            dtype = numpy.dtype( str( descriptor[ 'dtype' ] ) )
+            shape = tuple( descriptor[ 'shape' ] )
+            count = int( numpy.prod( shape ) ) if shape else 1
+            if count == 0:
+                self.arrays[ str( descriptor[ 'name' ] ) ] = numpy.zeros( shape, dtype=dtype )
+                continue
+            array = numpy.frombuffer( self.buffer, dtype=dtype, count=count,
+                                      offset=data_start + descriptor[ 'offset' ] )
+            self.arrays[ str( descriptor[ 'name' ] ) ] = array.reshape( shape )
+
+    def __getitem__( self, name ):
+        return self.arrays[ name ]
+
+    def __contains__( self, name ):
+        return name in self.arrays
+
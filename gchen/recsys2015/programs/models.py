@@ -0,0 +1,17 @@
+#coding=utf8
+#
+# Filename:    models.py
+#
+# The sequence and naive bayes methods by name, for the scripts
+# running either one: the model creation class, the prediction class
+# and the file name store_params writes the model to
+
+from naive_bayes_method import NaiveBayesModelCreation, NaiveBayesPrediction
+from sequence_method import SequenceModelCreation, SequencePrediction
+
+CREATION = { 'sequence': SequenceModelCreation,
+             'naive_bayes': NaiveBayesModelCreation }
+PREDICTION = { 'sequence': SequencePrediction,
+               'naive_bayes': NaiveBayesPrediction }
+PARAMS_FILES = { 'sequence': 'sequence_params.bin',
+                 'naive_bayes': 'naive_bayes_params.bin' }
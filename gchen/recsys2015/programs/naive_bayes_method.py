@@ -11,24 +11,53 @@
 #     NaiveBayesModelCreation: generate model parameters according
 #                            to bayesian features
 #     NaiveBayesPrediction: predict user actions with test data
-#     ResultsEvaluation:  calculate score and precision, with the
-#                         score criterion on: 
-#                         http://2015.recsyschallenge.com/challenge.html
+#
+# Results are evaluated with results_evaluation.ResultsEvaluation
 
-import cPickle
-import math
 import numpy
 import os
-import sys
+import scipy.sparse
+
+from count_table import BLOCK_ROWS, CountMinSketch, CountTable, ITEM_MASK, PAIR_SHIFT, find_keys, \
+                        min_support_for, new_array, pair_keys, split_pair_keys
+from instrumentation import METRICS
+from model_format import ModelFile, overhead_bytes, save_model_version
+from results_evaluation import ResultsEvaluation, predict_store
+from session_store import SessionStore
 
 class NaiveBayesModelCreation:
 
-    def __init__( self, clicks_file, buys_file ):
-        """Initiate clicks and buys dict file
+    def __init__( self, store_dir ):
+        """Initiate the session store holding clicks and buys
         """
-        self.clicks_dict_file = clicks_file
-        self.buys_dict_file = buys_file
+        self.store_dir = store_dir
         self.parameters = {}
+        self.probabilities = None
+        self.model_version = 0
+        # large derived arrays are memory mapped here when set
+        self.work_dir = None
+        # parameter budget, see set_budget
+        self.min_support = 1
+        self.max_bytes = None
+        self.sketch_bytes = 0
+        self.sketch = None
+        self.row_sums = None
+
+    def set_budget( self, max_bytes=None, min_support=1, sketch_bytes=0 ):
+        """ Bound the size of the model file to max_bytes ( sketch,
+        header and padding included ) by pruning ( item, sub item )
+        entries with less than min_support co-occurring clicks,
+        min_support is raised as far as needed. Rows are normalized
+        before pruning, so kept probabilities do not change. With
+        sketch_bytes the counts of pruned entries are kept in a
+        count-min sketch of that size, otherwise they are skipped
+        like entries never seen. Item keys and, with a sketch, row
+        sums are never pruned, unify_params fails on a budget below
+        them
+        """
+        self.max_bytes = max_bytes
+        self.min_support = min_support
+        self.sketch_bytes = sketch_bytes
 
 
     def match_clicks_buys( self, clicks, buys ):
@@ -55,101 +84,445 @@ class NaiveBayesModelCreation:
 
         return clicks_buys
 
-    def generate_params( self, clicks_buys ):
+    def match_clicks_buys_batch( self, store ):
+        """ Same as match_clicks_buys for all sessions of the store
+        at once, return flat arrays with one entry per distinct
+        ( session, item ):
+            sessions: session index in the store
+            items:    item id
+            counts:   n_i, clicks on the item in the session
+            buys:     b_i, whether the item is bought in the session
+        """
+        clicks, buys = store.clicks, store.buys
+        sessions, items, counts = clicks.distinct_items()
+
+        buy_sessions, found = find_keys( clicks.sessions, buys.sessions )
+        buy_sessions = numpy.repeat( numpy.where( found, buy_sessions, -1 ), buys.lengths() )
+        bought = numpy.in1d( pair_keys( sessions, items ),
+                             pair_keys( buy_sessions, buys.items )[ buy_sessions >= 0 ] )
+        return sessions, items, counts, bought.astype( numpy.int64 )
+
+    def check_match_equivalence( self, store ):
+        """ Compare match_clicks_buys_batch against match_clicks_buys
+        on every session of the store, return the number of sessions
+        whose counts or labels differ
+        """
+        sessions, items, counts, buys = self.match_clicks_buys_batch( store )
+        bounds = numpy.searchsorted( sessions, numpy.arange( len( store ) + 1 ) )
+        mismatches = 0
+        for index, ( _, clicks, session_buys ) in enumerate( store ):
+            start, end = bounds[ index ], bounds[ index + 1 ]
+            batch = dict( ( item, { 'count': count, 'buy': buy } ) for item, count, buy in
+                          zip( items[ start:end ].tolist(), counts[ start:end ].tolist(),
+                               buys[ start:end ].tolist() ) )
+            if self.match_clicks_buys( clicks, session_buys ) != batch:
+                mismatches += 1
+        print "\n\t Sessions with different labels:", mismatches
+        return mismatches
+
+    def generate_params( self, sessions, items, counts, buys ):
         """ Generate parameters for bayes inference:
             P( Xi, buy= 0/1 ) = [ X_j , X_j+1, X_j+2 ... ]
+        as the co-occurrence counts n( Xi, buy, Xj ) = sum of
+        clicks on Xj over sessions where Xi has label buy, i.e.
+        the sparse product L_buy^T * A of the session x item label
+        matrix and the session x item clicks matrix.
+        Return { 'cooccur': CountTable } keyed by pair_keys( item,
+        sub_item ) with [ n( buy=0 ), n( buy=1 ) ] rows, no smoothing
+        added.
         """
-        items = clicks_buys.keys()
-        for item in items:
-            buy = clicks_buys[ item ][ 'buy' ]
-            self.parameters.setdefault( item, {} )
-            self.parameters[ item ].setdefault( buy, {} )
-            self.parameters[ item ].setdefault( 1-buy , {} )
-            for sub_item in items:
-                self.parameters[ item ][ buy ].setdefault( sub_item, 1 )
-                self.parameters[ item ][ 1-buy ].setdefault( sub_item, 1 )
-                self.parameters[ item ][ buy ][ sub_item ] += clicks_buys[ sub_item ][ 'count' ]
-
-    def unify_params( self ):
-        """ Refresh parameters to avoid pick point divided by 0 
+        if len( items ) == 0:
+            return { 'cooccur': CountTable.empty( [ 2 ] ) }
+        vocab, codes = numpy.unique( items, return_inverse=True )
+        n_items, n_sessions = len( vocab ), sessions.max() + 1
+
+        clicks_matrix = scipy.sparse.csr_matrix( ( counts, ( sessions, codes ) ),
+                                                 shape=( n_sessions, n_items ) )
+        labels_matrix = scipy.sparse.csr_matrix( ( numpy.ones( len( codes ), dtype=numpy.int64 ),
+                                                   ( sessions, codes + buys * n_items ) ),
+                                                 shape=( n_sessions, 2 * n_items ) )
+        cooccur = ( labels_matrix.T.tocsr() * clicks_matrix ).tocoo()
+
+        item_codes, buy = cooccur.row % n_items, cooccur.row // n_items
+        return { 'cooccur': CountTable.accumulate( pair_keys( vocab[ item_codes ],
+                                                              vocab[ cooccur.col ] ),
+                                                   buy, [ 2 ], weights=cooccur.data ) }
+
+    def merge_params( self, new_params ):
+        """ Merge the new generated counts to the global counts
         """
-        print "\n\t Start unifying parameters to probabilities"
-        progress = 0
-        for item in self.parameters:
-            progress += 1
-            if progress % 1000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
-
-            for buy in [0, 1]:
-                cur_sum = sum( self.parameters[ item ][ buy ].values() )
-                for sub_item in self.parameters[ item ][ buy ]:
-                    cur_value = self.parameters[ item ][ buy ][ sub_item ] + 0.0
-                    self.parameters[ item ][ buy ][ sub_item ] = cur_value / cur_sum
-        print "\n\t Unifying parameters Finished~~"
+        assert type( new_params ) is dict, 'New_params is not dict type'
+        with METRICS.stage( 'merge' ):
+            for key in new_params:
+                if key in self.parameters:
+                    self.parameters[ key ] = self.parameters[ key ].merge( new_params[ key ] )
+                else:
+                    self.parameters[ key ] = new_params[ key ]
+            self.params_gauges()
 
-    def create( self ):
-        """ Load data from dictionary, create model
-        on [Cn] and [Cn-1,Cn] and store it to a directory
+    def params_gauges( self ):
+        """ Record keys and bytes of the count tables
         """
-        # Load clicks dictionary
-        print "\n\t Start loading clicks dict file"
-        with open( self.clicks_dict_file, 'rb' ) as fstream:
-            clicks_dict = cPickle.load( fstream )
-        print "\n\t Load clicks Finished~~"
-
-        # Load buys dictionary
-        print "\n\t Start loading buys dict file"
-        with open( self.buys_dict_file, 'rb' ) as fstream:
-            buys_dict = cPickle.load( fstream )
-        print "\n\t Load buys Finished~~"
-
-        # for each session get clicks sequence and corresponding buys sequence
-        print "\n\t Start generating parameters"
-        progress = 0
-        for session in clicks_dict:
-            progress += 1
-            if progress % 10000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
+        for name in self.parameters:
+            table = self.parameters[ name ]
+            METRICS.gauge( 'naive_bayes_%s_keys' % name, len( table ) )
+            METRICS.gauge( 'naive_bayes_%s_bytes' % name, table.keys.nbytes + table.counts.nbytes )
+
+    def count_params( self, store, matched=None ):
+        """ Match and count the sessions of a store, the result can be
+        merged with merge_params, counts of disjoint stores add up.
+        matched is the output of match_clicks_buys_batch when the
+        store was matched before
+        """
+        METRICS.count( 'sessions', len( store ) )
+        METRICS.count( 'clicks', len( store.clicks.items ) )
+        with METRICS.stage( 'match' ):
+            sessions, items, counts, buys = self.match_clicks_buys_batch( store ) \
+                                            if matched is None else matched
+        with METRICS.stage( 'generate' ):
+            params = self.generate_params( sessions, items, counts, buys )
+            for name in params:
+                METRICS.count( name + '_keys', len( params[ name ] ) )
+        return params
+
+    def row_starts( self, keys ):
+        """ Return the item of every pair key, the start of every
+        item row and the row index of every key
+        """
+        items, sub_items = split_pair_keys( keys )
+        new_row = numpy.r_[ True, items[1:] != items[:-1] ] \
+                  if len( items ) else numpy.zeros( 0, dtype=bool )
+        return items, numpy.flatnonzero( new_row ), numpy.cumsum( new_row ) - 1
+
+    def item_blocks( self, keys ):
+        """ Yield ( start, end ) blocks of about BLOCK_ROWS sorted pair
+        keys, cut between item rows
+        """
+        start = 0
+        while start < len( keys ):
+            end = start + BLOCK_ROWS
+            if end < len( keys ):
+                item = int( keys[ end ] >> PAIR_SHIFT )
+                end = numpy.searchsorted( keys, item << PAIR_SHIFT )
+                if end <= start:
+                    end = numpy.searchsorted( keys, ( item + 1 ) << PAIR_SHIFT )
+            end = min( end, len( keys ) )
+            yield start, end
+            start = end
+
+    def work_array( self, name, shape, dtype ):
+        return new_array( shape, dtype, self.work_dir and
+                          self.work_dir + os.sep + 'naive_bayes_%s.npy' % name )
+
+    def normalize_rows( self, keys, counts, smoothing ):
+        """ Normalize the counts of whole item rows, keys are the
+        sorted pair keys of the counts:
+            P( Xj | Xi, buy ) = ( n( Xi, buy, Xj ) + smoothing )
+                              / sum_j ( n( Xi, buy, Xj ) + smoothing )
+        """
+        _, row_starts, row = self.row_starts( keys )
+        smoothed = counts + float( smoothing )
+        probs = numpy.empty( smoothed.shape, dtype=numpy.float64 )
+        for buy in [ 0, 1 ]:
+            row_sums = numpy.add.reduceat( smoothed[ :, buy ], row_starts ) \
+                       if len( row_starts ) else numpy.zeros( 0 )
+            probs[ :, buy ] = smoothed[ :, buy ] / row_sums[ row ]
+        return probs
+
+    def set_probabilities( self, probs, smoothing ):
+        """ Keep probs, aligned with the keys of the counts, in CSR
+        layout: item rows of sorted sub item columns
+        """
+        keys = self.parameters[ 'cooccur' ].keys
+        item_keys, indptr = [ numpy.zeros( 0, dtype=numpy.int64 ) ], []
+        sub_item_keys = self.work_array( 'sub_item_keys', ( len( keys ), ), numpy.int64 )
+        for start, end in self.item_blocks( keys ):
+            items, row_starts, _ = self.row_starts( keys[ start:end ] )
+            item_keys.append( items[ row_starts ].astype( numpy.int64 ) )
+            indptr.append( row_starts + start )
+            sub_item_keys[ start:end ] = keys[ start:end ] & ITEM_MASK
+        indptr.append( [ len( keys ) ] )
+        item_keys = numpy.concatenate( item_keys )
+        indptr = numpy.concatenate( indptr ).astype( numpy.int64 )
+        if self.min_support > 1:
+            # sub items whose own row was pruned get an empty row, so
+            # every sub item has a column in the predictor's matrices
+            item_keys = numpy.union1d( item_keys, sub_item_keys )
+            indptr = numpy.append( numpy.searchsorted( keys >> PAIR_SHIFT, item_keys ), len( keys ) )
+        self.probabilities = {
+            'item_keys': item_keys,
+            'indptr': indptr,
+            'sub_item_keys': sub_item_keys,
+            'probs': probs,
+            'smoothing': smoothing }
+
+    def unify_params( self, smoothing=1 ):
+        """ Normalize every item row of the counts to probabilities,
+        each co-occurring sub item gets smoothing added in both buy
+        branches. The raw counts stay untouched for later updates.
+        """
+        print "\n\t Start unifying parameters to probabilities"
+        with METRICS.stage( 'unify' ):
+            table = self.parameters[ 'cooccur' ]
+            probs = self.work_array( 'probs', table.counts.shape, numpy.float64 )
+            for start, end in self.item_blocks( table.keys ):
+                probs[ start:end ] = self.normalize_rows( table.keys[ start:end ],
+                                                          table.counts[ start:end ], smoothing )
+                METRICS.sample()
+            self.set_probabilities( probs, smoothing )
+            self.model_version += 1
+        self.prune_params()
+        print "\n\t Unifying parameters Finished~~"
 
-            clicks = clicks_dict[ session ]
-            buys = buys_dict.get( session, [] )
+    def params_meta( self ):
+        return { 'model': 'naive_bayes', 'smoothing': self.probabilities[ 'smoothing' ],
+                 'min_support': self.min_support }
 
-            clicks_buys = self.match_clicks_buys( clicks, buys )
+    def params_names( self, sketch=None ):
+        """ Names of the arrays of the model file, sketch tells if it
+        holds a sketch ( by default if the model has one )
+        """
+        names = [ 'item_keys', 'indptr', 'sub_item_keys', 'probs', 'counts',
+                  'sub_item_rows', 'log_probs', 'matrix_keys' ]
+        if sketch is None:
+            sketch = self.sketch is not None
+        if sketch:
+            names += [ 'cooccur_sketch', 'cooccur_sketch_hashes', 'model_keys',
+                       'row_items', 'row_sums' ]
+        return names
+
+    def prune_params( self ):
+        """ Apply the budget of set_budget to the co-occurrence
+        table. The sketch fallback needs the full row sums, they are
+        kept for every item
+        """
+        if self.min_support <= 1 and self.max_bytes is None:
+            return
+        with METRICS.stage( 'prune' ):
+            table = self.parameters[ 'cooccur' ]
+            smoothing = self.probabilities[ 'smoothing' ]
+            max_keys = None
+            if self.max_bytes is not None:
+                # an entry stores key, counts, probs, column row, log
+                # probs and matrix key, and its pair key with a sketch,
+                # an item its key and indptr, and its row sums with a
+                # sketch
+                entry_bytes = 8 + 2 * table.counts[ :1 ].nbytes + 4 + 16 + 8 \
+                              + ( 8 if self.sketch_bytes else 0 )
+                item_bytes = 16 + ( 24 if self.sketch_bytes else 0 )
+                fixed = self.sketch_bytes + len( self.probabilities[ 'item_keys' ] ) * item_bytes \
+                        + overhead_bytes( dict( self.params_meta(), min_support=1 << 62 ),
+                                          self.params_names( bool( self.sketch_bytes ) ) )
+                assert fixed <= self.max_bytes, \
+                        'Budget of %d bytes below the %d bytes kept unpruned' % ( self.max_bytes, fixed )
+                max_keys = ( self.max_bytes - fixed ) // entry_bytes
+            support = table.support()
+            self.min_support = min_support_for( support, max_keys, self.min_support )
+            kept = support >= self.min_support
+
+            if self.sketch_bytes:
+                if self.sketch is None:
+                    self.sketch = CountMinSketch.for_bytes( self.sketch_bytes, table.counts.shape[1:] )
+                self.sketch.add( table.keys[ ~kept ], table.counts[ ~kept ] )
+                row_items, row_sums = [], []
+                for start, end in self.item_blocks( table.keys ):
+                    items, row_starts, _ = self.row_starts( table.keys[ start:end ] )
+                    row_items.append( items[ row_starts ].astype( numpy.int64 ) )
+                    row_sums.append( numpy.add.reduceat( table.counts[ start:end ] + float( smoothing ),
+                                                         row_starts ) )
+                self.row_sums = CountTable( numpy.concatenate( row_items ),
+                                            numpy.concatenate( row_sums ) )
+
+            self.parameters[ 'cooccur' ] = table.select( kept )
+            self.set_probabilities( numpy.asarray( self.probabilities[ 'probs' ][ kept ] ), smoothing )
+            METRICS.count( 'pruned_keys', len( kept ) - kept.sum() )
+            self.params_gauges()
+
+    def load_counts( self, params_file ):
+        """ Restore raw counts and probabilities from a stored model,
+        to update it with new sessions
+        """
+        model = ModelFile( params_file )
+        assert 'model_version' in model.meta, params_file + ' holds no raw counts'
+        items = numpy.repeat( model[ 'item_keys' ], numpy.diff( model[ 'indptr' ] ) )
+        self.parameters[ 'cooccur' ] = CountTable( pair_keys( items, model[ 'sub_item_keys' ] ),
+                                                   numpy.array( model[ 'counts' ] ) )
+        self.min_support = model.meta.get( 'min_support', 1 )
+        if 'cooccur_sketch' in model:
+            self.sketch = CountMinSketch( numpy.array( model[ 'cooccur_sketch' ] ),
+                                          numpy.array( model[ 'cooccur_sketch_hashes' ] ) )
+            self.row_sums = CountTable( numpy.array( model[ 'row_items' ] ),
+                                        numpy.array( model[ 'row_sums' ] ) )
+        self.set_probabilities( numpy.array( model[ 'probs' ] ), model.meta[ 'smoothing' ] )
+        self.model_version = model.meta[ 'model_version' ]
+
+    def update( self, store ):
+        """ Fold the sessions of a store ( e.g. the clicks and buys of
+        a new day ) into the raw counts. The sessions must not be
+        counted yet. Only the rows of items clicked in the new
+        sessions are normalized again, the others are copied over.
+        """
+        assert self.min_support <= 1, 'Pruned models hold partial counts, train them again'
+        print "\n\t Start updating parameters"
+        with METRICS.stage( 'update' ):
+            delta = self.count_params( store )[ 'cooccur' ]
+            old = self.parameters[ 'cooccur' ]
+            table = old.merge( delta )
+            changed = numpy.unique( split_pair_keys( delta.keys )[0] )
+
+            probs = numpy.empty( table.counts.shape )
+            kept = ~numpy.in1d( split_pair_keys( old.keys )[0], changed )
+            rows, _ = table.lookup( old.keys[ kept ] )
+            probs[ rows ] = self.probabilities[ 'probs' ][ kept ]
+            rows = numpy.flatnonzero( numpy.in1d( split_pair_keys( table.keys )[0], changed ) )
+            smoothing = self.probabilities[ 'smoothing' ]
+            probs[ rows ] = self.normalize_rows( table.keys[ rows ], table.counts[ rows ], smoothing )
+
+            self.parameters[ 'cooccur' ] = table
+            self.params_gauges()
+            self.set_probabilities( probs, smoothing )
+            self.model_version += 1
+        print "\n\t Updating parameters Finished~~ version", self.model_version
 
-            self.generate_params( clicks_buys )
+    def create( self ):
+        """ Load data from the session store, create model
+        on co-occurring items and store it to a directory
+        """
+        # Open clicks and buys store
+        print "\n\t Start opening session store"
+        with METRICS.stage( 'load' ):
+            store = SessionStore( self.store_dir )
+        print "\n\t Open session store Finished~~"
 
-        self.unify_params()
+        print "\n\t Start generating parameters"
+        with METRICS.stage( 'create' ):
+            self.merge_params( self.count_params( store ) )
+            self.unify_params()
         print "\n\t Parameters generation finished~"
 
 
     def store_params( self, dir_2_store ):
-        """ Store parameters dict to the directory for later use
+        """ Store parameters to the directory for later use, as a
+        new version of the binary model file in CSR layout: rows
+        are items, columns the co-occurring sub items, probs[:, buy]
+        the probabilities and counts the raw counts. Log
+        probabilities, column row indexes and the flat keys of the
+        entries ( and their pair keys with a sketch ) are stored too,
+        so predictors map them instead of computing a copy each
         """
         print "\n\t Start storing parameters"
-        with open( dir_2_store + os.sep + 'naive_bayes_params.dict' , 'wb' ) as fstream:
-            cPickle.dump( self.parameters, fstream, -1 )
+        with METRICS.stage( 'store' ):
+            model = self.probabilities
+            n_keys = len( model[ 'sub_item_keys' ] )
+            sub_item_rows = self.work_array( 'sub_item_rows', ( n_keys, ), numpy.int32 )
+            log_probs = self.work_array( 'log_probs', ( 2, n_keys ), numpy.float64 )
+            matrix_keys = self.work_array( 'matrix_keys', ( n_keys, ), numpy.int64 )
+            n_items = len( model[ 'item_keys' ] )
+            for start in xrange( 0, n_keys, BLOCK_ROWS ):
+                end = min( start + BLOCK_ROWS, n_keys )
+                sub_item_rows[ start:end ], _ = find_keys( model[ 'item_keys' ],
+                                                           model[ 'sub_item_keys' ][ start:end ] )
+                log_probs[ :, start:end ] = numpy.log( model[ 'probs' ][ start:end ] ).T
+                # row * n_items + column, sorted since the columns of
+                # every row are sorted
+                rows = numpy.searchsorted( model[ 'indptr' ], numpy.arange( start, end ),
+                                           side='right' ) - 1
+                matrix_keys[ start:end ] = rows.astype( numpy.int64 ) * n_items \
+                                           + sub_item_rows[ start:end ]
+            arrays = dict( ( name, model[ name ] ) for name in
+                           [ 'item_keys', 'indptr', 'sub_item_keys', 'probs' ] )
+            arrays.update( counts=self.parameters[ 'cooccur' ].counts, sub_item_rows=sub_item_rows,
+                           log_probs=log_probs, matrix_keys=matrix_keys )
+            if self.sketch is not None:
+                arrays.update( cooccur_sketch=self.sketch.counts,
+                               cooccur_sketch_hashes=self.sketch.hashes,
+                               model_keys=self.parameters[ 'cooccur' ].keys,
+                               row_items=self.row_sums.keys, row_sums=self.row_sums.counts )
+            save_model_version( dir_2_store + os.sep + 'naive_bayes_params.bin', self.model_version,
+                                self.params_meta(),
+                                [ ( name, arrays[ name ] ) for name in self.params_names() ] )
         print "\n\t Parameters storage finished~"
 
 
 class NaiveBayesPrediction:
 
-    def __init__( self, params_file, test_file ):
-        """ Initiate class with params/test file path
+    def __init__( self, params_file, test_store_dir ):
+        """ Initiate class with params file/test store path
         and the initial probability distribution on
         single and neighbor estimator.
         """
         self.params_file = params_file
-        self.test_file = test_file
+        self.test_store_dir = test_store_dir
         self.results = {}
+        # optional SessionFilter dropping sessions unlikely to buy
+        self.session_filter = None
+        self.results_name = 'naive_bayes_results'
 
     def load_params( self ):
+        """ Map the model, log_probs[ buy ] are the entries of the
+        CSR item x sub_item rows, matrix_keys the flat keys of those
+        entries for the lookups of predict_batch. Both are mapped,
+        matrix_keys is only computed for model files written before
+        it was stored
+        """
         print "\t Start Load parameters from sequence model"
-        with open( self.params_file, 'rb' ) as fstream:
-            self.parameters = cPickle.load( fstream )
+        with METRICS.stage( 'load' ):
+            self.parameters = ModelFile( self.params_file )
+            self.item_keys = self.parameters[ 'item_keys' ]
+            self.log_probs = self.parameters[ 'log_probs' ]
+
+            if 'matrix_keys' in self.parameters:
+                self.matrix_keys = self.parameters[ 'matrix_keys' ]
+            else:
+                n_items = len( self.item_keys )
+                rows = numpy.repeat( numpy.arange( n_items, dtype=numpy.int64 ),
+                                     numpy.diff( self.parameters[ 'indptr' ] ) )
+                self.matrix_keys = rows * n_items + self.parameters[ 'sub_item_rows' ]
+
+            # entries pruned from a budgeted model are estimated by a
+            # sketch, normalized with the row sums before pruning
+            self.sketch = None
+            if 'cooccur_sketch' in self.parameters:
+                self.sketch = CountMinSketch( self.parameters[ 'cooccur_sketch' ],
+                                              self.parameters[ 'cooccur_sketch_hashes' ] )
+                self.row_sums = CountTable( self.parameters[ 'row_items' ],
+                                            self.parameters[ 'row_sums' ] )
+                self.smoothing = self.parameters.meta[ 'smoothing' ]
+                if 'model_keys' in self.parameters:
+                    self.model_keys = self.parameters[ 'model_keys' ]
+                else:
+                    items = numpy.repeat( self.item_keys, numpy.diff( self.parameters[ 'indptr' ] ) )
+                    self.model_keys = pair_keys( items, self.parameters[ 'sub_item_keys' ] )
         print "\t Load parameters Finished ~~"
 
+    def sketch_log_probs( self, items, sub_items ):
+        """ Return [ not buy, buy ] log probabilities of the pruned
+        ( item, sub item ) pairs estimated by the sketch, 0 for pairs
+        in the model, never counted or of items without a row
+        """
+        log_probs = numpy.zeros( ( 2, len( items ) ) )
+        if self.sketch is None or len( items ) == 0:
+            return log_probs
+        keys = pair_keys( items, sub_items )
+        _, in_model = find_keys( self.model_keys, keys )
+        rows, has_row = self.row_sums.lookup( items )
+        estimate = self.sketch.estimate( keys )
+        use = ~in_model & has_row & ( estimate.sum( axis=1 ) > 0 )
+        log_probs[ :, use ] = numpy.log( ( estimate[ use ] + float( self.smoothing ) )
+                                         / self.row_sums.counts[ rows[ use ] ] ).T
+        return log_probs
+
+    def get_params( self, item ):
+        """ Binary search item in the model rows, return the sorted
+        sub item keys and their log probabilities [ not buy, buy ]
+        """
+        row, found = find_keys( self.item_keys, item )
+        if not found:
+            return self.parameters[ 'sub_item_keys' ][ :0 ], self.log_probs[ :, :0 ]
+        start, end = self.parameters[ 'indptr' ][ row:row + 2 ]
+        return self.parameters[ 'sub_item_keys' ][ start:end ], \
+               self.log_probs[ :, start:end ]
+
     def predict( self, clicks_dict ):
         """ Given a series of clicks in one session
         generate the most probable buys dict
@@ -159,140 +532,167 @@ class NaiveBayesPrediction:
         buys = []
         for item in clicks_dict:
             prob_buy, prob_not_buy = 0, 0
-            item_params = self.parameters.get( item, {} )
+            sub_item_keys, log_probs = self.get_params( item )
 
-            not_buy_params = item_params.get( 0, {} )
-            buy_params = item_params.get( 1, {} )
             for sub_item in clicks_dict:
-                if sub_item in not_buy_params:
-                    prob_not_buy += math.log( not_buy_params[ sub_item ] ) \
-                                     * clicks_dict[ sub_item ]
-                    prob_buy += math.log( buy_params[ sub_item ] ) \
-                                     * clicks_dict[ sub_item ]
+                index, found = find_keys( sub_item_keys, sub_item )
+                if found:
+                    prob_not_buy += log_probs[ 0 ][ index ] * clicks_dict[ sub_item ]
+                    prob_buy += log_probs[ 1 ][ index ] * clicks_dict[ sub_item ]
+                elif self.sketch is not None:
+                    estimated = self.sketch_log_probs( numpy.array( [ item ] ),
+                                                       numpy.array( [ sub_item ] ) )
+                    prob_not_buy += estimated[ 0 ][ 0 ] * clicks_dict[ sub_item ]
+                    prob_buy += estimated[ 1 ][ 0 ] * clicks_dict[ sub_item ]
 
             if prob_not_buy < prob_buy:
                 buys.append( item )
 
         return buys
 
-    def do_task( self, dir_2_store ):
-        print "\t Start Load test sessions dict from sequence model"
-        with open( self.test_file, 'rb' ) as fstream:
-            test_dict = cPickle.load( fstream )
-        print "\t Load test sessions dict Finished ~~"
-        print "\t Number of sessions in test dict:", len( test_dict.keys() )
-
-        progress = 0
-        for session in test_dict:
-            progress += 1
-            if progress % 10000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
-
-            clicks = test_dict[ session ]
-            clicks_dict = {}
-            buys = self.predict( clicks_dict )
-            if buys:
-                self.results[ session ] = buys
-
-        #Store prediction results to a csv
-        print "\t Start storing results to ", dir_2_store
-        with open( dir_2_store + os.sep + 'naive_bayes_results' , 'w' ) as fstream:
-            for session in self.results:
-                fstream.write( session + ";" + \
-                               ",".join( self.results[ session ] ) \
-                               + '\n' )
-        print "\t Storage of results Finished ~~"
-
-
-class ResultsEvaluation:
-
-    def __init__( self, test_file, results_file, answers_file ):
-        self.score = 0.0
-        self.test_file = test_file
-        self.results_dict = {}
-        self.answers_dict = {}
-        print "\n\t Start Load results"
-        with open( results_file, 'r' ) as fstream:
-            for line in fstream:
-                [ session, items ] = line.split( ';' )
-                items = items.split( ',' )
-                self.results_dict[ session ] = items
-        print "\t Load results Finished ~~"
-        print "\t Start Load answers"
-        with open( answers_file, 'rb' ) as fstream:
-            answers_orig = cPickle.load( fstream )
-            for session in answers_orig:
-                self.answers_dict[ session ] = []
-                for record in answers_orig[ session ]:
-                    self.answers_dict[ session ].append( record[ 'item' ] )
-        print "\t Load answers Finished ~~"
-
-
-    def cal_score( self ):
-        """ calculate score of the current results
+    def predict_session( self, clicks ):
+        """ Predict one session given as a SessionView
         """
-        S = 9249729
-        Sb = len( self.answers_dict.keys() ) + 0.0
-        increment_unit = Sb / S
-        progress = 0
-        for session in self.results_dict:
-            progress += 1
-            if progress % 10000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
-
-
-            if session in self.answers_dict:
-                self.score += increment_unit
-                results = set( self.results_dict[ session ] )
-                answers = set( self.answers_dict[ session ] )
-                self.score += \
-                        (len( results.intersection( answers ) ) + 0.0) \
-                        / len( results.union( answers ) )
-            else:
-                self.score -= increment_unit
-
-        print "\n\t The score range: [", Sb*Sb/S - Sb, ",", Sb*Sb/S + Sb, "]"
-        print "\n\t The final score is : ", self.score
-
-    def cal_precision( self ):
-        """ calculate precision of the current results
+        clicks_dict = {}
+        for item in clicks.items.tolist():
+            clicks_dict[ item ] = clicks_dict.get( item, 0 ) + 1
+        return self.predict( clicks_dict )
+
+    def session_pairs( self, sessions ):
+        """ Every ( candidate, sub item ) pair of entries of the same
+        session, sessions are the sorted session indexes of the
+        entries. Return ( rows, columns ) entry indexes
+        """
+        bounds = numpy.searchsorted( sessions, numpy.arange( sessions.max() + 2 ) )
+        lengths = numpy.diff( bounds )[ sessions ]
+        rows = numpy.repeat( numpy.arange( len( sessions ) ), lengths )
+        firsts = numpy.repeat( numpy.cumsum( lengths ) - lengths, lengths )
+        columns = bounds[ sessions[ rows ] ] + numpy.arange( len( rows ) ) - firsts
+        return rows, columns
+
+    def score_batch( self, sessions, items, counts ):
+        """ Score a block of sessions given as one entry per distinct
+        ( session, item ) with click counts ( see distinct_items ).
+        Only the ( candidate, sub item ) pairs of the same session
+        are looked up in the CSR rows of the model:
+            scores[ buy ][ i ] = sum_j counts[ j ] * log_probs[ buy ]( i, j )
+        Return ( not_buy, buy ) log likelihoods aligned with items,
+        items unknown to the model score 0 in both branches
+        """
+        not_buy_scores = numpy.zeros( len( items ) )
+        buy_scores = numpy.zeros( len( items ) )
+        if len( items ) == 0:
+            return not_buy_scores, buy_scores
+
+        rows, columns = self.session_pairs( sessions )
+        codes, found = find_keys( self.item_keys, items )
+        pairs = numpy.flatnonzero( found[ rows ] & found[ columns ] )
+        entries, in_matrix = find_keys( self.matrix_keys,
+                                        codes[ rows[ pairs ] ] * len( self.item_keys )
+                                        + codes[ columns[ pairs ] ] )
+        pairs, entries = pairs[ in_matrix ], entries[ in_matrix ]
+        weights = counts[ columns[ pairs ] ]
+        for scores, buy in [ ( not_buy_scores, 0 ), ( buy_scores, 1 ) ]:
+            scores += numpy.bincount( rows[ pairs ], weights=self.log_probs[ buy ][ entries ] * weights,
+                                      minlength=len( items ) )
+
+        # pairs pruned from the model are estimated by the sketch
+        if self.sketch is not None:
+            log_probs = self.sketch_log_probs( items[ rows ], items[ columns ] )
+            for scores, buy in [ ( not_buy_scores, 0 ), ( buy_scores, 1 ) ]:
+                scores += numpy.bincount( rows, weights=log_probs[ buy ] * counts[ columns ],
+                                          minlength=len( items ) )
+        return not_buy_scores, buy_scores
+
+    def predict_batch( self, table, start, end ):
+        """ Predict the bought items of sessions start:end of a
+        SessionTable at once, return { session index: [ items ] }
         """
-        S = 9249729.0
-        Sb = len( self.answers_dict.keys() ) + 0.0
-        results_set = set( self.results_dict.keys() )
-        answers_set = set( self.answers_dict.keys() )
+        sessions, items, counts = table.distinct_items( start, end )
+        not_buy_scores, buy_scores = self.score_batch( sessions, items, counts )
+        bought = numpy.flatnonzero( not_buy_scores < buy_scores )
+
+        buys = {}
+        for session, item in zip( ( sessions[ bought ] + start ).tolist(),
+                                  items[ bought ].tolist() ):
+            buys.setdefault( session, [] ).append( item )
+        return buys
 
-        union_amount = len( results_set.union( answers_set ) )
-        inter_amount = len( results_set.intersection( answers_set ) )
-        precision = ( inter_amount + S - union_amount ) / S
+    def check_batch_scoring( self, test_store ):
+        """ Compare predict_batch against predict on every session of
+        the test store, return the number of sessions that differ
+        """
+        batch_buys = self.predict_batch( test_store.clicks, 0, len( test_store ) )
+        mismatches = 0
+        for index, ( _, clicks, _ ) in enumerate( test_store ):
+            if sorted( self.predict_session( clicks ) ) != \
+               sorted( batch_buys.get( index, [] ) ):
+                mismatches += 1
+        print "\n\t Sessions with different predictions:", mismatches
+        return mismatches
+
+    def predict_sessions( self, table, start, end, block_size=10000 ):
+        """ Predict sessions start:end of a clicks SessionTable block
+        by block, yield ( session id, bought items ) of sessions
+        with buys
+        """
+        for block_start in xrange( start, end, block_size ):
+            block_end = min( block_start + block_size, end )
+            buys = self.predict_batch( table, block_start, block_end )
+            METRICS.progress( block_end - start, end - start )
+            for index in sorted( buys ):
+                yield table.sessions[ index ], buys[ index ]
 
-        print "\n\t The score range: [", 0, ",", 1, "]"
-        print "\n\t The final precision is : ", precision
+    def do_task( self, dir_2_store, block_size=10000 ):
+        predict_store( self, dir_2_store, block_size )
 
 
 def main():
-    clicks_file = "../median_datasets/training_sessions.dict"
-    buys_file = "../median_datasets/buys_sessions.dict"
-    tests_file = "../median_datasets/tests_sessions.dict"
+    store_dir = "../median_datasets/training_store"
+    tests_store_dir = "../median_datasets/tests_store"
     """
     # generate parameters and store them
-    sequence_model = NaiveBayesModelCreation( clicks_file, buys_file )
+    sequence_model = NaiveBayesModelCreation( store_dir )
     sequence_model.create()
     dir_2_store = "../median_datasets"
     sequence_model.store_params( dir_2_store )
     """
     """
+    # generate parameters within a 256M budget, counts of the pruned
+    # entries are kept in a 64M sketch
+    naive_bayes_model = NaiveBayesModelCreation( store_dir )
+    naive_bayes_model.set_budget( 256 << 20, sketch_bytes=64 << 20 )
+    naive_bayes_model.create()
+    naive_bayes_model.store_params( "../median_datasets" )
+    """
+    """
+    # fold the sessions of a new day into the stored model
+    naive_bayes_model = NaiveBayesModelCreation( store_dir )
+    naive_bayes_model.load_counts( "../median_datasets/naive_bayes_params.bin" )
+    naive_bayes_model.update( SessionStore( "../median_datasets/new_day_store" ) )
+    naive_bayes_model.store_params( "../median_datasets" )
+    """
+    """
     # use model to predict results
-    prediction = NaiveBayesPrediction( "../median_datasets/naive_bayes_params.dict", clicks_file )
+    prediction = NaiveBayesPrediction( "../median_datasets/naive_bayes_params.bin", store_dir )
     prediction.load_params()
     dir_2_store = "../results_datasets"
     prediction.do_task( dir_2_store )
     """
+    """
+    # check batch matching against per-session matching
+    naive_bayes_model = NaiveBayesModelCreation( store_dir )
+    naive_bayes_model.check_match_equivalence( SessionStore( store_dir ) )
+    """
+    """
+    # check batch scoring against per-session scoring
+    prediction = NaiveBayesPrediction( "../median_datasets/naive_bayes_params.bin", tests_store_dir )
+    prediction.load_params()
+    prediction.check_batch_scoring( SessionStore( tests_store_dir ) )
+    """
     # calculate score
     result_file = "../results_datasets/naive_bayes_results"
-    evaluation = ResultsEvaluation( clicks_file, result_file, buys_file)
+    evaluation = ResultsEvaluation( result_file, store_dir )
     #evaluation.cal_score()
     evaluation.cal_precision()
 
@@ -0,0 +1,361 @@
+#coding=utf8
+#
+# Filename:    online_scoring.py
+#
+# Score live sessions click by click with a loaded sequence or naive
+# bayes model, in process or through a local HTTP/JSON server.
+# Every session keeps its decoding state, so a new click costs one
+# label for the sequence model ( the previous order - 1 items and the
+# previous label are all it depends on ) and one pass over the
+# distinct items of the session for naive bayes. Parameter rows of
+# hot items are kept in an LRU cache, bounded by rows for the
+# sequence model and by row entries for naive bayes.
+#
+# usage: python online_scoring.py --model sequence --port 8015
+#     POST /click  { "session": 1, "item": 214536502 }
+#                  -> { "session": 1, "buys": [ 214536502 ] }
+#     POST /score  { "items": [ 214536502, 214536500 ] }
+#                  -> { "buys": [ 214536502 ] }
+#     GET  /stats  -> latency percentiles and cache hits
+#
+# @classes
+# --------
+#     LRUCache:           mapping of bounded size dropping the least
+#                         recently used keys
+#     LatencyStats:       latencies of recent requests, p50/p99
+#     SequenceScoring:    incremental greedy decoding of sessions
+#     NaiveBayesScoring:  incremental naive bayes scores of sessions
+#     ScoringHandler:     HTTP/JSON requests to a scoring object
+
+import BaseHTTPServer
+import argparse
+import collections
+import json
+import numpy
+import time
+
+from count_table import ITEM_MASK, PAIR_SHIFT
+
+
+class LRUCache:
+
+    def __init__( self, capacity, size=None ):
+        """ Keep values of at most capacity units in total, a value
+        takes size( value ) units, one by default
+        """
+        self.capacity = capacity
+        self.size = size or ( lambda value: 1 )
+        # key -> ( value, units )
+        self.entries = collections.OrderedDict()
+        self.units = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__( self ):
+        return len( self.entries )
+
+    def get( self, key ):
+        """ Return the value of key or None, and mark key as recent
+        """
+        entry = self.entries.pop( key, None )
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[ key ] = entry
+        return entry[0]
+
+    def put( self, key, value ):
+        """ Add or replace key, put it again after a value grew
+        """
+        entry = self.entries.pop( key, None )
+        if entry is not None:
+            self.units -= entry[1]
+        units = self.size( value )
+        self.entries[ key ] = ( value, units )
+        self.units += units
+        while self.units > self.capacity:
+            self.units -= self.entries.popitem( last=False )[1][1]
+
+
+class LatencyStats:
+
+    def __init__( self, window=100000 ):
+        """ Keep the latencies of the last window requests
+        """
+        self.latencies = collections.deque( maxlen=window )
+        self.count = 0
+
+    def add( self, seconds ):
+        self.latencies.append( seconds )
+        self.count += 1
+
+    def report( self ):
+        """ Return request count and p50/p99/max latency in ms
+        """
+        if not self.latencies:
+            return { 'requests': 0, 'p50_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0 }
+        latencies = numpy.array( self.latencies ) * 1000.0
+        p50, p99 = numpy.percentile( latencies, [ 50, 99 ] )
+        return { 'requests': self.count, 'p50_ms': p50, 'p99_ms': p99,
+                 'max_ms': latencies.max() }
+
+
+class SequenceScoring:
+
+    def __init__( self, prediction, cache_size=100000, max_sessions=100000 ):
+        """ prediction is a SequencePrediction with loaded params.
+        The state of a session is [ last order - 1 items, last label,
+        bought items ], the max_sessions most recent ones are kept.
+        """
+        self.prediction = prediction
+        self.cache = LRUCache( cache_size )
+        self.sessions = LRUCache( max_sessions )
+        self.latency = LatencyStats()
+
+    def get_params( self, name, key, default ):
+        params = self.cache.get( ( name, key ) )
+        if params is None:
+            params = self.prediction.get_params( name, key, default )
+            self.cache.put( ( name, key ), params )
+        return params
+
+    def get_context_params( self, context ):
+        """ context_params of the items of a higher order model, cached
+        """
+        params = self.cache.get( ( 'context', tuple( context ) ) )
+        if params is None:
+            params = self.prediction.context_params( context )
+            self.cache.put( ( 'context', tuple( context ) ), params )
+        return params
+
+    def next_label( self, state, item ):
+        """ Label a new click of a session and advance its state
+        """
+        item_params = self.get_params( 'single', item, self.prediction.default_single )
+        context = state[0] + [ item ]
+        if len( context ) == 1:
+            label = self.prediction.click_label( item_params )
+        elif len( context ) == 2:
+            pair = ( context[0] << PAIR_SHIFT ) + ( item & ITEM_MASK )
+            pair_params = self.get_params( 'pair', pair, self.prediction.default_pair )
+            label = self.prediction.click_label( item_params, pair_params, state[1] )
+        else:
+            pair_params = self.get_context_params( context )
+            label = self.prediction.click_label( item_params, pair_params, state[1] )
+        state[0], state[1] = context[ 1 - self.prediction.order: ], label
+        if label and item not in state[2]:
+            state[2].append( item )
+        return label
+
+    def add_click( self, session, item ):
+        """ Add a click to a live session, return its bought items
+        """
+        start = time.time()
+        state = self.sessions.get( session )
+        if state is None:
+            state = [ [], None, [] ]
+            self.sessions.put( session, state )
+        self.next_label( state, item )
+        self.latency.add( time.time() - start )
+        return list( state[2] )
+
+    def score_session( self, items ):
+        """ Decode a whole session, return its bought items, the
+        labels are those of SequencePrediction.predict
+        """
+        start = time.time()
+        state = [ [], None, [] ]
+        for item in items:
+            self.next_label( state, item )
+        self.latency.add( time.time() - start )
+        return state[2]
+
+    def stats( self ):
+        report = self.latency.report()
+        report.update( { 'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses,
+                         'live_sessions': len( self.sessions ) } )
+        return report
+
+
+class NaiveBayesScoring:
+
+    def __init__( self, prediction, cache_size=200000, max_sessions=100000 ):
+        """ prediction is a NaiveBayesPrediction with loaded params,
+        cache_size the number of row entries cached over all rows.
+        The state of a session is { item: click count } and
+        { item: [ not buy, buy ] log likelihoods }.
+        """
+        self.prediction = prediction
+        self.cache = LRUCache( cache_size, lambda row: max( len( row ), 1 ) )
+        self.sessions = LRUCache( max_sessions )
+        self.latency = LatencyStats()
+
+    def get_row( self, item ):
+        """ Return { sub item: ( not buy, buy ) log probability } of
+        an item row, cached
+        """
+        row = self.cache.get( item )
+        if row is None:
+            sub_item_keys, log_probs = self.prediction.get_params( item )
+            row = dict( zip( sub_item_keys.tolist(),
+                             zip( log_probs[0].tolist(), log_probs[1].tolist() ) ) )
+            self.cache.put( item, row )
+        return row
+
+    def get_log_probs( self, item, sub_item ):
+        """ Log probabilities of sub_item in the row of item, the
+        sketch estimate of a pruned entry is cached in the row.
+        None when the model knows neither
+        """
+        row = self.get_row( item )
+        log_probs = row.get( sub_item )
+        if log_probs is None and self.prediction.sketch is not None:
+            estimated = self.prediction.sketch_log_probs( numpy.array( [ item ] ),
+                                                          numpy.array( [ sub_item ] ) )
+            log_probs = row[ sub_item ] = ( estimated[ 0, 0 ], estimated[ 1, 0 ] )
+            self.cache.put( item, row )
+        return log_probs
+
+    def next_scores( self, state, item ):
+        """ Add a click to the state: every distinct item of the
+        session gains the log probabilities of the clicked item,
+        a new item sums its row over all clicks of the session
+        """
+        counts, scores = state
+        for other in scores:
+            log_probs = self.get_log_probs( other, item )
+            if log_probs is not None:
+                scores[ other ][0] += log_probs[0]
+                scores[ other ][1] += log_probs[1]
+        counts[ item ] = counts.get( item, 0 ) + 1
+        if item not in scores:
+            score = [ 0, 0 ]
+            for other in counts:
+                log_probs = self.get_log_probs( item, other )
+                if log_probs is not None:
+                    score[0] += log_probs[0] * counts[ other ]
+                    score[1] += log_probs[1] * counts[ other ]
+            scores[ item ] = score
+
+    def bought( self, state ):
+        return [ item for item, score in state[1].iteritems() if score[0] < score[1] ]
+
+    def add_click( self, session, item ):
+        """ Add a click to a live session, return its bought items
+        """
+        start = time.time()
+        state = self.sessions.get( session )
+        if state is None:
+            state = ( {}, {} )
+            self.sessions.put( session, state )
+        self.next_scores( state, item )
+        buys = self.bought( state )
+        self.latency.add( time.time() - start )
+        return buys
+
+    def score_session( self, items ):
+        """ Score a whole session, return its bought items, the
+        decisions are those of NaiveBayesPrediction.predict
+        """
+        start = time.time()
+        clicks_dict = {}
+        for item in items:
+            clicks_dict[ item ] = clicks_dict.get( item, 0 ) + 1
+        buys = []
+        for item in clicks_dict:
+            prob_buy, prob_not_buy = 0, 0
+            for sub_item in clicks_dict:
+                log_probs = self.get_log_probs( item, sub_item )
+                if log_probs is not None:
+                    prob_not_buy += log_probs[0] * clicks_dict[ sub_item ]
+                    prob_buy += log_probs[1] * clicks_dict[ sub_item ]
+            if prob_not_buy < prob_buy:
+                buys.append( item )
+        self.latency.add( time.time() - start )
+        return buys
+
+    def stats( self ):
+        report = self.latency.report()
+        report.update( { 'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses,
+                         'live_sessions': len( self.sessions ) } )
+        return report
+
+
+class ScoringHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    """ JSON requests to self.server.scoring
+    """
+
+    def send_json( self, code, body ):
+        data = json.dumps( body )
+        self.send_response( code )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( data ) ) )
+        self.end_headers()
+        self.wfile.write( data )
+
+    def do_GET( self ):
+        if self.path == '/stats':
+            self.send_json( 200, self.server.scoring.stats() )
+        else:
+            self.send_json( 404, { 'error': 'unknown path ' + self.path } )
+
+    def do_POST( self ):
+        try:
+            request = json.loads( self.rfile.read( int( self.headers.getheader( 'Content-Length', 0 ) ) ) )
+            if self.path == '/click':
+                buys = self.server.scoring.add_click( request[ 'session' ], int( request[ 'item' ] ) )
+                self.send_json( 200, { 'session': request[ 'session' ], 'buys': buys } )
+            elif self.path == '/score':
+                buys = self.server.scoring.score_session( [ int( item ) for item in request[ 'items' ] ] )
+                self.send_json( 200, { 'buys': buys } )
+            else:
+                self.send_json( 404, { 'error': 'unknown path ' + self.path } )
+        except ( ValueError, KeyError, TypeError ), error:
+            self.send_json( 400, { 'error': str( error ) } )
+
+    def log_message( self, format, *args ):
+        pass
+
+
+def serve( scoring, port ):
+    """ Serve a scoring object on localhost:port until interrupted
+    """
+    server = BaseHTTPServer.HTTPServer( ( '127.0.0.1', port ), ScoringHandler )
+    server.scoring = scoring
+    print "\n\t Serving on port", port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print "\n\t Latency:", scoring.stats()
+
+
+def main():
+    from naive_bayes_method import NaiveBayesPrediction
+    from sequence_method import SequencePrediction
+
+    parser = argparse.ArgumentParser( description='Score live sessions over HTTP' )
+    parser.add_argument( '--model', choices=[ 'sequence', 'naive_bayes' ], default='sequence' )
+    parser.add_argument( '--params', default=None )
+    parser.add_argument( '--port', type=int, default=8015 )
+    parser.add_argument( '--cache-size', type=int, default=None,
+                         help='cached rows ( sequence ) or row entries ( naive bayes ), '
+                              'the default of the scoring class by default' )
+    args = parser.parse_args()
+
+    options = {} if args.cache_size is None else { 'cache_size': args.cache_size }
+    if args.model == 'sequence':
+        prediction = SequencePrediction( args.params or "../median_datasets/sequence_params.bin", None )
+        prediction.load_params()
+        scoring = SequenceScoring( prediction, **options )
+    else:
+        prediction = NaiveBayesPrediction( args.params or "../median_datasets/naive_bayes_params.bin", None )
+        prediction.load_params()
+        scoring = NaiveBayesScoring( prediction, **options )
+    serve( scoring, args.port )
+
+
+if __name__ == "__main__":
+    main()
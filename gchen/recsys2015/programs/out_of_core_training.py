@@ -0,0 +1,232 @@
+#coding=utf8
+#
+# Filename:    out_of_core_training.py
+#
+# Train the sequence or naive bayes model within a memory budget.
+# Sessions are read from the store in chunks, the counts of the
+# chunks are added up in an in-memory buffer which is spilled to
+# disk as a sorted run whenever it grows over its share of the
+# budget. The runs are finally merged k-way, a few rows of every
+# run at a time, into memory mapped count tables, and the model is
+# derived from them block by block.
+#
+# usage: python out_of_core_training.py --model naive_bayes --max-memory 2G
+#
+# @classes
+# --------
+#     OutOfCoreTraining: count chunks, spill runs and merge them
+#                        into one model
+
+import argparse
+import numpy
+import os
+
+from count_table import CountTable
+from instrumentation import METRICS
+from session_store import SessionStore
+
+# rough peak bytes of counting per unit of chunk cost, a session
+# of n clicks costs n * n units ( its co-occurring item pairs )
+BYTES_PER_UNIT = 256
+# sessions whose chunk cost is summed at once
+COST_WINDOW = 1 << 20
+SIZE_UNITS = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30 }
+
+
+def parse_size( text ):
+    """ Parse a memory size like '2G', '512M' or '1000000' to bytes
+    """
+    text = text.strip().upper().rstrip( 'B' )
+    if text[-1:] in SIZE_UNITS:
+        return int( float( text[ :-1 ] ) * SIZE_UNITS[ text[-1] ] )
+    return int( text )
+
+
+def table_bytes( table ):
+    return table.keys.nbytes + table.counts.nbytes
+
+
+def save_run( path, table ):
+    numpy.save( path + '_keys.npy', table.keys )
+    numpy.save( path + '_counts.npy', table.counts )
+
+
+def load_run( path ):
+    return CountTable( numpy.load( path + '_keys.npy', mmap_mode='r' ),
+                       numpy.load( path + '_counts.npy', mmap_mode='r' ) )
+
+
+def remove_run( path ):
+    os.remove( path + '_keys.npy' )
+    os.remove( path + '_counts.npy' )
+
+
+def merge_runs( runs, path, step ):
+    """ Merge sorted runs into one table saved at path, reading at
+    most step rows of every run at a time. Every round merges all
+    keys up to the smallest last key read, so the rows of a key
+    from all runs are merged together. Return the merged table
+    memory mapped.
+    """
+    shape = runs[0].counts.shape[1:]
+    cursors = [ 0 ] * len( runs )
+    n_keys = 0
+    with open( path + '.keys', 'wb' ) as keys_stream, \
+         open( path + '.counts', 'wb' ) as counts_stream:
+        while True:
+            live = [ i for i in range( len( runs ) ) if cursors[ i ] < len( runs[ i ] ) ]
+            if not live:
+                break
+            bound = min( runs[ i ].keys[ min( cursors[ i ] + step, len( runs[ i ] ) ) - 1 ]
+                         for i in live )
+            merged = CountTable.empty( shape )
+            for i in live:
+                start = cursors[ i ]
+                end = start + numpy.searchsorted( runs[ i ].keys[ start:start + step ],
+                                                  bound, side='right' )
+                merged = merged.merge( CountTable( numpy.array( runs[ i ].keys[ start:end ] ),
+                                                   numpy.array( runs[ i ].counts[ start:end ] ) ) )
+                cursors[ i ] = end
+            keys_stream.write( merged.keys.astype( numpy.int64 ).tostring() )
+            counts_stream.write( merged.counts.astype( numpy.int64 ).tostring() )
+            n_keys += len( merged )
+
+    if n_keys == 0:
+        return CountTable.empty( shape )
+    return CountTable( numpy.memmap( path + '.keys', dtype=numpy.int64, mode='r',
+                                     shape=( n_keys, ) ),
+                       numpy.memmap( path + '.counts', dtype=numpy.int64, mode='r',
+                                     shape=( n_keys, ) + shape ) )
+
+
+class OutOfCoreTraining:
+
+    def __init__( self, model_class, store_dir, max_memory, run_dir, order=2 ):
+        """ model_class is SequenceModelCreation or
+        NaiveBayesModelCreation, max_memory the budget in bytes,
+        runs and merged tables go to run_dir, order is the context
+        order of the sequence model. An eighth of the
+        budget goes to counting a chunk and an eighth to the buffer
+        of counts, merging a table takes about three times its size.
+        """
+        self.model_class = model_class
+        self.store_dir = store_dir
+        self.order = order
+        self.max_memory = max_memory
+        self.run_dir = run_dir
+        self.chunk_units = max( max_memory // 8 // BYTES_PER_UNIT, 1 )
+        self.buffer_bytes = max_memory // 8
+        self.buffer = {}
+        self.runs = {}
+
+    def new_model( self ):
+        if self.order == 2:
+            return self.model_class( self.store_dir )
+        return self.model_class( self.store_dir, order=self.order )
+
+    def run_path( self, name, index ):
+        return self.run_dir + os.sep + '%s_%s_run_%04d' \
+               % ( self.model_class.__name__, name, index )
+
+    def chunks( self, store ):
+        """ Yield ( start, end ) session ranges of the store whose
+        counting cost fits in the chunk budget, at least one session
+        """
+        offsets = store.clicks.offsets
+        start = 0
+        while start < len( store ):
+            lengths = numpy.diff( offsets[ start:start + COST_WINDOW + 1 ] )
+            cost = numpy.cumsum( lengths * lengths )
+            end = start + max( numpy.searchsorted( cost, self.chunk_units, side='right' ), 1 )
+            yield start, end
+            start = end
+
+    def spill( self ):
+        """ Save every table of the buffer as a sorted run
+        """
+        for name in self.buffer:
+            runs = self.runs.setdefault( name, [] )
+            save_run( self.run_path( name, len( runs ) ), self.buffer[ name ] )
+            runs.append( self.run_path( name, len( runs ) ) )
+        self.buffer = {}
+
+    def count( self ):
+        """ Count the store chunk by chunk, spilling the buffer when
+        it outgrows its share of the budget
+        """
+        if not os.path.exists( self.run_dir ):
+            os.makedirs( self.run_dir )
+        store = SessionStore( self.store_dir )
+        model = self.new_model()
+
+        print "\n\t Start counting in chunks"
+        with METRICS.stage( 'count' ):
+            for start, end in self.chunks( store ):
+                counts = model.count_params( store.take( numpy.arange( start, end ) ) )
+                for name in counts:
+                    if name in self.buffer:
+                        self.buffer[ name ] = self.buffer[ name ].merge( counts[ name ] )
+                    else:
+                        self.buffer[ name ] = counts[ name ]
+                if sum( table_bytes( table ) for table in self.buffer.values() ) > self.buffer_bytes:
+                    with METRICS.stage( 'spill' ):
+                        self.spill()
+                METRICS.progress( end, len( store ) )
+            with METRICS.stage( 'spill' ):
+                self.spill()
+            METRICS.gauge( 'runs', max( [ 0 ] + map( len, self.runs.values() ) ) )
+        print "\n\t Counting in chunks Finished~~"
+
+    def merge( self ):
+        """ Merge the runs of every table into a new model and unify
+        it, derived arrays of the model are memory mapped in run_dir.
+        The returned model is ready for store_params
+        """
+        print "\n\t Start merging runs"
+        model = self.new_model()
+        with METRICS.stage( 'merge' ):
+            for name in self.runs:
+                runs = [ load_run( path ) for path in self.runs[ name ] ]
+                row_bytes = table_bytes( runs[0] ) // max( len( runs[0] ), 1 ) or 1
+                step = max( self.buffer_bytes // ( row_bytes * len( runs ) ), 1 )
+                path = self.run_dir + os.sep + '%s_%s_merged' % ( self.model_class.__name__, name )
+                model.parameters[ name ] = merge_runs( runs, path, step )
+                for run_path in self.runs[ name ]:
+                    remove_run( run_path )
+            # tables without runs ( an empty store ) stay empty
+            empty = model.count_params( SessionStore( self.store_dir ).take( numpy.arange( 0 ) ) )
+            for name in empty:
+                if name not in self.runs:
+                    model.parameters[ name ] = empty[ name ]
+            self.runs = {}
+            model.params_gauges()
+        model.work_dir = self.run_dir
+        model.unify_params()
+        print "\n\t Merging runs Finished~~"
+        return model
+
+    def create( self ):
+        self.count()
+        return self.merge()
+
+
+def main():
+    from models import CREATION
+
+    parser = argparse.ArgumentParser( description='Train a model within a memory budget' )
+    parser.add_argument( '--model', choices=sorted( CREATION ), default='sequence' )
+    parser.add_argument( '--store', default="../median_datasets/training_store" )
+    parser.add_argument( '--max-memory', default='2G' )
+    parser.add_argument( '--order', type=int, default=2, help='context order of the sequence model' )
+    parser.add_argument( '--run-dir', default="../median_datasets/runs" )
+    parser.add_argument( '--output', default="../median_datasets" )
+    args = parser.parse_args()
+
+    training = OutOfCoreTraining( CREATION[ args.model ], args.store,
+                                  parse_size( args.max_memory ), args.run_dir, args.order )
+    model = training.create()
+    model.store_params( args.output )
+
+
+if __name__ == "__main__":
+    main()
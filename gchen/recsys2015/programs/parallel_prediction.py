@@ -0,0 +1,130 @@
+#coding=utf8
+#
+# Filename:    parallel_prediction.py
+#
+# Predict the test sessions in parallel worker processes. The model
+# is loaded once in the parent; workers are forked afterwards and
+# read it through the shared memory mapping. Every worker scores its
+# own range of sessions and streams the results to its own part file,
+# the parts are concatenated into the usual 'session;item,item' file.
+# The session_filter of the prediction is applied in the parent, the
+# workers only split the kept sessions.
+#
+# @classes
+# --------
+#     ParallelPrediction: split the test store into session ranges
+#                         and predict them in a process pool
+
+import multiprocessing
+import numpy
+import os
+import time
+
+from instrumentation import METRICS
+from session_store import SessionStore
+
+# prediction object and clicks table shared with the forked workers
+PREDICTION = None
+TABLE = None
+
+
+def predict_part( args ):
+    """ Worker: predict sessions start:end and write them to part_file
+    """
+    start, end, part_file = args
+    # only the parent shows progress
+    METRICS.configure( live=False )
+    with open( part_file + '.tmp', 'w' ) as fstream:
+        for session, items in PREDICTION.predict_sessions( TABLE, start, end ):
+            fstream.write( str( session ) + ";" + \
+                           ",".join( [ str( item ) for item in items ] ) \
+                           + '\n' )
+    os.rename( part_file + '.tmp', part_file )
+    return end - start
+
+
+class ParallelPrediction:
+
+    def __init__( self, prediction, processes=None, parts_per_process=4 ):
+        """ prediction is a SequencePrediction or NaiveBayesPrediction
+        with parameters already loaded
+        """
+        self.prediction = prediction
+        self.processes = processes or multiprocessing.cpu_count()
+        self.parts_per_process = parts_per_process
+
+    def split_ranges( self, table, n_parts ):
+        """ Split the sessions of a table into n_parts ranges
+        holding about the same number of clicks
+        """
+        bounds = numpy.linspace( 0, table.offsets[-1], n_parts + 1 )
+        bounds = numpy.unique( numpy.searchsorted( table.offsets, bounds ) )
+        return zip( bounds[ :-1 ].tolist(), bounds[ 1: ].tolist() )
+
+    def do_task( self, dir_2_store ):
+        global PREDICTION, TABLE
+        PREDICTION = self.prediction
+
+        table = SessionStore( self.prediction.test_store_dir ).clicks
+        if self.prediction.session_filter is not None:
+            table = self.prediction.session_filter.filter_table( table )
+            print "\t Sessions kept by the session filter:", len( table )
+        TABLE = table
+        ranges = self.split_ranges( table, self.processes * self.parts_per_process )
+        results_file = dir_2_store + os.sep + self.prediction.results_name
+        part_files = [ results_file + '.part-%05d' % part for part in range( len( ranges ) ) ]
+        tasks = [ ( start, end, part_file ) for ( start, end ), part_file
+                  in zip( ranges, part_files ) ]
+
+        print "\t Start predicting", len( table ), "sessions in", len( tasks ), \
+              "parts with", self.processes, "processes"
+        start_time = time.time()
+        with METRICS.stage( 'predict' ):
+            METRICS.count( 'sessions', len( table ) )
+            METRICS.count( 'clicks', len( table.items ) )
+            pool = multiprocessing.Pool( self.processes )
+            try:
+                done = 0
+                for sessions in pool.imap_unordered( predict_part, tasks ):
+                    done += sessions
+                    METRICS.progress( done, len( table ) )
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start_time
+        print "\n\t Prediction Finished ~~", len( table ) / max( elapsed, 1e-9 ), \
+              "sessions/sec"
+
+        # merge the parts into the results file
+        print "\t Start storing results to ", dir_2_store
+        with METRICS.stage( 'write' ):
+            with open( results_file + '.tmp', 'w' ) as fstream:
+                for part_file in part_files:
+                    with open( part_file, 'r' ) as part:
+                        for line in part:
+                            fstream.write( line )
+            os.rename( results_file + '.tmp', results_file )
+        for part_file in part_files:
+            os.remove( part_file )
+        print "\t Storage of results Finished ~~"
+
+
+def main():
+    from naive_bayes_method import NaiveBayesPrediction
+    from sequence_method import SequencePrediction
+
+    tests_store_dir = "../median_datasets/tests_store"
+    dir_2_store = "../results_datasets"
+
+    prediction = SequencePrediction( "../median_datasets/sequence_params.bin", tests_store_dir )
+    prediction.load_params()
+    ParallelPrediction( prediction ).do_task( dir_2_store )
+    """
+    prediction = NaiveBayesPrediction( "../median_datasets/naive_bayes_params.bin", tests_store_dir )
+    prediction.load_params()
+    ParallelPrediction( prediction ).do_task( dir_2_store )
+    """
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#coding=utf8
+#
+# Filename:    parameter_budget.py
+#
+# Report model size against challenge score at several parameter
+# budgets. The training store is counted once, every budget prunes
+# a copy of the counts ( see set_budget of the model creation
+# classes ), stores it, predicts a held-out store with buys and
+# scores the results.
+#
+# usage: python parameter_budget.py --model sequence --budgets 1M,4M,16M
+#
+# @classes
+# --------
+#     ParameterBudget: count once, prune, predict and score per budget
+
+import argparse
+import json
+import os
+
+from models import CREATION, PARAMS_FILES, PREDICTION
+from out_of_core_training import parse_size
+from results_evaluation import ResultsEvaluation
+from session_store import SessionStore
+
+
+class ParameterBudget:
+
+    def __init__( self, model, store_dir, heldout_store_dir, work_dir ):
+        """ model is 'sequence' or 'naive_bayes', the held-out store
+        must have buys, models and results go to work_dir
+        """
+        self.model = model
+        self.store_dir = store_dir
+        self.heldout_store_dir = heldout_store_dir
+        self.work_dir = work_dir
+        self.counts = None
+
+    def count( self ):
+        model = CREATION[ self.model ]( self.store_dir )
+        self.counts = model.count_params( SessionStore( self.store_dir ) )
+
+    def evaluate( self, name, max_bytes=None, min_support=1, sketch_bytes=0 ):
+        """ Prune the counts to a budget, store, predict and score the
+        model, return its row of the report
+        """
+        if self.counts is None:
+            self.count()
+        model_dir = self.work_dir + os.sep + name
+        if not os.path.exists( model_dir ):
+            os.makedirs( model_dir )
+
+        model = CREATION[ self.model ]( self.store_dir )
+        model.merge_params( self.counts )
+        model.set_budget( max_bytes, min_support, sketch_bytes )
+        model.unify_params()
+        model.store_params( model_dir )
+
+        params_file = model_dir + os.sep + PARAMS_FILES[ self.model ]
+        prediction = PREDICTION[ self.model ]( params_file, self.heldout_store_dir )
+        prediction.load_params()
+        prediction.do_task( model_dir )
+        store = SessionStore( self.heldout_store_dir )
+        evaluation = ResultsEvaluation( model_dir + os.sep + prediction.results_name, store,
+                                        total_sessions=len( store ) )
+        return { 'budget': name,
+                 'max_bytes': max_bytes,
+                 'min_support': model.min_support,
+                 'keys': sum( len( table ) for table in model.parameters.values() ),
+                 'sketch_bytes': sketch_bytes,
+                 'model_bytes': os.path.getsize( params_file ),
+                 'score': evaluation.get_score() }
+
+    def run( self, budgets, sketch_fraction=0.0 ):
+        """ Evaluate the unpruned model and every budget ( bytes ),
+        sketch_fraction of a budget goes to the sketch
+        """
+        report = [ self.evaluate( 'full' ) ]
+        for max_bytes in budgets:
+            report.append( self.evaluate( 'budget_%d' % max_bytes, max_bytes,
+                                          sketch_bytes=int( max_bytes * sketch_fraction ) ) )
+
+        full_score = report[0][ 'score' ]
+        print "\n\t %-16s %12s %8s %10s %12s %12s %10s" % ( 'budget', 'model bytes', 'support',
+                                                             'keys', 'sketch', 'score', 'change' )
+        for row in report:
+            row[ 'score_change' ] = row[ 'score' ] - full_score
+            print "\t %-16s %12d %8d %10d %12d %12.2f %10.2f" % (
+                    row[ 'budget' ], row[ 'model_bytes' ], row[ 'min_support' ], row[ 'keys' ],
+                    row[ 'sketch_bytes' ], row[ 'score' ], row[ 'score_change' ] )
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Model size against score at parameter budgets' )
+    parser.add_argument( '--model', choices=sorted( CREATION ), default='sequence' )
+    parser.add_argument( '--store', default="../median_datasets/training_store" )
+    parser.add_argument( '--heldout-store', default="../median_datasets/heldout_store" )
+    parser.add_argument( '--budgets', default='1M,4M,16M,64M' )
+    parser.add_argument( '--sketch-fraction', type=float, default=0.0 )
+    parser.add_argument( '--work-dir', default="../median_datasets/budgets" )
+    parser.add_argument( '--output', default=None )
+    args = parser.parse_args()
+
+    budget = ParameterBudget( args.model, args.store, args.heldout_store, args.work_dir )
+    report = budget.run( [ parse_size( size ) for size in args.budgets.split( ',' ) ],
+                         args.sketch_fraction )
+    if args.output:
+        with open( args.output, 'w' ) as fstream:
+            json.dump( report, fstream, indent=2, sort_keys=True )
+
+
+if __name__ == "__main__":
+    main()
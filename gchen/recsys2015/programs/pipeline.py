@@ -0,0 +1,298 @@
+#coding=utf8
+#
+# Filename:    pipeline.py
+#
+# Run ingest, match, train, predict and evaluate of one method as
+# named stages with a content addressed cache. The key of a stage
+# hashes everything its output depends on: the fingerprints ( size
+# and modification time ) of the raw files or the keys of the
+# upstream stages, the stage parameters ( model class, smoothing,
+# order, init_proportion ) and the fingerprints of the modules doing
+# the work, the module of the stage and the local modules it imports.
+# A stage whose key has an artifact is skipped, a changed
+# input or parameter changes the key of its stage and of everything
+# downstream, so only those stages run again.
+#
+# Cache layout: <cache dir>/<stage>/<key>/ holds the output of the
+# stage and stage.json, written last, with its inputs and timing.
+#
+# usage: python pipeline.py --model sequence --init-proportion 0.6
+#
+# @classes
+# --------
+#     StageCache: artifact directories of stages keyed by the hash
+#                 of their inputs
+#     Pipeline:   the stages of one method over raw csv files
+
+import argparse
+import hashlib
+import json
+import numpy
+import os
+import shutil
+import sys
+import time
+import types
+
+from instrumentation import METRICS
+from models import CREATION, PARAMS_FILES, PREDICTION
+from results_evaluation import ResultsEvaluation
+from session_store import SessionIngestion, SessionStore
+
+STAGES = [ 'ingest', 'match', 'train', 'predict', 'evaluate' ]
+# directory of the modules whose code goes into the stage keys
+LOCAL_DIR = os.path.dirname( os.path.abspath( __file__ ) )
+
+
+def file_fingerprint( path ):
+    """ [ path, size, mtime ] of a file, None when it is missing
+    """
+    if path is None:
+        return None
+    path = os.path.abspath( path )
+    stat = os.stat( path )
+    return [ path, stat.st_size, int( stat.st_mtime * 1000 ) ]
+
+
+def local_modules( name, found ):
+    """ Add to found the module name and the modules of LOCAL_DIR it
+    imports at module level, directly or not
+    """
+    source = getattr( sys.modules.get( name ), '__file__', None )
+    if name in found or source is None \
+       or os.path.dirname( os.path.abspath( source ) ) != LOCAL_DIR:
+        return found
+    found.add( name )
+    for value in vars( sys.modules[ name ] ).values():
+        if isinstance( value, types.ModuleType ):
+            local_modules( value.__name__, found )
+        elif isinstance( getattr( value, '__module__', None ), str ):
+            local_modules( value.__module__, found )
+    return found
+
+
+def code_fingerprint( obj ):
+    """ Fingerprints of the source files of the module defining obj
+    and of the local modules it imports
+    """
+    fingerprints = []
+    for name in sorted( local_modules( obj.__module__, set() ) ):
+        source = sys.modules[ name ].__file__
+        if source.endswith( '.pyc' ):
+            source = source[ :-1 ]
+        fingerprints.append( [ name ] + file_fingerprint( source )[ 1: ] )
+    return fingerprints
+
+
+def save_matched( path, matched ):
+    """ Save the output of match_clicks_buys_batch, an array or a
+    tuple of arrays
+    """
+    arrays = matched if isinstance( matched, tuple ) else ( matched, )
+    with open( path, 'wb' ) as fstream:
+        numpy.savez( fstream, *arrays )
+    return isinstance( matched, tuple )
+
+
+def load_matched( path, is_tuple ):
+    arrays = numpy.load( path )
+    matched = tuple( arrays[ 'arr_%d' % i ] for i in xrange( len( arrays.files ) ) )
+    return matched if is_tuple else matched[0]
+
+
+class StageCache:
+
+    def __init__( self, cache_dir ):
+        self.cache_dir = cache_dir
+        self.ran = []
+        self.skipped = []
+
+    def key( self, stage, inputs ):
+        """ Hash of the stage name and its inputs, inputs is a json
+        serializable dict
+        """
+        text = json.dumps( { 'stage': stage, 'inputs': inputs }, sort_keys=True )
+        return hashlib.sha1( text ).hexdigest()
+
+    def path( self, stage, key ):
+        return self.cache_dir + os.sep + stage + os.sep + key
+
+    def valid( self, stage, key ):
+        return os.path.exists( self.path( stage, key ) + os.sep + 'stage.json' )
+
+    def run( self, stage, inputs, build ):
+        """ Return the artifact directory of the stage for inputs,
+        build( directory ) fills it first unless it is cached. The
+        artifact is built aside and renamed, so an interrupted stage
+        leaves no valid artifact
+        """
+        key = self.key( stage, inputs )
+        path = self.path( stage, key )
+        if self.valid( stage, key ):
+            print "\n\t Stage", stage, "cached", key[ :12 ]
+            self.skipped.append( stage )
+            return path
+
+        print "\n\t Stage", stage, "running", key[ :12 ]
+        temp_path = path + '.tmp'
+        if os.path.exists( temp_path ):
+            shutil.rmtree( temp_path )
+        os.makedirs( temp_path )
+        start = time.time()
+        with METRICS.stage( stage ):
+            build( temp_path )
+        with open( temp_path + os.sep + 'stage.json', 'w' ) as fstream:
+            json.dump( { 'stage': stage, 'key': key, 'inputs': inputs,
+                         'seconds': time.time() - start }, fstream, indent=2, sort_keys=True )
+        if os.path.exists( path ):
+            shutil.rmtree( path )
+        os.rename( temp_path, path )
+        self.ran.append( stage )
+        return path
+
+
+class Pipeline:
+
+    def __init__( self, model, cache_dir, clicks_file, buys_file, tests_file,
+                  tests_buys_file, smoothing=1, init_proportion=None, order=2 ):
+        """ model is 'sequence' or 'naive_bayes'. The tests buys file
+        holds the answers of the evaluate stage. init_proportion
+        ( pair weight ) and order only apply to the sequence model,
+        None keeps the default weights
+        """
+        self.model = model
+        self.creation = CREATION[ model ]
+        self.prediction = PREDICTION[ model ]
+        self.cache = StageCache( cache_dir )
+        self.clicks_file = clicks_file
+        self.buys_file = buys_file
+        self.tests_file = tests_file
+        self.tests_buys_file = tests_buys_file
+        self.smoothing = smoothing
+        self.init_proportion = init_proportion
+        self.order = order
+
+    def model_inputs( self, with_order=True ):
+        """ Inputs shared by the stages running model code, the click
+        labels of the match stage do not depend on the order
+        """
+        inputs = { 'model_class': self.creation.__name__,
+                   'code': code_fingerprint( self.creation ) }
+        if self.model == 'sequence' and with_order:
+            inputs[ 'order' ] = self.order
+        return inputs
+
+    def ingest( self, clicks_file, buys_file ):
+        """ Session store of a clicks file and an optional buys file
+        """
+        def build( path ):
+            SessionIngestion( clicks_file, buys_file ).ingest( path )
+        return self.cache.run( 'ingest', { 'clicks': file_fingerprint( clicks_file ),
+                                           'buys': file_fingerprint( buys_file ),
+                                           'code': code_fingerprint( SessionIngestion ) }, build )
+
+    def match( self, store_dir ):
+        """ Click labels of the training store, as matched by the model
+        """
+        def build( path ):
+            model = self.creation( store_dir )
+            is_tuple = save_matched( path + os.sep + 'matched.npz',
+                                     model.match_clicks_buys_batch( SessionStore( store_dir ) ) )
+            with open( path + os.sep + 'matched.json', 'w' ) as fstream:
+                json.dump( { 'tuple': is_tuple }, fstream )
+        inputs = dict( self.model_inputs( with_order=False ), store=os.path.basename( store_dir ) )
+        return self.cache.run( 'match', inputs, build )
+
+    def train( self, store_dir, matched_dir ):
+        """ Model file counted from the matched training store
+        """
+        def build( path ):
+            with open( matched_dir + os.sep + 'matched.json' ) as fstream:
+                is_tuple = json.load( fstream )[ 'tuple' ]
+            matched = load_matched( matched_dir + os.sep + 'matched.npz', is_tuple )
+            if self.model == 'sequence':
+                model = self.creation( store_dir, order=self.order )
+                model.smoothing = self.smoothing
+            else:
+                model = self.creation( store_dir )
+            model.merge_params( model.count_params( SessionStore( store_dir ), matched ) )
+            if self.model == 'sequence':
+                model.unify_params()
+            else:
+                model.unify_params( self.smoothing )
+            model.store_params( path )
+        inputs = dict( self.model_inputs(), store=os.path.basename( store_dir ),
+                       matched=os.path.basename( matched_dir ), smoothing=self.smoothing )
+        return self.cache.run( 'train', inputs, build )
+
+    def predict( self, model_dir, tests_dir ):
+        """ Results file of the tests store
+        """
+        def build( path ):
+            prediction = self.prediction( model_dir + os.sep + PARAMS_FILES[ self.model ],
+                                          tests_dir )
+            prediction.load_params()
+            if self.init_proportion is not None:
+                prediction.init_proportion = { 'single': 1.0 - self.init_proportion,
+                                               'pair': self.init_proportion }
+            prediction.do_task( path )
+        inputs = dict( self.model_inputs(), model=os.path.basename( model_dir ),
+                       tests=os.path.basename( tests_dir ),
+                       init_proportion=self.init_proportion )
+        return self.cache.run( 'predict', inputs, build )
+
+    def evaluate( self, results_dir, tests_dir ):
+        """ Score and precision of the results against the tests buys,
+        return them as a dict
+        """
+        results_name = self.prediction( None, None ).results_name
+
+        def build( path ):
+            store = SessionStore( tests_dir )
+            evaluation = ResultsEvaluation( results_dir + os.sep + results_name, store,
+                                            total_sessions=len( store ) )
+            scores = { 'score': evaluation.cal_score(),
+                       'precision': evaluation.cal_precision() }
+            with open( path + os.sep + 'scores.json', 'w' ) as fstream:
+                json.dump( scores, fstream, indent=2, sort_keys=True )
+        path = self.cache.run( 'evaluate', { 'results': os.path.basename( results_dir ),
+                                             'tests': os.path.basename( tests_dir ),
+                                             'code': code_fingerprint( ResultsEvaluation ) },
+                               build )
+        with open( path + os.sep + 'scores.json' ) as fstream:
+            return json.load( fstream )
+
+    def run( self ):
+        """ Run every stage not cached yet, return the scores
+        """
+        training_dir = self.ingest( self.clicks_file, self.buys_file )
+        tests_dir = self.ingest( self.tests_file, self.tests_buys_file )
+        matched_dir = self.match( training_dir )
+        model_dir = self.train( training_dir, matched_dir )
+        results_dir = self.predict( model_dir, tests_dir )
+        scores = self.evaluate( results_dir, tests_dir )
+        print "\n\t Stages run:", self.cache.ran, "cached:", self.cache.skipped
+        return scores
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Cached ingest, train, predict and evaluate stages' )
+    parser.add_argument( '--model', choices=sorted( PARAMS_FILES ), default='sequence' )
+    parser.add_argument( '--cache-dir', default="../median_datasets/stage_cache" )
+    parser.add_argument( '--clicks', default="../original_datasets/yoochoose-clicks.dat" )
+    parser.add_argument( '--buys', default="../original_datasets/yoochoose-buys.dat" )
+    parser.add_argument( '--tests', default="../original_datasets/yoochoose-test.dat" )
+    parser.add_argument( '--tests-buys', default="../original_datasets/yoochoose-test-buys.dat" )
+    parser.add_argument( '--smoothing', type=float, default=1 )
+    parser.add_argument( '--init-proportion', type=float, default=None,
+                         help='pair weight of the sequence model' )
+    parser.add_argument( '--order', type=int, default=2 )
+    args = parser.parse_args()
+
+    pipeline = Pipeline( args.model, args.cache_dir, args.clicks, args.buys, args.tests,
+                         args.tests_buys, args.smoothing, args.init_proportion, args.order )
+    print json.dumps( pipeline.run(), sort_keys=True )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+#coding=utf8
+#
+# Filename:    results_evaluation.py
+#
+# Evaluate a 'session;item,item' results file against the buys of a
+# session store, shared by the sequence and naive bayes methods, and
+# write one for a predictor ( predict_store )
+#
+# @classes
+# --------
+#     ResultsEvaluation:  calculate score and precision, with the
+#                         score criterion on:
+#                         http://2015.recsyschallenge.com/challenge.html
+#     SampledEvaluation:  estimate score and precision on a stratified
+#                         sample of sessions ( buyers / non buyers x
+#                         length buckets ) with bootstrap intervals,
+#                         one sample serves many results files
+#
+# usage: python results_evaluation.py --index sample.npz results_a results_b
+
+import argparse
+import numpy
+import os
+
+from count_table import find_keys, pair_keys
+from instrumentation import METRICS
+from session_store import SessionStore
+
+# number of sessions in the challenge test set
+TEST_SESSIONS = 9249729
+
+BLOCK_SIZE = 1 << 25
+# session lengths starting a new stratum of SampledEvaluation
+LENGTH_BOUNDS = [ 2, 3, 5, 10 ]
+
+
+def parse_results( data ):
+    """ Parse complete 'session;item,item' lines of a string at once.
+    A number followed by ';' is a session, the other numbers are
+    items of the last session. Only digits and the delimiters that
+    end a number are kept, so numpy parses all numbers in one go.
+    Return ( sessions, pair_sessions, pair_items ), one session per
+    line and one ( session, item ) pair per item.
+    """
+    buf = numpy.frombuffer( data, dtype=numpy.uint8 )
+    is_digit = ( buf >= ord( '0' ) ) & ( buf <= ord( '9' ) )
+    ends = ~is_digit
+    ends[ :1 ] = False
+    ends[ 1: ] &= is_digit[ :-1 ]
+    if not ends.any():
+        empty = numpy.zeros( 0, dtype=numpy.int64 )
+        return empty, empty, empty.astype( numpy.int32 )
+
+    is_session = buf[ ends ] == ord( ';' )
+    numbers = numpy.where( ends, ord( ',' ), buf )[ is_digit | ends ]
+    values = numpy.fromstring( numbers.tostring(), dtype=numpy.int64, sep=',' )
+    owner = numpy.maximum.accumulate( numpy.where( is_session,
+                                                   numpy.arange( len( values ) ), 0 ) )
+    return values[ is_session ], values[ owner[ ~is_session ] ], \
+           values[ ~is_session ].astype( numpy.int32 )
+
+
+def read_results( results_file ):
+    """ Stream a results file in blocks of whole lines, return the
+    arrays of parse_results for the whole file
+    """
+    parts, rest = [], ''
+    with open( results_file, 'rb' ) as fstream:
+        while True:
+            block = fstream.read( BLOCK_SIZE )
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind( '\n' ) + 1
+            parts.append( parse_results( block[ :cut ] ) )
+            rest = block[ cut: ]
+    parts.append( parse_results( rest + '\n' ) )
+    return tuple( numpy.concatenate( [ part[ i ] for part in parts ] ) for i in xrange( 3 ) )
+
+
+def predict_store( prediction, dir_2_store, *predict_args ):
+    """ do_task of the predictors: predict the clicks of the test
+    store of prediction, kept by its session_filter when set, and
+    write the 'session;item,item' results file to dir_2_store.
+    predict_args go to predict_sessions after the session range
+    """
+    print "\t Start open test session store"
+    with METRICS.stage( 'load' ):
+        test_store = SessionStore( prediction.test_store_dir )
+    print "\t Open test session store Finished ~~"
+    print "\t Number of sessions in test store:", len( test_store )
+
+    table = test_store.clicks
+    if prediction.session_filter is not None:
+        table = prediction.session_filter.filter_table( table )
+        print "\t Sessions kept by the session filter:", len( table )
+
+    with METRICS.stage( 'predict' ):
+        METRICS.count( 'sessions', len( table ) )
+        METRICS.count( 'clicks', len( table.items ) )
+        for session, items in prediction.predict_sessions( table, 0, len( table ), *predict_args ):
+            prediction.results[ str( session ) ] = [ str( item ) for item in items ]
+
+    #Store prediction results to a csv
+    print "\t Start storing results to ", dir_2_store
+    with METRICS.stage( 'write' ):
+        with open( dir_2_store + os.sep + prediction.results_name , 'w' ) as fstream:
+            for session in prediction.results:
+                fstream.write( session + ";" + \
+                               ",".join( prediction.results[ session ] ) \
+                               + '\n' )
+    print "\t Storage of results Finished ~~"
+
+
+class ResultsEvaluation:
+
+    def __init__( self, results_file, store_dir, total_sessions=TEST_SESSIONS ):
+        """ Load answers from the buys of the store ( a store dir or
+        an open SessionStore ) and stream the results file,
+        results_file may be None to set results later with
+        set_results
+        """
+        self.score = 0.0
+        self.total_sessions = total_sessions
+        store = store_dir
+        if not isinstance( store, SessionStore ):
+            store = SessionStore( store_dir )
+        print "\t Start Load answers"
+        with METRICS.stage( 'load' ):
+            self.load_answers( store.buys )
+        print "\t Load answers Finished ~~"
+        if results_file is not None:
+            print "\n\t Start Load results"
+            with METRICS.stage( 'load' ):
+                self.load_results( results_file )
+                METRICS.count( 'result_pairs', len( self.result_keys ) )
+            print "\t Load results Finished ~~"
+
+    def load_answers( self, buys ):
+        """ Keep the bought ( session, item ) pairs of a buys table
+        as sorted int64 keys, and the sessions with buys
+        """
+        sessions, items, _ = buys.distinct_items()
+        self.answer_keys = pair_keys( numpy.asarray( buys.sessions )[ sessions ], items )
+        self.answer_sessions, self.answer_counts = \
+                numpy.unique( self.answer_keys >> 32, return_counts=True )
+
+    def load_results( self, results_file ):
+        """ Stream the results file in blocks of whole lines
+        """
+        sessions, pair_sessions, pair_items = read_results( results_file )
+        self.set_results( pair_sessions, pair_items, sessions )
+
+    def set_results( self, pair_sessions, pair_items, sessions=None ):
+        """ Set results from arrays, one ( session, item ) pair per
+        predicted item, sessions lists the predicted sessions ( the
+        sessions of the pairs by default )
+        """
+        self.result_keys = numpy.unique( pair_keys( pair_sessions, pair_items ) )
+        if sessions is None:
+            sessions = pair_sessions
+        self.result_sessions = numpy.unique( sessions )
+        self.score = 0.0
+
+    def session_terms( self ):
+        """ Return for every result session whether it bought and the
+        jaccard of predicted and bought items
+        """
+        bought = numpy.in1d( self.result_sessions, self.answer_sessions )
+        index = numpy.searchsorted( self.result_sessions, self.result_keys >> 32 )
+        n_results = numpy.bincount( index, minlength=len( self.result_sessions ) )
+        n_inter = numpy.bincount( index, minlength=len( self.result_sessions ),
+                                  weights=numpy.in1d( self.result_keys, self.answer_keys ) )
+        rows, found = find_keys( self.answer_sessions, self.result_sessions )
+        n_answers = numpy.zeros( len( self.result_sessions ), dtype=numpy.int64 )
+        n_answers[ found ] = self.answer_counts[ rows[ found ] ]
+        union = numpy.maximum( n_results + n_answers - n_inter, 1 )
+        return bought, numpy.where( bought, n_inter / union, 0.0 )
+
+    def get_score( self ):
+        """ calculate score of the current results without printing
+        """
+        with METRICS.stage( 'evaluate' ):
+            increment_unit = ( len( self.answer_sessions ) + 0.0 ) / self.total_sessions
+            bought, jaccard = self.session_terms()
+            self.score = increment_unit * ( bought.sum() - ( ~bought ).sum() ) + jaccard.sum()
+            METRICS.count( 'result_sessions', len( self.result_sessions ) )
+        return self.score
+
+    def cal_score( self ):
+        """ calculate score of the current results
+        """
+        S = self.total_sessions
+        Sb = len( self.answer_sessions ) + 0.0
+        self.get_score()
+
+        print "\n\t The score range: [", Sb*Sb/S - Sb, ",", Sb*Sb/S + Sb, "]"
+        print "\n\t The final score is : ", self.score
+        return self.score
+
+    def cal_precision( self ):
+        """ calculate precision of the current results
+        """
+        S = self.total_sessions + 0.0
+        with METRICS.stage( 'evaluate' ):
+            inter_amount = numpy.in1d( self.result_sessions, self.answer_sessions ).sum()
+        union_amount = len( self.result_sessions ) + len( self.answer_sessions ) - inter_amount
+        precision = ( inter_amount + S - union_amount ) / S
+
+        print "\n\t The score range: [", 0, ",", 1, "]"
+        print "\n\t The final precision is : ", precision
+        return precision
+
+
+class SampledEvaluation:
+
+    def __init__( self, store_dir, fraction=0.1, total_sessions=TEST_SESSIONS, seed=2015,
+                  length_bounds=LENGTH_BOUNDS ):
+        """ Sample fraction of the clicks sessions of the store ( a
+        store dir or an open SessionStore ) in every stratum, strata
+        are buyers / non buyers times the session length buckets cut
+        at length_bounds. store_dir may be None to load an index
+        saved with save
+        """
+        self.store_dir = store_dir
+        self.total_sessions = total_sessions
+        if store_dir is None:
+            return
+        store = store_dir
+        if not isinstance( store, SessionStore ):
+            store = SessionStore( store_dir )
+        random = numpy.random.RandomState( seed )
+
+        sessions = numpy.asarray( store.clicks.sessions )
+        bought = numpy.in1d( sessions, store.buys.sessions )
+        strata = bought * ( len( length_bounds ) + 1 ) \
+                 + numpy.searchsorted( length_bounds, store.clicks.lengths(), side='right' )
+        self.n_buyers = len( numpy.unique( store.buys.sessions ) )
+        self.population = numpy.bincount( strata, minlength=2 * ( len( length_bounds ) + 1 ) )
+
+        # every stratum keeps at least 2 sessions for its variance
+        picked = []
+        for stratum in numpy.flatnonzero( self.population ):
+            members = numpy.flatnonzero( strata == stratum )
+            size = min( len( members ), max( int( numpy.ceil( fraction * len( members ) ) ), 2 ) )
+            picked.append( random.choice( members, size, replace=False ) )
+        picked = numpy.sort( numpy.concatenate( picked ) )
+        self.set_sample( sessions[ picked ], strata[ picked ], bought[ picked ],
+                         store.take( picked ).buys )
+
+    def set_sample( self, sessions, strata, bought, buys ):
+        """ Keep the sampled sessions ( sorted ), their strata, whether
+        they bought and the answers of the buys of the sample
+        """
+        self.sessions = sessions
+        self.strata = strata
+        self.bought = bought
+        self.sample_sizes = numpy.bincount( strata, minlength=len( self.population ) )
+        self.weights = self.population / numpy.maximum( self.sample_sizes, 1 ).astype( numpy.float64 )
+        distinct_sessions, items, _ = buys.distinct_items()
+        self.answer_keys = pair_keys( numpy.asarray( buys.sessions )[ distinct_sessions ], items )
+        answer_sessions, counts = numpy.unique( self.answer_keys >> 32, return_counts=True )
+        self.answer_counts = numpy.zeros( len( sessions ), dtype=numpy.int64 )
+        self.answer_counts[ numpy.searchsorted( sessions, answer_sessions ) ] = counts
+
+    def save( self, path ):
+        """ Save the sampled index, to evaluate results in other
+        processes without the store
+        """
+        with open( path, 'wb' ) as fstream:
+            numpy.savez( fstream, sessions=self.sessions, strata=self.strata,
+                         bought=self.bought, population=self.population,
+                         answer_keys=self.answer_keys, answer_counts=self.answer_counts,
+                         totals=numpy.array( [ self.n_buyers, self.total_sessions ] ) )
+
+    @staticmethod
+    def load( path ):
+        arrays = numpy.load( path )
+        evaluation = SampledEvaluation( None, total_sessions=int( arrays[ 'totals' ][1] ) )
+        evaluation.n_buyers = int( arrays[ 'totals' ][0] )
+        evaluation.population = arrays[ 'population' ]
+        evaluation.sessions = arrays[ 'sessions' ]
+        evaluation.strata = arrays[ 'strata' ]
+        evaluation.bought = arrays[ 'bought' ]
+        evaluation.sample_sizes = numpy.bincount( evaluation.strata,
+                                                  minlength=len( evaluation.population ) )
+        evaluation.weights = evaluation.population \
+                             / numpy.maximum( evaluation.sample_sizes, 1 ).astype( numpy.float64 )
+        evaluation.answer_keys = arrays[ 'answer_keys' ]
+        evaluation.answer_counts = arrays[ 'answer_counts' ]
+        return evaluation
+
+    def sample_terms( self, results_file ):
+        """ Read a results file and return for every sampled session
+        its term of the score and whether its buy / no buy guess is
+        wrong, as columns [ n_sample, 2 ]. Sessions of the results
+        outside the store are ignored
+        """
+        result_sessions, pair_sessions, pair_items = read_results( results_file )
+        predicted = numpy.in1d( self.sessions, result_sessions )
+        keys = numpy.unique( pair_keys( pair_sessions, pair_items ) )
+        rows, found = find_keys( self.sessions, keys >> 32 )
+        rows, keys = rows[ found ], keys[ found ]
+        n_results = numpy.bincount( rows, minlength=len( self.sessions ) )
+        n_inter = numpy.bincount( rows, minlength=len( self.sessions ),
+                                  weights=numpy.in1d( keys, self.answer_keys ) )
+        union = numpy.maximum( n_results + self.answer_counts - n_inter, 1 )
+        unit = self.n_buyers / float( self.total_sessions )
+
+        terms = numpy.zeros( ( len( self.sessions ), 2 ) )
+        terms[ :, 0 ] = numpy.where( predicted, numpy.where( self.bought, unit + n_inter / union,
+                                                             -unit ), 0.0 )
+        terms[ :, 1 ] = predicted != self.bought
+        return terms
+
+    def totals( self, terms ):
+        """ Stratified estimates of the population sums of terms
+        """
+        return ( terms * self.weights[ self.strata ][ :, None ] ).sum( axis=0 )
+
+    def bootstrap( self, terms, n_boot=1000, seed=2015 ):
+        """ Population sums of n_boot stratified bootstrap resamples
+        of the sample, [ n_boot, columns ]. The deviation of every
+        resampled stratum from its sample is scaled by the finite
+        population correction sqrt( 1 - n_h / N_h ), so a stratum
+        sampled whole does not vary
+        """
+        random = numpy.random.RandomState( seed )
+        sums = numpy.zeros( ( n_boot, terms.shape[1] ) )
+        for stratum in numpy.flatnonzero( self.sample_sizes ):
+            values = terms[ self.strata == stratum ]
+            size = len( values )
+            total = values.sum( axis=0 )
+            correction = numpy.sqrt( max( 1.0 - size / float( self.population[ stratum ] ), 0.0 ) )
+            step = max( ( 1 << 22 ) // size, 1 )
+            for start in xrange( 0, n_boot, step ):
+                draws = random.randint( 0, size, ( min( step, n_boot - start ), size ) )
+                resampled = total + correction * ( values[ draws ].sum( axis=1 ) - total )
+                sums[ start:start + len( draws ) ] += self.weights[ stratum ] * resampled
+        return sums
+
+    def estimate( self, results_file, n_boot=1000, level=0.95 ):
+        """ Estimate score and precision of a results file with their
+        bootstrap confidence intervals at level
+        """
+        with METRICS.stage( 'evaluate' ):
+            terms = self.sample_terms( results_file )
+            estimates = self.to_measures( self.totals( terms ) )
+            resampled = self.to_measures( self.bootstrap( terms, n_boot ) )
+        tail = 50.0 * ( 1.0 - level )
+        low, high = numpy.percentile( resampled, [ tail, 100.0 - tail ], axis=0 )
+        report = { 'sample_sessions': len( self.sessions ) }
+        for column, name in enumerate( [ 'score', 'precision' ] ):
+            report[ name ] = float( estimates[ column ] )
+            report[ name + '_interval' ] = [ float( low[ column ] ), float( high[ column ] ) ]
+        print "\n\t Estimated score     : ", report[ 'score' ], report[ 'score_interval' ]
+        print "\t Estimated precision : ", report[ 'precision' ], report[ 'precision_interval' ]
+        return report
+
+    def to_measures( self, sums ):
+        """ Score and precision from the sums of score terms and
+        wrong guesses
+        """
+        sums = numpy.array( sums, dtype=numpy.float64 )
+        sums[ ..., 1 ] = 1.0 - sums[ ..., 1 ] / self.total_sessions
+        return sums
+
+    def required_sample( self, results_a, results_b, alpha=0.05, power=0.8 ):
+        """ Paired comparison of two results files on the sample,
+        return the estimated score difference, its standard error
+        and the number of sampled sessions needed to tell them apart
+        at a two sided alpha with the given power, allocated like
+        the current sample
+        """
+        z_alpha = { 0.1: 1.645, 0.05: 1.960, 0.01: 2.576 }[ alpha ]
+        z_power = { 0.5: 0.0, 0.8: 0.842, 0.9: 1.282 }[ power ]
+        differences = self.sample_terms( results_a )[ :, 0 ] - self.sample_terms( results_b )[ :, 0 ]
+        difference = self.totals( differences[ :, None ] )[0]
+        variance = 0.0
+        for stratum in numpy.flatnonzero( self.sample_sizes > 1 ):
+            values = differences[ self.strata == stratum ]
+            size = float( len( values ) )
+            variance += self.population[ stratum ] ** 2 * values.var( ddof=1 ) / size \
+                        * ( 1.0 - size / self.population[ stratum ] )
+        error = numpy.sqrt( variance )
+        if difference == 0:
+            needed = int( self.population.sum() )
+        else:
+            needed = int( numpy.ceil( len( self.sessions ) * ( ( z_alpha + z_power ) * error
+                                                               / abs( difference ) ) ** 2 ) )
+        needed = min( needed, int( self.population.sum() ) )
+        print "\n\t Score difference:", difference, "+-", error
+        print "\t Sampled sessions needed to separate them:", needed
+        return { 'difference': difference, 'error': error, 'needed_sessions': needed }
+
+    def check_exact( self, results_file, n_boot=1000, level=0.95 ):
+        """ Score the results file exactly with ResultsEvaluation and
+        check that the exact values fall in the intervals
+        """
+        assert self.store_dir is not None, 'The exact check needs the store'
+        report = self.estimate( results_file, n_boot, level )
+        evaluation = ResultsEvaluation( results_file, self.store_dir, self.total_sessions )
+        for name, exact in [ ( 'score', evaluation.cal_score() ),
+                             ( 'precision', evaluation.cal_precision() ) ]:
+            low, high = report[ name + '_interval' ]
+            report[ name + '_exact' ] = exact
+            # summing in another order may move the bounds by rounding
+            slack = 1e-9 * max( abs( exact ), 1.0 )
+            report[ name + '_covered' ] = bool( low - slack <= exact <= high + slack )
+        print "\n\t Exact values inside the intervals:", report[ 'score_covered' ], \
+              report[ 'precision_covered' ]
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Approximate evaluation on a stratified sample' )
+    parser.add_argument( 'results', nargs='+' )
+    parser.add_argument( '--store', default="../median_datasets/tests_store" )
+    parser.add_argument( '--fraction', type=float, default=0.1 )
+    parser.add_argument( '--total-sessions', type=int, default=None,
+                         help='sessions of the test set, the store size by default' )
+    parser.add_argument( '--index', default=None, help='sample index file, reused when present' )
+    parser.add_argument( '--check-exact', action='store_true' )
+    args = parser.parse_args()
+
+    if args.index and os.path.exists( args.index ):
+        sampled = SampledEvaluation.load( args.index )
+        sampled.store_dir = args.store
+    else:
+        store = SessionStore( args.store )
+        sampled = SampledEvaluation( store, args.fraction, args.total_sessions or len( store ) )
+        if args.index:
+            sampled.save( args.index )
+    for results_file in args.results:
+        print "\n\t", results_file
+        if args.check_exact:
+            sampled.check_exact( results_file )
+        else:
+            sampled.estimate( results_file )
+    if len( args.results ) == 2:
+        sampled.required_sample( *args.results )
+
+
+if __name__ == "__main__":
+    main()
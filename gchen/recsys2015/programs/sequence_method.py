@@ -4,31 +4,68 @@
 # Author:      Ge CHEN <princhene1991@126.com>
 # Date:        2015-01-31
 #
-# Use neighboring sequence inference to predict user actions
+# Use neighboring sequence inference to predict user actions. With
+# order k > 2 the label transition of a click is also counted for the
+# context of its k - 1 previous items, prediction backs off from the
+# longest context kept in the model to the pair
 #
 # @classes
 # --------
 #     SequenceModelCreation: generate model parameters according
 #                            to sequence features
 #     SequencePrediction: predict user actions with test data
-#     ResultsEvaluation:  calculate score and precision, with the
-#                         score criterion on: 
-#                         http://2015.recsyschallenge.com/challenge.html
+#
+# Results are evaluated with results_evaluation.ResultsEvaluation
 
-import cPickle
 import numpy
 import os
-import sys
+
+from count_table import BLOCK_ROWS, CountMinSketch, CountTable, PAIR_SHIFT, ITEM_MASK, context_keys, \
+                        find_keys, min_support_for, new_array, pair_keys
+from instrumentation import METRICS
+from model_format import ModelFile, overhead_bytes, save_model_version
+from results_evaluation import ResultsEvaluation, predict_store
+from session_store import SessionStore
 
 class SequenceModelCreation:
 
-    def __init__( self, clicks_file, buys_file ):
-        """Initiate clicks and buys dict file
+    def __init__( self, store_dir, order=2 ):
+        """Initiate the session store holding clicks and buys, order
+        is the number of items of the longest context ( 2 to 4 )
         """
-        self.clicks_dict_file = clicks_file
-        self.buys_dict_file = buys_file
+        assert 2 <= order <= 4, 'Context order must be 2 to 4'
+        self.store_dir = store_dir
+        self.order = order
         self.parameters = {}
+        self.probabilities = {}
+        self.smoothing = 1
+        self.model_version = 0
+        # large derived arrays are memory mapped here when set
+        self.work_dir = None
+        # parameter budget, see set_budget
+        self.min_support = 1
+        self.max_bytes = None
+        self.sketch_bytes = 0
+        self.sketches = {}
+
+    def set_budget( self, max_bytes=None, min_support=1, sketch_bytes=0 ):
+        """ Bound the size of the model file to max_bytes ( sketch,
+        header and padding included ) by pruning pair keys clicked
+        less than min_support times, min_support is raised as far as
+        needed. The item table is never pruned, unify_params fails
+        on a budget below it. With sketch_bytes the counts of pruned
+        keys are kept in a count-min sketch of that size, otherwise
+        they fall back to the even probabilities of unseen keys
+        """
+        self.max_bytes = max_bytes
+        self.min_support = min_support
+        self.sketch_bytes = sketch_bytes
 
+    def table_names( self ):
+        """ Parameter tables: items, pairs and one table of hashed
+        contexts per order above 2
+        """
+        return [ 'single', 'pair' ] + [ 'order%d' % n for n in xrange( 3, self.order + 1 ) ]
 
     def match_clicks_buys( self, clicks, buys ):
         """ given a list of clicks and buys in the
@@ -65,36 +102,130 @@ class SequenceModelCreation:
 
         return clicks_seq, buys_seq
 
-    def generate_params( self, clicks_seq, buys_seq ):
-        """ Generate parameters for sequence inference:
+    def match_clicks_buys_batch( self, store ):
+        """ Label every click of the store at once, same labels as
+        match_clicks_buys gives session by session. For a click on
+        item x at time t, let M be the buys of x in the session
+        with time > t:
+            b = 1  if len( M ) >= 2
+            b = 1  if len( M ) == 1 and no later click on x happens
+                   before that buy
+            b = 0  otherwise
+        Return an int8 array aligned with store.clicks.items
+        """
+        clicks, buys = store.clicks, store.buys
+        n_clicks, n_buys = len( clicks.items ), len( buys.items )
+        if n_clicks == 0:
+            return numpy.zeros( 0, dtype=numpy.int8 )
+
+        # key every record by ( session, item )
+        click_keys = pair_keys( numpy.repeat( clicks.sessions, clicks.lengths() ), clicks.items )
+        buy_keys = pair_keys( numpy.repeat( buys.sessions, buys.lengths() ), buys.items )
+
+        # sort clicks and buys together by key and time, on equal
+        # time the buy goes first since only later buys count
+        keys = numpy.concatenate( ( click_keys, buy_keys ) )
+        times = numpy.concatenate( ( clicks.times, buys.times ) )
+        is_buy = numpy.concatenate( ( numpy.zeros( n_clicks, numpy.int64 ),
+                                      numpy.ones( n_buys, numpy.int64 ) ) )
+        order = numpy.lexsort( ( 1 - is_buy, times, keys ) )
+        keys, times, is_buy = keys[ order ], times[ order ], is_buy[ order ]
+
+        new_group = numpy.r_[ True, keys[1:] != keys[:-1] ]
+        group_starts = numpy.flatnonzero( new_group )
+        group_ends = numpy.append( group_starts[1:], len( keys ) ) - 1
+        group = numpy.cumsum( new_group ) - 1
+
+        # number of buys after each record and last buy time of each key
+        buys_seen = numpy.cumsum( is_buy )
+        buys_after = buys_seen[ group_ends ][ group ] - buys_seen
+        buy_times = numpy.where( is_buy == 1, times, numpy.iinfo( numpy.int64 ).min )
+        last_buy_time = numpy.maximum.reduceat( buy_times, group_starts )[ group ]
+
+        is_click = order < n_clicks
+        count = numpy.empty( n_clicks, dtype=numpy.int64 )
+        count[ order[ is_click ] ] = buys_after[ is_click ]
+        deadline = numpy.empty( n_clicks, dtype=numpy.int64 )
+        deadline[ order[ is_click ] ] = last_buy_time[ is_click ]
+
+        # clicks on the same key at a later position before the last buy
+        click_order = numpy.argsort( click_keys, kind='mergesort' )
+        sorted_keys = click_keys[ click_order ]
+        early = ( clicks.times[ click_order ] < deadline[ click_order ] ).astype( numpy.int64 )
+        early_seen = numpy.cumsum( early )
+        new_group = numpy.r_[ True, sorted_keys[1:] != sorted_keys[:-1] ]
+        click_ends = numpy.append( numpy.flatnonzero( new_group )[1:], n_clicks ) - 1
+        click_group = numpy.cumsum( new_group ) - 1
+        later_early = numpy.empty( n_clicks, dtype=numpy.int64 )
+        later_early[ click_order ] = early_seen[ click_ends ][ click_group ] - early_seen
+
+        labels = ( count >= 2 ) | ( ( count == 1 ) & ( later_early == 0 ) )
+        return labels.astype( numpy.int8 )
+
+    def check_match_equivalence( self, store ):
+        """ Compare match_clicks_buys_batch against match_clicks_buys
+        on every session of the store, return the number of sessions
+        whose labels differ
+        """
+        labels = self.match_clicks_buys_batch( store )
+        offsets = store.clicks.offsets
+        mismatches = 0
+        for index, ( _, clicks, buys ) in enumerate( store ):
+            _, buys_seq = self.match_clicks_buys( clicks, buys )
+            if buys_seq != labels[ offsets[ index ]:offsets[ index + 1 ] ].tolist():
+                mismatches += 1
+        print "\n\t Sessions with different labels:", mismatches
+        return mismatches
+
+    def generate_params( self, items, buys, offsets ):
+        """ Generate parameters for sequence inference in bulk,
+        items/buys are flat click arrays and offsets the CSR
+        session offsets:
             P( Xi ) = [ n( bi=0 ), n( bi=1 ) ]
             P( Xi-1,Xi ) = [ n( bi-1=0, bi=0 ) , n( bi-1=0, bi=1) ,
                              n( bi-1=1, bi=0 ) , n( bi-1=1, bi=1) ]
+            P( Xi-k+1,...,Xi ) = the same counts for clicks with k - 1
+                             previous clicks in the session
+        Return { 'single': CountTable [2], 'pair': CountTable [2,2] }
+        keyed by item id and by pair_keys( item, item_next ), and
+        { 'order<k>': CountTable [2,2] } keyed by context_keys up to
+        the order of the model
         """
-        assert len( clicks_seq ) == len( buys_seq ), \
-                "The clicks_seq and buys_seq are not of same length!"
-        len_seq = len( clicks_seq )
-        params_dict = {}
-        for i in range( len_seq ):
-            # update params for current item
-            item = clicks_seq[ i ]
-            buy = buys_seq[ i ]
-            params_dict.setdefault( item, \
-                                    numpy.array([ 0, 0 ]) )
-            params_dict[ item ][ buy ] += 1
-
-            # update params for item together with next item
-            if i < ( len_seq - 1 ):
-                item_next = clicks_seq[ i+1 ]
-                buy_next = buys_seq[ i+1 ]
-                pair = item + '_' + item_next
-                params_dict.setdefault( pair, \
-                                        numpy.array([ [0, 0],
-                                                      [0, 0] ])
-                                        )
-                params_dict[ pair ][ buy ][ buy_next ] += 1
-
-        return params_dict
+        assert len( items ) == len( buys ), \
+                "The items and buys are not of same length!"
+        buys = numpy.asarray( buys, dtype=numpy.int64 )
+
+        # intern item ids
+        vocab, codes = numpy.unique( items, return_inverse=True )
+        codes = codes.astype( numpy.int64 )
+        counts = numpy.bincount( codes * 2 + buys, minlength=len( vocab ) * 2 )
+        single = CountTable( vocab.astype( numpy.int64 ),
+                             counts.reshape( len( vocab ), 2 ).astype( numpy.int64 ) )
+
+        # neighbouring clicks inside the same session
+        is_pair = numpy.ones( max( len( items ) - 1, 0 ), dtype=bool )
+        session_ends = numpy.asarray( offsets[ 1:-1 ], dtype=numpy.int64 ) - 1
+        is_pair[ session_ends[ session_ends >= 0 ] ] = False
+        first = numpy.flatnonzero( is_pair )
+        pair_codes = codes[ first ] * len( vocab ) + codes[ first + 1 ]
+        unique_codes, inverse = numpy.unique( pair_codes, return_inverse=True )
+        counts = numpy.bincount( inverse * 4 + buys[ first ] * 2 + buys[ first + 1 ],
+                                 minlength=len( unique_codes ) * 4 )
+        pair = CountTable( pair_keys( vocab[ unique_codes // len( vocab ) ],
+                                      vocab[ unique_codes % len( vocab ) ] ),
+                           counts.reshape( len( unique_codes ), 2, 2 ).astype( numpy.int64 ) )
+        params = { 'single': single, 'pair': pair }
+
+        # longer contexts of the clicks far enough into their session
+        offsets = numpy.asarray( offsets, dtype=numpy.int64 )
+        position = numpy.arange( len( items ) ) \
+                   - numpy.repeat( offsets[ :-1 ] - offsets[0], numpy.diff( offsets ) )
+        for n in xrange( 3, self.order + 1 ):
+            ends = numpy.flatnonzero( position >= n - 1 )
+            params[ 'order%d' % n ] = CountTable.accumulate( context_keys( items, n )[ ends - n + 1 ],
+                                                             buys[ ends - 1 ] * 2 + buys[ ends ],
+                                                             ( 2, 2 ) )
+        return params
 
 
     def merge_params( self, new_params ):
@@ -102,89 +233,278 @@ class SequenceModelCreation:
         global parameters set
         """
         assert type( new_params ) is dict, 'New_params is not dict type'
-        for key in new_params:
-            if key in self.parameters:
-                self.parameters[ key ] += new_params[ key ]
-            else:
-                self.parameters[ key ] = new_params[ key ]
+        with METRICS.stage( 'merge' ):
+            for key in new_params:
+                if key in self.parameters:
+                    self.parameters[ key ] = self.parameters[ key ].merge( new_params[ key ] )
+                else:
+                    self.parameters[ key ] = new_params[ key ]
+            self.params_gauges()
 
+    def params_gauges( self ):
+        """ Record keys and bytes of the parameter tables
+        """
+        for name in self.parameters:
+            table = self.parameters[ name ]
+            METRICS.gauge( 'sequence_%s_keys' % name, len( table ) )
+            METRICS.gauge( 'sequence_%s_bytes' % name, table.keys.nbytes + table.counts.nbytes )
+
+
+    def smooth( self, counts ):
+        """ Probabilities of count rows with smoothing added to every
+        count, to avoid pick point divided by 0
+        """
+        smoothed = counts + float( self.smoothing )
+        return smoothed / smoothed.sum( axis=-1, keepdims=True )
 
     def unify_params( self ):
-        """ Refresh parameters to avoid pick point divided by 0 
+        """ Derive the smoothed probabilities of all keys, the raw
+        counts in parameters stay untouched for later updates
+        """
+        with METRICS.stage( 'unify' ):
+            for name in self.table_names():
+                counts = self.parameters[ name ].counts
+                probs = new_array( counts.shape, numpy.float64, self.work_dir and
+                                   self.work_dir + os.sep + 'sequence_%s_probs.npy' % name )
+                for start in xrange( 0, len( counts ), BLOCK_ROWS ):
+                    probs[ start:start + BLOCK_ROWS ] = self.smooth( counts[ start:start + BLOCK_ROWS ] )
+                    METRICS.sample()
+                self.probabilities[ name ] = probs
+            self.model_version += 1
+        self.prune_params()
+
+    def key_bytes( self, name ):
+        """ Stored bytes of one key: key, raw counts and probabilities
+        """
+        return 8 + 2 * self.parameters[ name ].counts[ :1 ].nbytes
+
+    def params_meta( self ):
+        return { 'model': 'sequence', 'smoothing': self.smoothing,
+                 'min_support': self.min_support, 'order': self.order }
+
+    def params_names( self ):
+        """ Names of the arrays of the model file
         """
-        for key in self.parameters:
-            if '_' not in key:
-                self.parameters[ key ] += numpy.array([1, 1])
-            else:
-                self.parameters[ key ] += numpy.array(
-                                    [ [1, 1],
-                                      [1, 1] ]
-                                  )
+        names = []
+        for name in self.table_names():
+            names += [ name + '_keys', name + '_counts', name + '_probs' ]
+        for name in sorted( self.sketches ):
+            names += [ name + '_sketch', name + '_sketch_hashes' ]
+        return names
+
+    def prune_params( self ):
+        """ Apply the budget of set_budget to the pair and context
+        tables with one min_support, the item table is small and kept
+        whole. Pruned contexts back off to shorter ones, the sketch
+        only holds pruned pairs
+        """
+        if self.min_support <= 1 and self.max_bytes is None:
+            return
+        with METRICS.stage( 'prune' ):
+            names = self.table_names()[ 1: ]
+            max_keys = None
+            if self.max_bytes is not None:
+                arrays = self.params_names()
+                if self.sketch_bytes and 'pair' not in self.sketches:
+                    arrays += [ 'pair_sketch', 'pair_sketch_hashes' ]
+                fixed = self.sketch_bytes + len( self.parameters[ 'single' ] ) * self.key_bytes( 'single' ) \
+                        + overhead_bytes( dict( self.params_meta(), min_support=1 << 62 ), arrays )
+                assert fixed <= self.max_bytes, \
+                        'Budget of %d bytes below the %d bytes kept unpruned' % ( self.max_bytes, fixed )
+                max_keys = ( self.max_bytes - fixed ) // self.key_bytes( 'pair' )
+            supports = [ self.parameters[ name ].support() for name in names ]
+            self.min_support = min_support_for( numpy.concatenate( supports ), max_keys,
+                                                self.min_support )
+            for name, support in zip( names, supports ):
+                table = self.parameters[ name ]
+                kept = support >= self.min_support
+                if self.sketch_bytes and name == 'pair':
+                    if name not in self.sketches:
+                        self.sketches[ name ] = CountMinSketch.for_bytes( self.sketch_bytes,
+                                                                          table.counts.shape[1:] )
+                    self.sketches[ name ].add( table.keys[ ~kept ], table.counts[ ~kept ] )
+                self.parameters[ name ] = table.select( kept )
+                self.probabilities[ name ] = numpy.asarray( self.probabilities[ name ][ kept ] )
+                METRICS.count( 'pruned_keys', len( kept ) - kept.sum() )
+            self.params_gauges()
+
+    def load_counts( self, params_file ):
+        """ Restore raw counts and probabilities from a stored model,
+        to update it with new sessions
+        """
+        model = ModelFile( params_file )
+        assert 'model_version' in model.meta, params_file + ' holds no raw counts'
+        self.order = model.meta.get( 'order', 2 )
+        for name in self.table_names():
+            self.parameters[ name ] = CountTable( numpy.array( model[ name + '_keys' ] ),
+                                                  numpy.array( model[ name + '_counts' ] ) )
+            self.probabilities[ name ] = numpy.array( model[ name + '_probs' ] )
+        self.smoothing = model.meta[ 'smoothing' ]
+        self.model_version = model.meta[ 'model_version' ]
+        self.min_support = model.meta.get( 'min_support', 1 )
+
+    def update( self, store ):
+        """ Fold the sessions of a store ( e.g. the clicks and buys of
+        a new day ) into the raw counts. The sessions must not be
+        counted yet. Only probabilities of keys seen in the new
+        sessions are recomputed, the others are copied over.
+        """
+        assert self.min_support <= 1, 'Pruned models hold partial counts, train them again'
+        print "\n\t Start updating parameters"
+        with METRICS.stage( 'update' ):
+            delta = self.count_params( store )
+            for name in self.table_names():
+                old, table = self.parameters[ name ], self.parameters[ name ].merge( delta[ name ] )
+                probs = numpy.empty( table.counts.shape )
+                rows, _ = table.lookup( old.keys )
+                probs[ rows ] = self.probabilities[ name ]
+                rows, _ = table.lookup( delta[ name ].keys )
+                probs[ rows ] = self.smooth( table.counts[ rows ] )
+                self.parameters[ name ], self.probabilities[ name ] = table, probs
+            self.params_gauges()
+            self.model_version += 1
+        print "\n\t Updating parameters Finished~~ version", self.model_version
+
+    def count_params( self, store, matched=None ):
+        """ Match and count the sessions of a store, the result can be
+        merged with merge_params, counts of disjoint stores add up.
+        matched is the output of match_clicks_buys_batch when the
+        store was matched before
+        """
+        METRICS.count( 'sessions', len( store ) )
+        METRICS.count( 'clicks', len( store.clicks.items ) )
+        with METRICS.stage( 'match' ):
+            buys = self.match_clicks_buys_batch( store ) if matched is None else matched
+        with METRICS.stage( 'generate' ):
+            params = self.generate_params( store.clicks.items, buys,
+                                           store.clicks.offsets )
+            for name in params:
+                METRICS.count( name + '_keys', len( params[ name ] ) )
+        return params
 
     def create( self ):
-        """ Load data from dictionary, create model
+        """ Load data from the session store, create model
         on [Cn] and [Cn-1,Cn] and store it to a directory
         """
-        # Load clicks dictionary
-        print "\n\t Start loading clicks dict file"
-        with open( self.clicks_dict_file, 'rb' ) as fstream:
-            clicks_dict = cPickle.load( fstream )
-        print "\n\t Load clicks Finished~~"
+        # Open clicks and buys store
+        print "\n\t Start opening session store"
+        with METRICS.stage( 'load' ):
+            store = SessionStore( self.store_dir )
+        print "\n\t Open session store Finished~~"
 
-        # Load buys dictionary
-        print "\n\t Start loading buys dict file"
-        with open( self.buys_dict_file, 'rb' ) as fstream:
-            buys_dict = cPickle.load( fstream )
-        print "\n\t Load buys Finished~~"
-
-        # for each session get clicks sequence and corresponding buys sequence
         print "\n\t Start generating parameters"
-        progress = 0
-        for session in clicks_dict:
-            progress += 1
-            if progress % 10000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
-
-            clicks = clicks_dict[ session ]
-            buys = buys_dict.get( session, [] )
-
-            clicks, buys = self.match_clicks_buys( clicks, buys )
-
-            new_params = self.generate_params( clicks, buys )
-            self.merge_params( new_params )
-        self.unify_params()
+        with METRICS.stage( 'create' ):
+            self.merge_params( self.count_params( store ) )
+            self.unify_params()
         print "\n\t Parameters generation finished~"
 
 
     def store_params( self, dir_2_store ):
-        """ Store parameters dict to the directory for later use
+        """ Store parameters to the directory for later use, as a
+        new version of the binary model file with sorted keys, raw
+        counts and the smoothed probabilities
         """
         print "\n\t Start storing parameters"
-        with open( dir_2_store + os.sep + 'sequence_params.dict' , 'wb' ) as fstream:
-            cPickle.dump( self.parameters, fstream, -1 )
+        arrays = {}
+        for name in self.table_names():
+            arrays[ name + '_keys' ] = self.parameters[ name ].keys
+            arrays[ name + '_counts' ] = self.parameters[ name ].counts
+            arrays[ name + '_probs' ] = self.probabilities[ name ]
+        for name in self.sketches:
+            arrays[ name + '_sketch' ] = self.sketches[ name ].counts
+            arrays[ name + '_sketch_hashes' ] = self.sketches[ name ].hashes
+        with METRICS.stage( 'store' ):
+            save_model_version( dir_2_store + os.sep + 'sequence_params.bin', self.model_version,
+                                self.params_meta(),
+                                [ ( name, arrays[ name ] ) for name in self.params_names() ] )
         print "\n\t Parameters storage finished~"
 
 
 class SequencePrediction:
 
-    def __init__( self, params_file, test_file ):
-        """ Initiate class with params/test file path
+    def __init__( self, params_file, test_store_dir, decoding='greedy' ):
+        """ Initiate class with params file/test store path
         and the initial probability distribution on
-        single and neighbor estimator.
+        single and neighbor estimator. decoding is 'greedy' (
+        label by label as predict does ) or 'viterbi' ( most
+        probable label sequence ) for the batch decoder.
         """
         self.params_file = params_file
-        self.test_file = test_file
+        self.test_store_dir = test_store_dir
         self.init_proportion = { 'single': 0.3,
                                  'pair': 0.7 }
+        self.decoding = decoding
+        # greedy decoding buys a click when P( buy ) is above it
+        self.buy_threshold = 0.5
         self.results = {}
+        # optional SessionFilter dropping sessions unlikely to buy
+        self.session_filter = None
+        self.results_name = 'seq_results'
 
     def load_params( self ):
         print "\t Start Load parameters from sequence model"
-        with open( self.params_file, 'rb' ) as fstream:
-            self.parameters = cPickle.load( fstream )
+        with METRICS.stage( 'load' ):
+            self.parameters = ModelFile( self.params_file )
+        # missing keys only hold smoothing, i.e. even probabilities
+        self.default_single = numpy.array( [ 0.5, 0.5 ] )
+        self.default_pair = numpy.array( [ [ 0.5, 0.5 ],
+                                           [ 0.5, 0.5 ] ] )
+        # keys pruned from a budgeted model are estimated by a sketch
+        self.smoothing = self.parameters.meta.get( 'smoothing', 1 )
+        self.order = self.parameters.meta.get( 'order', 2 )
+        self.sketches = {}
+        for name in [ 'single', 'pair' ]:
+            if name + '_sketch' in self.parameters:
+                self.sketches[ name ] = CountMinSketch( self.parameters[ name + '_sketch' ],
+                                                        self.parameters[ name + '_sketch_hashes' ] )
         print "\t Load parameters Finished ~~"
 
+    def sketch_params( self, name, keys ):
+        """ Smoothed probabilities of the sketch estimates of keys,
+        keys never counted get the even probabilities of default
+        """
+        smoothed = self.sketches[ name ].estimate( keys ) + float( self.smoothing )
+        return smoothed / smoothed.sum( axis=-1, keepdims=True )
+
+    def get_params( self, name, key, default ):
+        """ Binary search key in the sorted keys of the name table,
+        return its smoothed probabilities, the sketch estimate of a
+        pruned key or default when the key is missing
+        """
+        keys = self.parameters[ name + '_keys' ]
+        row, found = find_keys( keys, key )
+        if found:
+            return self.parameters[ name + '_probs' ][ row ]
+        if name in self.sketches:
+            return self.sketch_params( name, numpy.array( [ key ] ) )[0]
+        return default
+
+    def context_params( self, items ):
+        """ P( b | b_prev ) of the last click of items given the
+        clicks before it: the longest context of at most order items
+        kept in the model, else the pair of the last two items.
+        At most order - 1 binary searches
+        """
+        for n in xrange( min( len( items ), self.order ), 2, -1 ):
+            key = context_keys( items[ -n: ], n )[0]
+            row, found = find_keys( self.parameters[ 'order%d_keys' % n ], key )
+            if found:
+                return self.parameters[ 'order%d_probs' % n ][ row ]
+        pair = ( items[-2] << PAIR_SHIFT ) + ( items[-1] & ITEM_MASK )
+        return self.get_params( 'pair', pair, self.default_pair )
+
+    def lookup_params( self, name, keys, default ):
+        """ get_params of an array of keys
+        """
+        rows, found = find_keys( self.parameters[ name + '_keys' ], keys )
+        params = numpy.empty( ( len( keys ), ) + default.shape )
+        params[ found ] = self.parameters[ name + '_probs' ][ rows[ found ] ]
+        if name in self.sketches:
+            params[ ~found ] = self.sketch_params( name, keys[ ~found ] )
+        else:
+            params[ ~found ] = default
+        return params
+
     def predict( self, clicks ):
         """ Given a series of clicks in one session
         generate the most probable buys sequence
@@ -195,162 +515,345 @@ class SequencePrediction:
         buys = []
         for i in range( len_clicks ):
             item = clicks[ i ]
-            item_params = self.parameters.get( item,
-                                               numpy.array([ 1, 1])
-                                              )
+            item_params = self.get_params( 'single', item,
+                                           self.default_single )
             if i == 0 :
-                if item_params[0] >= item_params[1]:
-                    buys.append( 0 )
-                else:
-                    buys.append( 1 )
+                buys.append( self.click_label( item_params ) )
                 continue
 
-            last_item = clicks[ i-1 ]
-            last_buy = buys[-1]
-            pair = last_item + '_' + item
-            pair_params = self.parameters.get( pair,
-                                                numpy.array(
-                                                    [[ 1, 1 ],
-                                                     [ 1, 1 ]]
-                                                            )
-                                             )
-            prob_buy = self.init_proportion[ 'single' ] \
-                        * item_params[1] / sum( item_params ) \
-                      + self.init_proportion[ 'pair' ] \
-                         * pair_params[ last_buy ][1] / sum( pair_params[ last_buy ])
-
-            prob_not_buy = self.init_proportion[ 'single' ] \
-                            * item_params[0] / sum( item_params ) \
-                          + self.init_proportion[ 'pair' ] \
-                             * pair_params[ last_buy ][0] / sum( pair_params[ last_buy ])
-
-            if prob_not_buy >= prob_buy:
-                buys.append( 0 )
-            else:
-                buys.append( 1 )
+            pair_params = self.context_params( clicks[ max( i + 1 - self.order, 0 ):i + 1 ] )
+            buys.append( self.click_label( item_params, pair_params, buys[-1] ) )
 
         return buys
 
+    def predict_session( self, clicks ):
+        """ Predict one session given as a SessionView, return the
+        items of the bought clicks like predict_sessions
+        """
+        items = clicks.items.tolist()
+        return [ item for item, buy in zip( items, self.predict( items ) ) if buy ]
+
+    def click_label( self, item_params, pair_params=None, last_buy=None ):
+        """ Label a click given P( b ) of its item and, except on the
+        first click, P( b | b_prev ) of the pair with the previous
+        item and the previous label. The click is bought when
+        P( buy ) is above buy_threshold
+        """
+        limit = 2.0 * self.buy_threshold - 1.0
+        if pair_params is None:
+            if item_params[1] - item_params[0] > limit:
+                return 1
+            return 0
+
+        prob_buy = self.init_proportion[ 'single' ] * item_params[1] \
+                  + self.init_proportion[ 'pair' ] * pair_params[ last_buy ][1]
+
+        prob_not_buy = self.init_proportion[ 'single' ] * item_params[0] \
+                      + self.init_proportion[ 'pair' ] * pair_params[ last_buy ][0]
+
+        if prob_buy - prob_not_buy > limit:
+            return 1
+        return 0
+
+    def click_params( self, table, start, end ):
+        """ Look up the probabilities of all clicks of sessions
+        start:end at once, return
+            single: [ n, 2 ]    P( b ) of the clicked item
+            pair:   [ n, 2, 2 ] P( b | b_prev ) of ( previous, item ),
+                                or of the longest context found as in
+                                context_params, meaningless on the
+                                first click
+        """
+        offsets = table.offsets[ start:end + 1 ]
+        first, last = offsets[0], offsets[-1]
+        items = numpy.asarray( table.items[ first:last ] )
+
+        single = self.lookup_params( 'single', items, self.default_single )
+        pair = numpy.empty( ( len( items ), 2, 2 ) )
+        pair[ :1 ] = self.default_pair
+        pair[ 1: ] = self.lookup_params( 'pair', pair_keys( items[ :-1 ], items[ 1: ] ),
+                                         self.default_pair )
+        if self.order > 2:
+            position = numpy.arange( len( items ) ) \
+                       - numpy.repeat( offsets[ :-1 ] - first, numpy.diff( offsets ) )
+            # longer contexts found overwrite shorter ones
+            for n in xrange( 3, self.order + 1 ):
+                rows, found = find_keys( self.parameters[ 'order%d_keys' % n ], context_keys( items, n ) )
+                hits = numpy.flatnonzero( found & ( position[ n - 1: ] >= n - 1 ) )
+                pair[ hits + n - 1 ] = self.parameters[ 'order%d_probs' % n ][ rows[ hits ] ]
+        return single, pair
+
+    def length_order( self, offsets ):
+        """ Sort the sessions of offsets by decreasing length, return
+        their starts relative to offsets[0], their lengths and the
+        number of sessions longer than t for every position t
+        """
+        lengths = numpy.diff( offsets )
+        order = numpy.argsort( -lengths, kind='mergesort' )
+        starts = ( offsets[ :-1 ] - offsets[0] )[ order ]
+        lengths = lengths[ order ]
+        n_active = numpy.searchsorted( -lengths, -numpy.arange( lengths[0] ), side='left' )
+        return starts, lengths, n_active
+
+    def decode_batch( self, table, start, end, decoding=None, margins=None ):
+        """ Decode sessions start:end of a clicks SessionTable at once.
+        Sessions are sorted by length, step t decodes position t of
+        every session longer than t, so each step is a few array
+        operations over all those sessions.
+            greedy:  the same labels as predict, under buy_threshold
+            viterbi: the label sequence maximizing the product of
+                     P( b1 ) * prod_t ( single * P( bt ) + pair *
+                     P( bt | bt-1 ) ), ties go to not buy
+        Return int8 labels aligned with the clicks of the sessions,
+        greedy decoding also writes P( buy ) - P( not buy ) of every
+        click to margins when it is given
+        """
+        decoding = decoding or self.decoding
+        single, pair = self.click_params( table, start, end )
+        labels = numpy.zeros( len( single ), dtype=numpy.int8 )
+        if len( single ) == 0:
+            return labels
+
+        starts, lengths, n_active = self.length_order( table.offsets[ start:end + 1 ] )
+        w_single = self.init_proportion[ 'single' ]
+        w_pair = self.init_proportion[ 'pair' ]
+
+        if decoding == 'greedy':
+            limit = 2.0 * self.buy_threshold - 1.0
+            labels[ starts ] = single[ starts, 1 ] - single[ starts, 0 ] > limit
+            if margins is not None:
+                margins[ starts ] = single[ starts, 1 ] - single[ starts, 0 ]
+            for t in xrange( 1, lengths[0] ):
+                position = starts[ :n_active[ t ] ] + t
+                last_buy = labels[ position - 1 ]
+                pair_params = pair[ position, last_buy ]
+                prob_buy = w_single * single[ position, 1 ] + w_pair * pair_params[ :, 1 ]
+                prob_not_buy = w_single * single[ position, 0 ] + w_pair * pair_params[ :, 0 ]
+                labels[ position ] = prob_buy - prob_not_buy > limit
+                if margins is not None:
+                    margins[ position ] = prob_buy - prob_not_buy
+            return labels
+
+        assert decoding == 'viterbi', 'Unknown decoding ' + str( decoding )
+        delta = numpy.log( single[ starts ] )
+        back = numpy.zeros( ( len( single ), 2 ), dtype=numpy.int8 )
+        for t in xrange( 1, lengths[0] ):
+            active = n_active[ t ]
+            position = starts[ :active ] + t
+            # scores[ session, b_prev, b ]
+            scores = delta[ :active, :, None ] + numpy.log(
+                        w_single * single[ position ][ :, None, : ]
+                        + w_pair * pair[ position ] )
+            back[ position ] = numpy.argmax( scores, axis=1 )
+            delta[ :active ] = numpy.max( scores, axis=1 )
+
+        labels[ starts + lengths - 1 ] = numpy.argmax( delta, axis=1 )
+        for t in xrange( lengths[0] - 1, 0, -1 ):
+            position = starts[ :n_active[ t ] ] + t
+            labels[ position - 1 ] = back[ position, labels[ position ] ]
+        return labels
+
+    def predict_sessions( self, table, start, end, block_size=10000 ):
+        """ Predict sessions start:end of a clicks SessionTable block
+        by block, yield ( session id, bought items ) of sessions
+        with buys
+        """
+        for block_start in xrange( start, end, block_size ):
+            block_end = min( block_start + block_size, end )
+            labels = self.decode_batch( table, block_start, block_end )
+            METRICS.progress( block_end - start, end - start )
+            first = table.offsets[ block_start ]
+            items = table.items[ first:table.offsets[ block_end ] ]
+            bought = numpy.flatnonzero( labels )
+            sessions = numpy.searchsorted( table.offsets[ block_start:block_end + 1 ] - first,
+                                           bought, side='right' ) - 1 + block_start
+            for index in numpy.unique( sessions ).tolist():
+                yield table.sessions[ index ], \
+                      items[ bought[ sessions == index ] ].tolist()
+
+    def check_batch_decoding( self, test_store ):
+        """ Compare greedy decode_batch against predict on every session
+        of the test store and count sessions where viterbi differs
+        from greedy, return the number of greedy mismatches
+        """
+        table = test_store.clicks
+        greedy = self.decode_batch( table, 0, len( table ), 'greedy' )
+        viterbi = self.decode_batch( table, 0, len( table ), 'viterbi' )
+        mismatches, changed = 0, 0
+        for index, ( _, clicks, _ ) in enumerate( test_store ):
+            start, end = table.offsets[ index ], table.offsets[ index + 1 ]
+            if self.predict( clicks.items.tolist() ) != greedy[ start:end ].tolist():
+                mismatches += 1
+            if ( greedy[ start:end ] != viterbi[ start:end ] ).any():
+                changed += 1
+        print "\n\t Sessions with different greedy labels:", mismatches
+        print "\t Sessions where viterbi differs from greedy:", changed
+        return mismatches
+
+    def click_margins( self, table, start, end, block_size=100000 ):
+        """ Look up once P( buy ) - P( not buy ) of all clicks of
+        sessions start:end, return
+            single: [ n ]    margin of the single estimator
+            pair:   [ n, 2 ] margin of the pair estimator given the
+                             previous label
+        Greedy decoding under any init_proportion and threshold
+        only needs these margins
+        """
+        singles, pairs = [], []
+        for block_start in xrange( start, end, block_size ):
+            block_end = min( block_start + block_size, end )
+            single, pair = self.click_params( table, block_start, block_end )
+            singles.append( single[ :, 1 ] - single[ :, 0 ] )
+            pairs.append( pair[ :, :, 1 ] - pair[ :, :, 0 ] )
+        return numpy.concatenate( singles ), numpy.concatenate( pairs )
+
+    def decode_margins( self, single, pair, offsets, w_pair, thresholds ):
+        """ Greedy decode sessions of offsets from their click margins
+        under several settings at once, setting k buys a click when
+            ( 1 - w_pair[k] ) * single + w_pair[k] * pair[ b_prev ]
+        is above 2 * thresholds[k] - 1, i.e. P( buy ) > thresholds[k]
+        ( the first click uses single alone ). This is decode_batch's
+        greedy decoding with buy_threshold thresholds[k].
+        Return bool labels [ n, settings ] aligned with the clicks
+        """
+        labels = numpy.zeros( ( len( single ), len( w_pair ) ), dtype=bool )
+        if len( single ) == 0:
+            return labels
+
+        starts, lengths, n_active = self.length_order( offsets - offsets[0] )
+        w_single = 1.0 - w_pair
+        limits = 2.0 * thresholds - 1.0
+        labels[ starts ] = single[ starts, None ] > limits
+        for t in xrange( 1, lengths[0] ):
+            position = starts[ :n_active[ t ] ] + t
+            pair_margin = numpy.where( labels[ position - 1 ],
+                                       pair[ position, 1, None ],
+                                       pair[ position, 0, None ] )
+            labels[ position ] = w_single * single[ position, None ] \
+                                 + w_pair * pair_margin > limits
+        return labels
+
+    def sweep( self, store, pair_weights, thresholds, block_size=100000 ):
+        """ Tune the pair proportion and the buy threshold on a
+        held-out store with buys. Click margins are looked up once,
+        then every ( pair weight, threshold ) of the grid is decoded
+        from them and scored with the challenge score.
+        Return [ ( score, pair weight, threshold ) ] best first, the
+        best pair weight is kept in init_proportion and its threshold
+        in buy_threshold, so greedy decoding reproduces the best score
+        """
+        table = store.clicks
+        grid = [ ( weight, threshold ) for weight in pair_weights
+                                       for threshold in thresholds ]
+        w_pair = numpy.array( [ weight for weight, _ in grid ], dtype=float )
+        limits = numpy.array( [ threshold for _, threshold in grid ], dtype=float )
+
+        print "\n\t Start looking up click margins"
+        with METRICS.stage( 'margins' ):
+            single, pair = self.click_margins( table, 0, len( table ), block_size )
+        print "\t Look up Finished ~~"
+
+        print "\n\t Start decoding", len( grid ), "settings"
+        with METRICS.stage( 'predict' ):
+            results = [ [] for _ in grid ]
+            sessions = numpy.asarray( table.sessions )
+            for block_start in xrange( 0, len( table ), block_size ):
+                block_end = min( block_start + block_size, len( table ) )
+
+                offsets = table.offsets[ block_start:block_end + 1 ]
+                first, last = offsets[0], offsets[-1]
+                labels = self.decode_margins( single[ first:last ], pair[ first:last ],
+                                              offsets, w_pair, limits )
+                # bought clicks grouped by setting
+                settings, bought = numpy.nonzero( labels.T )
+                index = numpy.searchsorted( offsets - first, bought, side='right' ) - 1
+                keys = pair_keys( sessions[ block_start + index ],
+                                  numpy.asarray( table.items[ first:last ] )[ bought ] )
+                bounds = numpy.searchsorted( settings, numpy.arange( len( grid ) + 1 ) )
+                for k in xrange( len( grid ) ):
+                    results[ k ].append( keys[ bounds[ k ]:bounds[ k + 1 ] ] )
+                METRICS.progress( block_end, len( table ) )
+        print "\n\t Decoding Finished~~"
+
+        evaluation = ResultsEvaluation( None, store, total_sessions=len( store ) )
+        scores = []
+        for k, ( weight, threshold ) in enumerate( grid ):
+            keys = numpy.concatenate( results[ k ] )
+            evaluation.set_results( keys >> PAIR_SHIFT, keys & ITEM_MASK )
+            scores.append( ( evaluation.get_score(), weight, threshold ) )
+        scores.sort( reverse=True )
+
+        print "\n\t score\t\t pair weight\t threshold"
+        for score, weight, threshold in scores:
+            print "\t", score, "\t", weight, "\t\t", threshold
+        self.init_proportion = { 'single': 1.0 - scores[0][1],
+                                 'pair': scores[0][1] }
+        self.buy_threshold = scores[0][2]
+        return scores
+
     def do_task( self, dir_2_store ):
-        print "\t Start Load test sessions dict from sequence model"
-        with open( self.test_file, 'rb' ) as fstream:
-            test_dict = cPickle.load( fstream )
-        print "\t Load test sessions dict Finished ~~"
-        print "\t Number of sessions in test dict:", len( test_dict.keys() )
-
-        progress = 0
-        for session in test_dict:
-            progress += 1
-            if progress % 10000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
-
-            clicks = test_dict[ session ]
-            clicks_seq = [ click[ 'item' ] for click in clicks ]
-            buys_seq = self.predict( clicks_seq )
-            if 1 in buys_seq:
-                self.results[ session ] = []
-                for i in range( len( buys_seq ) ):
-                    if buys_seq[ i ] == 1:
-                        self.results[ session ].append( clicks_seq[ i ] )
-
-        #Store prediction results to a csv
-        print "\t Start storing results to ", dir_2_store
-        with open( dir_2_store + os.sep + 'seq_results' , 'w' ) as fstream:
-            for session in self.results:
-                fstream.write( session + ";" + \
-                               ",".join( self.results[ session ] ) \
-                               + '\n' )
-        print "\t Storage of results Finished ~~"
-
-
-class ResultsEvaluation:
-
-    def __init__( self, test_file, results_file, answers_file ):
-        self.score = 0.0
-        self.test_file = test_file
-        self.results_dict = {}
-        self.answers_dict = {}
-        print "\n\t Start Load results"
-        with open( results_file, 'r' ) as fstream:
-            for line in fstream:
-                [ session, items ] = line.split( ';' )
-                items = items.split( ',' )
-                self.results_dict[ session ] = items
-        print "\t Load results Finished ~~"
-        print "\t Start Load answers"
-        with open( answers_file, 'rb' ) as fstream:
-            answers_orig = cPickle.load( fstream )
-            for session in answers_orig:
-                self.answers_dict[ session ] = []
-                for record in answers_orig[ session ]:
-                    self.answers_dict[ session ].append( record[ 'item' ] )
-        print "\t Load answers Finished ~~"
-
-
-    def cal_score( self ):
-        """ calculate score of the current results
-        """
-        S = 9249729
-        Sb = len( self.answers_dict.keys() ) + 0.0
-        increment_unit = Sb / S
-        progress = 0
-        for session in self.results_dict:
-            progress += 1
-            if progress % 10000 == 0:
-                sys.stdout.write( "\r\t\t progress:" + str( progress ) )
-                sys.stdout.flush()
-
-
-            if session in self.answers_dict:
-                self.score += increment_unit
-                results = set( self.results_dict[ session ] )
-                answers = set( self.answers_dict[ session ] )
-                self.score += \
-                        (len( results.intersection( answers ) ) + 0.0) \
-                        / len( results.union( answers ) )
-            else:
-                self.score -= increment_unit
-
-        print "\n\t The score range: [", Sb*Sb/S - Sb, ",", Sb*Sb/S + Sb, "]"
-        print "\n\t The final score is : ", self.score
-
-
-    def cal_precision( self ):
-        """ calculate precision of the current results
-        """
-        S = 9249729.0
-        Sb = len( self.answers_dict.keys() ) + 0.0
-        results_set = set( self.results_dict.keys() )
-        answers_set = set( self.answers_dict.keys() )
-
-        union_amount = len( results_set.union( answers_set ) )
-        inter_amount = len( results_set.intersection( answers_set ) )
-        precision = ( inter_amount + S - union_amount ) / S
-
-        print "\n\t The score range: [", 0, ",", 1, "]"
-        print "\n\t The final precision is : ", precision
+        predict_store( self, dir_2_store )
+
 
 def main():
-    clicks_file = "../median_datasets/training_sessions.dict"
-    buys_file = "../median_datasets/buys_sessions.dict"
+    store_dir = "../median_datasets/training_store"
     dir_2_store = "../median_datasets"
     dir_2_store = "../results_datasets"
     """
     # generate parameters and store them
-    sequence_model = SequenceModelCreation( clicks_file, buys_file )
+    sequence_model = SequenceModelCreation( store_dir )
+    sequence_model.create()
+    sequence_model.store_params( dir_2_store )
+    """
+    """
+    # generate parameters within a 64M budget, counts of the pruned
+    # pairs are kept in a 16M sketch
+    sequence_model = SequenceModelCreation( store_dir )
+    sequence_model.set_budget( 64 << 20, sketch_bytes=16 << 20 )
+    sequence_model.create()
+    sequence_model.store_params( dir_2_store )
+    """
+    """
+    # generate parameters with contexts of up to 3 items
+    sequence_model = SequenceModelCreation( store_dir, order=3 )
     sequence_model.create()
     sequence_model.store_params( dir_2_store )
     """
     """
+    # fold the sessions of a new day into the stored model
+    sequence_model = SequenceModelCreation( store_dir )
+    sequence_model.load_counts( "../median_datasets/sequence_params.bin" )
+    sequence_model.update( SessionStore( "../median_datasets/new_day_store" ) )
+    sequence_model.store_params( "../median_datasets" )
+    """
+    """
     # use model to predict results
-    prediction = SequencePrediction( "../median_datasets/sequence_params.dict", clicks_file )
+    prediction = SequencePrediction( "../median_datasets/sequence_params.bin", store_dir )
     prediction.load_params()
     prediction.do_task( dir_2_store )
     """
+    """
+    # check batch matching against per-session matching
+    sequence_model = SequenceModelCreation( store_dir )
+    sequence_model.check_match_equivalence( SessionStore( store_dir ) )
+    """
+    """
+    # compare batch decoding with per-session decoding
+    prediction = SequencePrediction( "../median_datasets/sequence_params.bin", store_dir )
+    prediction.load_params()
+    prediction.check_batch_decoding( SessionStore( store_dir ) )
+    """
+    """
+    # tune init_proportion and the buy threshold on held-out sessions
+    prediction = SequencePrediction( "../median_datasets/sequence_params.bin", store_dir )
+    prediction.load_params()
+    prediction.sweep( SessionStore( "../median_datasets/heldout_store" ),
+                      numpy.linspace( 0.0, 1.0, 11 ),
+                      numpy.linspace( 0.1, 0.9, 9 ) )
+    """
     # calculate score
     result_file = "../results_datasets/seq_results"
-    evaluation = ResultsEvaluation( clicks_file, result_file, buys_file)
+    evaluation = ResultsEvaluation( result_file, store_dir )
     #evaluation.cal_score()
     evaluation.cal_precision()
 
@@ -0,0 +1,244 @@
+#coding=utf8
+#
+# Filename:    session_filter.py
+#
+# Cheap first stage in front of the item level models: a logistic
+# regression gives every session a buy probability from features
+# computed for all sessions at once, sessions below a threshold are
+# dropped before the sequence or naive bayes predictor runs ( set
+# the session_filter of a predictor ). Features of a session:
+#     log of its clicks and of its duration in seconds
+#     distinct items over clicks
+#     mean log click count of its items in the training store
+#     max and mean smoothed buy rate of its items
+#
+# usage: python session_filter.py --model sequence --thresholds 0.02,0.05,0.1
+#
+# @classes
+# --------
+#     SessionFilter: fit, store and apply the session buy filter
+
+import argparse
+import json
+import numpy
+import os
+import time
+
+from count_table import CountTable, PAIR_SHIFT, pair_keys
+from instrumentation import METRICS
+from model_format import ModelFile, save_model
+from session_store import SessionStore, session_shards
+
+FEATURES = [ 'bias', 'log_clicks', 'log_duration', 'distinct_ratio',
+             'log_item_clicks', 'max_buy_rate', 'mean_buy_rate' ]
+# prior of the smoothed buy rates, ( buys + 1 ) / ( clicks + 50 )
+RATE_PRIOR = ( 1.0, 50.0 )
+
+
+class SessionFilter:
+
+    def __init__( self, threshold=0.05, ridge=1e-3 ):
+        """ Sessions with a buy probability below threshold are
+        dropped, ridge is the L2 penalty of the fit
+        """
+        self.threshold = threshold
+        self.ridge = ridge
+        self.items = None
+        self.weights = None
+
+    def item_stats( self, store ):
+        """ Clicks and buys of every item of a store with buys
+        """
+        clicks = numpy.asarray( store.clicks.items ).astype( numpy.int64 )
+        buys = numpy.asarray( store.buys.items ).astype( numpy.int64 )
+        keys = numpy.concatenate( ( clicks, buys ) )
+        cells = numpy.r_[ numpy.zeros( len( clicks ), numpy.int64 ),
+                          numpy.ones( len( buys ), numpy.int64 ) ]
+        return CountTable.accumulate( keys, cells, ( 2, ) )
+
+    def features( self, table ):
+        """ Feature matrix [ n_sessions, len( FEATURES ) ] of a clicks
+        SessionTable, every session has at least one click
+        """
+        offsets = numpy.asarray( table.offsets )
+        starts = offsets[ :-1 ] - offsets[0]
+        lengths = numpy.diff( offsets ).astype( numpy.float64 )
+        items = numpy.asarray( table.items[ offsets[0]:offsets[-1] ] )
+        times = numpy.asarray( table.times[ offsets[0]:offsets[-1] ] )
+        if len( items ) == 0:
+            return numpy.zeros( ( 0, len( FEATURES ) ) )
+
+        rows, found = self.items.lookup( items )
+        counts = numpy.where( found[ :, None ], self.items.counts[ rows ], 0 ).astype( numpy.float64 )
+        buy_rate = ( counts[ :, 1 ] + RATE_PRIOR[0] ) / ( counts[ :, 0 ] + RATE_PRIOR[1] )
+
+        session = numpy.repeat( numpy.arange( len( lengths ) ), lengths.astype( numpy.int64 ) )
+        distinct = numpy.bincount( numpy.unique( pair_keys( session, items ) ) >> PAIR_SHIFT,
+                                   minlength=len( lengths ) )
+        duration = ( numpy.maximum.reduceat( times, starts )
+                     - numpy.minimum.reduceat( times, starts ) ) / 1000.0
+
+        features = numpy.empty( ( len( lengths ), len( FEATURES ) ) )
+        features[ :, 0 ] = 1.0
+        features[ :, 1 ] = numpy.log( lengths )
+        features[ :, 2 ] = numpy.log1p( duration )
+        features[ :, 3 ] = distinct / lengths
+        features[ :, 4 ] = numpy.add.reduceat( numpy.log1p( counts[ :, 0 ] ), starts ) / lengths
+        features[ :, 5 ] = numpy.maximum.reduceat( buy_rate, starts )
+        features[ :, 6 ] = numpy.add.reduceat( buy_rate, starts ) / lengths
+        return features
+
+    def standardize( self, features ):
+        scaled = ( features - self.mean ) / self.scale
+        scaled[ :, 0 ] = 1.0
+        return scaled
+
+    def fit( self, store, iterations=25 ):
+        """ Fit the weights on a store with buys by Newton steps, a
+        session is positive when it has buys. The item features of a
+        session come from the other half of the store ( hashed
+        halves ), its own buys would leak into its buy rates, with
+        counts scaled to the whole store. The stored item stats are
+        those of the whole store
+        """
+        print "\n\t Start fitting session filter"
+        with METRICS.stage( 'filter_fit' ):
+            halves = session_shards( store.clicks.sessions, 2 )
+            features = numpy.empty( ( len( store ), len( FEATURES ) ) )
+            for half in ( 0, 1 ):
+                other = store.shard( 1 - half, 2 )
+                items = self.item_stats( other )
+                ratio = len( store.clicks.items ) / float( max( len( other.clicks.items ), 1 ) )
+                self.items = CountTable( items.keys, items.counts * ratio )
+                rows = numpy.flatnonzero( halves == half )
+                features[ rows ] = self.features( store.clicks.take( rows ) )
+            self.items = self.item_stats( store )
+            labels = numpy.in1d( store.clicks.sessions, store.buys.sessions ).astype( numpy.float64 )
+            self.mean = features.mean( axis=0 )
+            self.scale = numpy.maximum( features.std( axis=0 ), 1e-9 )
+            features = self.standardize( features )
+
+            penalty = self.ridge * len( labels ) * numpy.eye( len( FEATURES ) )
+            penalty[ 0, 0 ] = 0.0
+            self.weights = numpy.zeros( len( FEATURES ) )
+            for _ in xrange( iterations ):
+                probs = 1.0 / ( 1.0 + numpy.exp( -features.dot( self.weights ) ) )
+                gradient = features.T.dot( probs - labels ) + penalty.dot( self.weights )
+                hessian = ( features * ( probs * ( 1.0 - probs ) )[ :, None ] ).T.dot( features ) \
+                          + penalty
+                step = numpy.linalg.solve( hessian, gradient )
+                self.weights -= step
+                if numpy.abs( step ).max() < 1e-8:
+                    break
+        print "\t Fitting session filter Finished~~"
+        return self
+
+    def buy_probability( self, table ):
+        """ Buy probability of every session of a clicks SessionTable
+        """
+        features = self.standardize( self.features( table ) )
+        return 1.0 / ( 1.0 + numpy.exp( -features.dot( self.weights ) ) )
+
+    def keep( self, table ):
+        """ Sorted indexes of the sessions at or above the threshold
+        """
+        with METRICS.stage( 'filter' ):
+            kept = numpy.flatnonzero( self.buy_probability( table ) >= self.threshold )
+            METRICS.count( 'filtered_sessions', len( table ) - len( kept ) )
+        return kept
+
+    def filter_table( self, table ):
+        """ In-memory clicks table of the kept sessions
+        """
+        return table.take( self.keep( table ) )
+
+    def report( self, store, thresholds ):
+        """ For every threshold, the share of sessions and clicks kept
+        and of buying sessions kept ( recall ) on a store with buys
+        """
+        probs = self.buy_probability( store.clicks )
+        bought = numpy.in1d( store.clicks.sessions, store.buys.sessions )
+        lengths = store.clicks.lengths()
+        rows = []
+        for threshold in thresholds:
+            kept = probs >= threshold
+            rows.append( { 'threshold': threshold,
+                           'sessions_kept': kept.mean(),
+                           'clicks_kept': lengths[ kept ].sum() / float( max( lengths.sum(), 1 ) ),
+                           'buyer_recall': kept[ bought ].mean() if bought.any() else 0.0 } )
+        return rows
+
+    def save( self, path ):
+        save_model( path, { 'model': 'session_filter', 'threshold': self.threshold,
+                            'features': FEATURES },
+                    [ ( 'item_keys', self.items.keys ), ( 'item_counts', self.items.counts ),
+                      ( 'mean', self.mean ), ( 'scale', self.scale ),
+                      ( 'weights', self.weights ) ] )
+
+    @staticmethod
+    def load( path, threshold=None ):
+        """ Load a stored filter, threshold overrides the stored one
+        """
+        model = ModelFile( path )
+        assert model.meta[ 'features' ] == FEATURES, path + ' has other features'
+        session_filter = SessionFilter( model.meta[ 'threshold' ] if threshold is None else threshold )
+        session_filter.items = CountTable( model[ 'item_keys' ], model[ 'item_counts' ] )
+        session_filter.mean = model[ 'mean' ]
+        session_filter.scale = model[ 'scale' ]
+        session_filter.weights = model[ 'weights' ]
+        return session_filter
+
+
+def main():
+    from models import PARAMS_FILES, PREDICTION
+    from results_evaluation import ResultsEvaluation
+
+    parser = argparse.ArgumentParser( description='Session buy filter, throughput against score' )
+    parser.add_argument( '--model', choices=sorted( PREDICTION ), default='sequence' )
+    parser.add_argument( '--params', default=None )
+    parser.add_argument( '--store', default="../median_datasets/training_store" )
+    parser.add_argument( '--heldout-store', default="../median_datasets/heldout_store" )
+    parser.add_argument( '--thresholds', default='0.01,0.02,0.05,0.1,0.2' )
+    parser.add_argument( '--work-dir', default="../median_datasets/session_filter" )
+    parser.add_argument( '--output', default=None )
+    args = parser.parse_args()
+
+    if not os.path.exists( args.work_dir ):
+        os.makedirs( args.work_dir )
+    session_filter = SessionFilter().fit( SessionStore( args.store ) )
+    session_filter.save( args.work_dir + os.sep + 'session_filter.bin' )
+    store = SessionStore( args.heldout_store )
+    thresholds = [ float( threshold ) for threshold in args.thresholds.split( ',' ) ]
+    report = [ { 'threshold': None, 'sessions_kept': 1.0, 'clicks_kept': 1.0, 'buyer_recall': 1.0 } ] \
+             + session_filter.report( store, thresholds )
+
+    prediction_class = PREDICTION[ args.model ]
+    params_file = args.params or "../median_datasets/" + PARAMS_FILES[ args.model ]
+    for row in report:
+        prediction = prediction_class( params_file, args.heldout_store )
+        prediction.load_params()
+        if row[ 'threshold' ] is not None:
+            session_filter.threshold = row[ 'threshold' ]
+            prediction.session_filter = session_filter
+        start = time.time()
+        prediction.do_task( args.work_dir )
+        row[ 'seconds' ] = time.time() - start
+        evaluation = ResultsEvaluation( args.work_dir + os.sep + prediction.results_name, store,
+                                        total_sessions=len( store ) )
+        row[ 'score' ] = evaluation.get_score()
+
+    print "\n\t %-10s %9s %9s %9s %9s %8s %12s" % ( 'threshold', 'sessions', 'clicks', 'recall',
+                                                   'seconds', 'speedup', 'score' )
+    for row in report:
+        print "\t %-10s %9.3f %9.3f %9.3f %9.2f %8.2f %12.2f" % (
+                row[ 'threshold' ] if row[ 'threshold' ] is not None else 'none',
+                row[ 'sessions_kept' ], row[ 'clicks_kept' ], row[ 'buyer_recall' ],
+                row[ 'seconds' ], report[0][ 'seconds' ] / max( row[ 'seconds' ], 1e-9 ),
+                row[ 'score' ] )
+    if args.output:
+        with open( args.output, 'w' ) as fstream:
+            json.dump( report, fstream, indent=2, sort_keys=True )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+#coding=utf8
+#
+# Filename:    session_store.py
+#
+# Stream the raw yoochoose csv files once and keep the sessions
+# in a session-grouped columnar store on disk
+#
+# @classes
+# --------
+#     SessionIngestion: read clicks/buys csv files in chunks and
+#                       write them as session-grouped columns
+#     SessionTable:     one table ( clicks or buys ) of the store,
+#                       flat typed columns with CSR-style offsets
+#     SessionView:      zero-copy view of the rows of one session,
+#                       indexable like the old lists of records
+#     ClickRecord:      one row of a view, record[ 'item' ] and
+#                       record[ 'time' ] like the old dict records
+#     SessionStore:     clicks and buys tables of one data set,
+#                       read from a store directory, built from
+#                       tables in memory or from the old dicts
+#     TimeIndex:        time order, dwell time and time to buy of
+#                       every click, precomputed at ingestion
+#
+# Layout of a store directory ( all numpy .npy files ):
+#     <table>_sessions.npy  int64 [ n_sessions ]      sorted session ids
+#     <table>_offsets.npy   int64 [ n_sessions + 1 ]  session i owns rows
+#                                                     offsets[i]:offsets[i+1]
+#     <table>_items.npy     int32 [ n_rows ]          item ids
+#     <table>_times.npy     int64 [ n_rows ]          epoch milliseconds
+# where <table> is 'clicks' or 'buys'. Rows keep the file order
+# inside every session. The time index of the clicks, aligned with
+# the clicks rows:
+#     clicks_order.npy        int32 [ n_clicks ]  rank of the click in
+#                                                 time order in its session
+#     clicks_dwell.npy        int64 [ n_clicks ]  ms to the next click of
+#                                                 the session, -1 on the last
+#     clicks_time_to_buy.npy  int64 [ n_clicks ]  ms to the first later buy
+#                                                 of the item, -1 without
+# Times are parsed once at ingestion, every time comparison after it
+# is on int64 arrays.
+
+import numpy
+import os
+import sys
+
+from count_table import ITEM_MASK, PAIR_SHIFT, find_keys, pair_keys
+
+TABLES = [ 'clicks', 'buys' ]
+
+
+def session_shards( sessions, n_shards ):
+    """ Hash session ids to shards 0..n_shards-1, a multiplicative
+    hash keeps neighbouring ids apart
+    """
+    hashed = ( numpy.asarray( sessions ).astype( numpy.uint64 )
+               * numpy.uint64( 2654435761 ) ) % numpy.uint64( 1 << 32 )
+    return ( hashed % numpy.uint64( n_shards ) ).astype( numpy.int64 )
+
+
+class SessionIngestion:
+
+    def __init__( self, clicks_file, buys_file=None, chunk_size=1000000 ):
+        """ Initiate raw csv files, buys file is optional ( test data
+        only has clicks ). chunk_size is the number of lines converted
+        to arrays at a time.
+        """
+        self.clicks_file = clicks_file
+        self.buys_file = buys_file
+        self.chunk_size = chunk_size
+
+    def convert_chunk( self, sessions, times, items ):
+        """ Convert one chunk of csv fields into typed arrays,
+        timestamps like '2014-04-07T10:51:09.277Z' become
+        epoch milliseconds.
+        """
+        sessions = numpy.array( sessions, dtype=numpy.int64 )
+        items = numpy.array( items, dtype=numpy.int32 )
+        times = numpy.array( [ t.rstrip( 'Z' ) for t in times ],
+                             dtype='datetime64[ms]' ).astype( numpy.int64 )
+        return sessions, items, times
+
+    def read_table( self, csv_file ):
+        """ Stream one csv file ( session,timestamp,item,... ) and
+        return flat arrays of sessions, items and times in file order
+        """
+        print "\n\t Start reading", csv_file
+        chunks = []
+        sessions, times, items = [], [], []
+        progress = 0
+        with open( csv_file, 'r' ) as fstream:
+            for line in fstream:
+                fields = line.split( ',', 3 )
+                if len( fields ) < 3:
+                    continue
+                sessions.append( fields[0] )
+                times.append( fields[1] )
+                items.append( fields[2].rstrip() )
+                if len( sessions ) == self.chunk_size:
+                    chunks.append( self.convert_chunk( sessions, times, items ) )
+                    sessions, times, items = [], [], []
+                    progress += self.chunk_size
+                    sys.stdout.write( "\r\t\t progress:" + str( progress ) )
+                    sys.stdout.flush()
+        if sessions:
+            chunks.append( self.convert_chunk( sessions, times, items ) )
+        print "\n\t Read", csv_file, "Finished~~"
+
+        if not chunks:
+            return numpy.zeros( 0, numpy.int64 ), \
+                   numpy.zeros( 0, numpy.int32 ), \
+                   numpy.zeros( 0, numpy.int64 )
+        return numpy.concatenate( [ c[0] for c in chunks ] ), \
+               numpy.concatenate( [ c[1] for c in chunks ] ), \
+               numpy.concatenate( [ c[2] for c in chunks ] )
+
+    def group_sessions( self, sessions, items, times ):
+        """ Group rows by session with a stable sort, so the
+        rows of every session keep their original order.
+        Return sorted session ids, offsets, items and times
+        """
+        order = numpy.argsort( sessions, kind='mergesort' )
+        sessions = sessions[ order ]
+        items = items[ order ]
+        times = times[ order ]
+
+        starts = numpy.flatnonzero( numpy.r_[ True, sessions[1:] != sessions[:-1] ] ) \
+                 if len( sessions ) else numpy.zeros( 0, numpy.int64 )
+        offsets = numpy.append( starts, len( sessions ) ).astype( numpy.int64 )
+        return sessions[ starts ], offsets, items, times
+
+    def ingest( self, dir_2_store ):
+        """ Read the csv files once and write the columnar store
+        """
+        if not os.path.exists( dir_2_store ):
+            os.makedirs( dir_2_store )
+
+        sources = { 'clicks': self.clicks_file, 'buys': self.buys_file }
+        for table in TABLES:
+            if sources[ table ] is None:
+                columns = ( numpy.zeros( 0, numpy.int64 ),
+                            numpy.zeros( 0, numpy.int32 ),
+                            numpy.zeros( 0, numpy.int64 ) )
+            else:
+                columns = self.read_table( sources[ table ] )
+            sessions, offsets, items, times = self.group_sessions( *columns )
+            SessionTable( sessions, offsets, items, times ).save( dir_2_store, table )
+            print "\t Stored", table, ":", len( sessions ), "sessions,", \
+                  len( items ), "records"
+        TimeIndex.build( SessionStore( dir_2_store ) ).save( dir_2_store )
+        print "\t Stored time index"
+
+
+class SessionTable:
+
+    def __init__( self, sessions, offsets, items, times ):
+        """ Initiate table with its columns
+        """
+        self.sessions = sessions
+        self.offsets = offsets
+        self.items = items
+        self.times = times
+
+    def __len__( self ):
+        return len( self.sessions )
+
+    def save( self, dir_2_store, table ):
+        for column in [ 'sessions', 'offsets', 'items', 'times' ]:
+            numpy.save( dir_2_store + os.sep + table + '_' + column + '.npy',
+                        getattr( self, column ) )
+
+    @staticmethod
+    def load( store_dir, table, mmap_mode='r' ):
+        """ Open the columns of one table, memory mapped by default
+        """
+        columns = []
+        for column in [ 'sessions', 'offsets', 'items', 'times' ]:
+            columns.append( numpy.load( store_dir + os.sep + table + '_' + column + '.npy',
+                                        mmap_mode=mmap_mode ) )
+        return SessionTable( *columns )
+
+    def lengths( self ):
+        return numpy.diff( self.offsets )
+
+    def nbytes( self ):
+        return sum( getattr( self, column ).nbytes
+                    for column in [ 'sessions', 'offsets', 'items', 'times' ] )
+
+    def view( self, index ):
+        """ Return a SessionView of the index-th session, its columns
+        are slices of the table columns
+        """
+        start, end = self.offsets[ index ], self.offsets[ index + 1 ]
+        return SessionView( self.sessions[ index ], self.items[ start:end ],
+                            self.times[ start:end ] )
+
+    def empty_view( self, session ):
+        return SessionView( session, self.items[ :0 ], self.times[ :0 ] )
+
+    def rows( self, index ):
+        """ Return ( items, times ) of the index-th session
+        """
+        start, end = self.offsets[ index ], self.offsets[ index + 1 ]
+        return self.items[ start:end ], self.times[ start:end ]
+
+    def take( self, indices ):
+        """ Return an in-memory table with the given sessions,
+        indices must be sorted to keep session ids sorted
+        """
+        indices = numpy.asarray( indices, dtype=numpy.int64 )
+        starts = self.offsets[ indices ]
+        lengths = self.offsets[ indices + 1 ] - starts
+        offsets = numpy.zeros( len( indices ) + 1, dtype=numpy.int64 )
+        numpy.cumsum( lengths, out=offsets[ 1: ] )
+        rows = numpy.repeat( starts - offsets[ :-1 ], lengths ) + numpy.arange( offsets[-1] )
+        return SessionTable( numpy.asarray( self.sessions[ indices ] ), offsets,
+                             numpy.asarray( self.items[ rows ] ),
+                             numpy.asarray( self.times[ rows ] ) )
+
+    def distinct_keys( self, start=0, end=None ):
+        """ Reduce sessions start:end to one entry per distinct item,
+        return sorted ( keys, counts ) where keys are the pair_keys of
+        ( session index relative to start, item ) and counts the rows
+        of the item
+        """
+        end = len( self ) if end is None else end
+        first, last = self.offsets[ start ], self.offsets[ end ]
+        sessions = numpy.repeat( numpy.arange( end - start, dtype=numpy.int64 ),
+                                 numpy.diff( self.offsets[ start:end + 1 ] ) )
+        keys, counts = numpy.unique( pair_keys( sessions, self.items[ first:last ] ),
+                                     return_counts=True )
+        return keys, counts.astype( numpy.int64 )
+
+    @staticmethod
+    def key_items( keys ):
+        """ Items of distinct_keys keys
+        """
+        return ( keys & ITEM_MASK ).astype( numpy.int32 )
+
+    def distinct_items( self, start=0, end=None ):
+        """ distinct_keys split into ( sessions, items, counts )
+        """
+        keys, counts = self.distinct_keys( start, end )
+        return keys >> PAIR_SHIFT, self.key_items( keys ), counts
+
+    def find( self, session ):
+        """ Return the position of session id in the table, -1 if absent
+        """
+        index = numpy.searchsorted( self.sessions, session )
+        if index < len( self.sessions ) and self.sessions[ index ] == session:
+            return index
+        return -1
+
+
+class ClickRecord:
+    """ One click or buy of a SessionView. Only exists while it is
+    used, the store keeps the columns
+    """
+    __slots__ = ( 'item', 'time' )
+
+    def __init__( self, item, time ):
+        self.item = item
+        self.time = time
+
+    def __getitem__( self, name ):
+        return getattr( self, name )
+
+
+class SessionView:
+
+    def __init__( self, session, items, times ):
+        """ Rows of one session, items and times are slices of the
+        columns of a table, no copy is made. Indexing and iterating
+        give ClickRecords, so the per-session methods written for
+        lists of { 'item': item, 'time': time } work on views.
+        Items and times are ints, not the strings of the csv files.
+        """
+        self.session = session
+        self.items = items
+        self.times = times
+
+    def __len__( self ):
+        return len( self.items )
+
+    def __getitem__( self, index ):
+        return ClickRecord( int( self.items[ index ] ), int( self.times[ index ] ) )
+
+    def __iter__( self ):
+        for item, time in zip( self.items.tolist(), self.times.tolist() ):
+            yield ClickRecord( item, time )
+
+
+class SessionStore:
+
+    def __init__( self, store_dir=None, mmap_mode='r', clicks=None, buys=None ):
+        """ Open clicks and buys tables of a store directory, or
+        wrap the given tables when store_dir is None
+        """
+        self.store_dir = store_dir
+        if store_dir is None:
+            self.clicks, self.buys = clicks, buys
+        else:
+            self.clicks = SessionTable.load( store_dir, 'clicks', mmap_mode )
+            self.buys = SessionTable.load( store_dir, 'buys', mmap_mode )
+
+    def __len__( self ):
+        return len( self.clicks )
+
+    def __iter__( self ):
+        """ Iterate ( session id, clicks view, buys view ) over the
+        clicks sessions, in session id order
+        """
+        buys_starts, buys_ends = self.buys_ranges()
+        for index in xrange( len( self ) ):
+            yield ( self.clicks.sessions[ index ], ) \
+                  + self.views( index, ( buys_starts[ index ], buys_ends[ index ] ) )
+
+    def nbytes( self ):
+        """ Bytes of the columns, i.e. resident size once loaded
+        """
+        return self.clicks.nbytes() + self.buys.nbytes()
+
+    @staticmethod
+    def from_dicts( clicks_dict, buys_dict=None ):
+        """ Build an in-memory store from the old pickled format,
+        { session: [ { 'item': item, 'time': time } ] } with
+        strings as read from the csv files
+        """
+        ingestion = SessionIngestion( None )
+        tables = []
+        for records_dict in [ clicks_dict, buys_dict or {} ]:
+            sessions, times, items = [], [], []
+            for session in records_dict:
+                for record in records_dict[ session ]:
+                    sessions.append( session )
+                    times.append( record[ 'time' ] )
+                    items.append( record[ 'item' ] )
+            columns = ingestion.convert_chunk( sessions, times, items )
+            tables.append( SessionTable( *ingestion.group_sessions( *columns ) ) )
+        return SessionStore( clicks=tables[0], buys=tables[1] )
+
+    def take( self, indices ):
+        """ Return an in-memory store with the given clicks sessions
+        ( sorted indexes ) and their buys
+        """
+        clicks = self.clicks.take( indices )
+        buy_rows, found = find_keys( self.buys.sessions, clicks.sessions )
+        return SessionStore( clicks=clicks, buys=self.buys.take( buy_rows[ found ] ) )
+
+    def shard( self, shard, n_shards ):
+        """ Return the sessions hashed to shard out of n_shards
+        """
+        shards = session_shards( self.clicks.sessions, n_shards )
+        return self.take( numpy.flatnonzero( shards == shard ) )
+
+    def buys_ranges( self ):
+        """ Return ( starts, ends ) of the buys rows for every clicks
+        session, sessions without buys get an empty range
+        """
+        sessions = self.clicks.sessions
+        if len( self.buys ) == 0:
+            empty = numpy.zeros( len( sessions ), dtype=numpy.int64 )
+            return empty, empty.copy()
+        index = numpy.searchsorted( self.buys.sessions, sessions )
+        index = numpy.minimum( index, len( self.buys ) - 1 )
+        found = self.buys.sessions[ index ] == sessions
+        starts = numpy.where( found, self.buys.offsets[ index ], 0 )
+        ends = numpy.where( found, self.buys.offsets[ index + 1 ], 0 )
+        return starts, ends
+
+    def time_index( self ):
+        """ Return the TimeIndex of the store, stores ingested without
+        one get it computed in memory
+        """
+        if self.store_dir is not None and TimeIndex.exists( self.store_dir ):
+            return TimeIndex.load( self.store_dir )
+        return TimeIndex.build( self )
+
+    def views( self, index, buys_range=None ):
+        """ Return SessionViews of the clicks and buys of the
+        index-th clicks session, the per-session methods of the
+        models take them in place of the old lists of records
+        """
+        clicks = self.clicks.view( index )
+        if buys_range is None:
+            buy_index = self.buys.find( clicks.session )
+            if buy_index < 0:
+                return clicks, self.buys.empty_view( clicks.session )
+            return clicks, self.buys.view( buy_index )
+        start, end = buys_range
+        return clicks, SessionView( clicks.session, self.buys.items[ start:end ],
+                                    self.buys.times[ start:end ] )
+
+
+class TimeIndex:
+
+    COLUMNS = [ 'order', 'dwell', 'time_to_buy' ]
+
+    def __init__( self, order, dwell, time_to_buy ):
+        """ Columns aligned with the clicks rows of a store, see the
+        store layout above
+        """
+        self.order = order
+        self.dwell = dwell
+        self.time_to_buy = time_to_buy
+
+    @staticmethod
+    def build( store ):
+        """ Compute the index of a store with a few sorts. A buy
+        counts for a click when it is strictly later, like in the
+        matching of the models
+        """
+        clicks, buys = store.clicks, store.buys
+        n_clicks = len( clicks.items )
+        session = numpy.repeat( numpy.arange( len( clicks ), dtype=numpy.int64 ), clicks.lengths() )
+        times = numpy.asarray( clicks.times )
+
+        # time order inside every session, file order on ties
+        ranked = numpy.lexsort( ( numpy.arange( n_clicks ), times, session ) )
+        order = numpy.empty( n_clicks, dtype=numpy.int32 )
+        order[ ranked ] = numpy.arange( n_clicks ) - numpy.asarray( clicks.offsets )[ session[ ranked ] ]
+        dwell = numpy.full( n_clicks, -1, dtype=numpy.int64 )
+        same = session[ ranked ][ 1: ] == session[ ranked ][ :-1 ]
+        dwell[ ranked[ :-1 ][ same ] ] = numpy.diff( times[ ranked ] )[ same ]
+
+        # clicks and buys keyed by ( session, item ), on equal time
+        # the buy goes first since only later buys count
+        buy_rows, found = find_keys( clicks.sessions, buys.sessions )
+        buy_session = numpy.repeat( numpy.where( found, buy_rows, -1 ), buys.lengths() )
+        keep = buy_session >= 0
+        click_keys = pair_keys( session, numpy.asarray( clicks.items ) )
+        buy_keys = pair_keys( buy_session[ keep ], numpy.asarray( buys.items )[ keep ] )
+        keys = numpy.concatenate( ( click_keys, buy_keys ) )
+        all_times = numpy.concatenate( ( times, numpy.asarray( buys.times )[ keep ] ) )
+        is_buy = numpy.arange( len( keys ) ) >= n_clicks
+        merged = numpy.lexsort( ( ~is_buy, all_times, keys ) )
+        positions = numpy.where( is_buy[ merged ], numpy.arange( len( merged ) ), len( merged ) )
+        next_buy = numpy.minimum.accumulate( positions[ ::-1 ] )[ ::-1 ]
+        is_click = ~is_buy[ merged ]
+        click_positions = numpy.flatnonzero( is_click )
+        next_buy = next_buy[ click_positions ]
+        has_buy = next_buy < len( merged )
+        has_buy[ has_buy ] = keys[ merged[ next_buy[ has_buy ] ] ] == keys[ merged[ click_positions[ has_buy ] ] ]
+        time_to_buy = numpy.full( n_clicks, -1, dtype=numpy.int64 )
+        rows = merged[ click_positions ]
+        time_to_buy[ rows[ has_buy ] ] = all_times[ merged[ next_buy[ has_buy ] ] ] - times[ rows[ has_buy ] ]
+        return TimeIndex( order, dwell, time_to_buy )
+
+    @staticmethod
+    def exists( store_dir ):
+        return os.path.exists( store_dir + os.sep + 'clicks_time_to_buy.npy' )
+
+    def save( self, dir_2_store ):
+        for column in TimeIndex.COLUMNS:
+            numpy.save( dir_2_store + os.sep + 'clicks_' + column + '.npy', getattr( self, column ) )
+
+    @staticmethod
+    def load( store_dir, mmap_mode='r' ):
+        return TimeIndex( *[ numpy.load( store_dir + os.sep + 'clicks_' + column + '.npy',
+                                         mmap_mode=mmap_mode )
+                             for column in TimeIndex.COLUMNS ] )
+
+
+def main():
+    # ingest training data with buys
+    ingestion = SessionIngestion( "../original_datasets/yoochoose-clicks.dat",
+                                  "../original_datasets/yoochoose-buys.dat" )
+    ingestion.ingest( "../median_datasets/training_store" )
+    store = SessionStore( "../median_datasets/training_store" )
+    print "\t Store size:", store.nbytes() / 1024 / 1024, "MB for", \
+          len( store.clicks.items ), "clicks"
+    """
+    # ingest test data, clicks only
+    ingestion = SessionIngestion( "../original_datasets/yoochoose-test.dat" )
+    ingestion.ingest( "../median_datasets/tests_store" )
+    """
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#coding=utf8
+#
+# Filename:    sharded_training.py
+#
+# Train the sequence or naive bayes model over session shards in
+# parallel worker processes. Sessions are hashed to N shards, every
+# worker counts one shard and saves the partial counts to disk, the
+# shards are then merged with the model's merge_params. Counts are
+# additive, so the model equals the one of serial training. Shard
+# files are named after the model class, its order and a fingerprint
+# of the store, so a saved shard is only reused for the same counts.
+#
+# @classes
+# --------
+#     ShardedTraining: count shards in a process pool and reduce
+#                      them into one model
+
+import hashlib
+import multiprocessing
+import os
+
+from count_table import load_tables, save_tables
+from instrumentation import METRICS
+from session_store import SessionStore
+
+
+def new_model( model_class, store_dir, order ):
+    """ A model_class instance, order only applies to the sequence
+    model
+    """
+    if order == 2:
+        return model_class( store_dir )
+    return model_class( store_dir, order=order )
+
+
+def store_fingerprint( store_dir ):
+    """ Short hash of the store path and of the size and modification
+    time of its clicks offsets
+    """
+    path = os.path.abspath( store_dir )
+    stat = os.stat( path + os.sep + 'clicks_offsets.npy' )
+    return hashlib.sha1( '%s:%d:%d' % ( path, stat.st_size,
+                                        int( stat.st_mtime * 1000 ) ) ).hexdigest()[ :12 ]
+
+
+def count_shard( args ):
+    """ Worker: count one shard of the store and save it
+    """
+    model_class, store_dir, order, shard, n_shards, shard_file = args
+    model = new_model( model_class, store_dir, order )
+    store = SessionStore( store_dir ).shard( shard, n_shards )
+    save_tables( shard_file + '.tmp', model.count_params( store ) )
+    os.rename( shard_file + '.tmp', shard_file )
+    return shard
+
+
+class ShardedTraining:
+
+    def __init__( self, model_class, store_dir, n_shards, shard_dir, order=2 ):
+        """ model_class is SequenceModelCreation or
+        NaiveBayesModelCreation, shard files go to shard_dir, order
+        is the context order of the sequence model
+        """
+        self.model_class = model_class
+        self.store_dir = store_dir
+        self.order = order
+        self.n_shards = n_shards
+        self.shard_dir = shard_dir
+        self.store_fingerprint = store_fingerprint( store_dir )
+
+    def shard_file( self, shard ):
+        return self.shard_dir + os.sep + '%s_order%d_%s_shard_%03d_of_%03d.npz' \
+               % ( self.model_class.__name__, self.order, self.store_fingerprint,
+                   shard, self.n_shards )
+
+    def count_shards( self, shards=None, processes=None ):
+        """ Count the given shards ( all shards without a saved file
+        by default ) in a pool of processes. A failed shard can be
+        rerun alone with count_shards( [ shard ] )
+        """
+        if not os.path.exists( self.shard_dir ):
+            os.makedirs( self.shard_dir )
+        if shards is None:
+            shards = [ shard for shard in range( self.n_shards )
+                       if not os.path.exists( self.shard_file( shard ) ) ]
+        tasks = [ ( self.model_class, self.store_dir, self.order, shard, self.n_shards,
+                    self.shard_file( shard ) ) for shard in shards ]
+
+        print "\n\t Start counting", len( tasks ), "shards"
+        with METRICS.stage( 'count' ):
+            if processes == 1:
+                done = map( count_shard, tasks )
+            else:
+                pool = multiprocessing.Pool( processes )
+                try:
+                    done = []
+                    for shard in pool.imap_unordered( count_shard, tasks ):
+                        done.append( shard )
+                        METRICS.progress( len( done ), len( tasks ) )
+                finally:
+                    pool.close()
+                    pool.join()
+        print "\n\t Counting shards Finished~~"
+        return done
+
+    def reduce_shards( self ):
+        """ Merge all shard files into a new model and unify it,
+        the returned model is ready for store_params
+        """
+        missing = [ shard for shard in range( self.n_shards )
+                    if not os.path.exists( self.shard_file( shard ) ) ]
+        assert not missing, 'Shards not counted yet: ' + str( missing )
+
+        print "\n\t Start merging shards"
+        model = new_model( self.model_class, self.store_dir, self.order )
+        for shard in range( self.n_shards ):
+            model.merge_params( load_tables( self.shard_file( shard ) ) )
+        model.unify_params()
+        print "\n\t Merging shards Finished~~"
+        return model
+
+    def create( self, processes=None ):
+        """ Count missing shards in parallel and reduce them
+        """
+        self.count_shards( processes=processes )
+        return self.reduce_shards()
+
+
+def main():
+    from naive_bayes_method import NaiveBayesModelCreation
+    from sequence_method import SequenceModelCreation
+
+    store_dir = "../median_datasets/training_store"
+    shard_dir = "../median_datasets/shards"
+    dir_2_store = "../median_datasets"
+
+    # train both models on 16 shards
+    for model_class in [ SequenceModelCreation, NaiveBayesModelCreation ]:
+        training = ShardedTraining( model_class, store_dir, 16, shard_dir )
+        model = training.create()
+        model.store_params( dir_2_store )
+
+
+if __name__ == "__main__":
+    main()
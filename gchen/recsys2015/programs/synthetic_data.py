@@ -0,0 +1,134 @@
+#coding=utf8
+#
+# Filename:    synthetic_data.py
+#
+# Generate deterministic yoochoose-like csv files, to measure the
+# programs without the challenge data:
+#     session lengths   lognormal, mean about 3.3 clicks, long tail
+#     item popularity   zipfian over the item ranks
+#     buys              every click is bought with the buy rate of
+#                       its item, beta distributed around 1.6%
+#     times             sessions start over 2014-04..09, clicks
+#                       follow each other after exponential dwells
+# Output files in yoochoose format:
+#     yoochoose-clicks.dat      session,timestamp,item,category
+#     yoochoose-buys.dat        session,timestamp,item,price,quantity
+#     yoochoose-test.dat        clicks of the test sessions
+#     yoochoose-test-buys.dat   buys of the test sessions, the answers
+#
+# usage: python synthetic_data.py --tier small --output ../synthetic_datasets/small
+#
+# @classes
+# --------
+#     SyntheticData: item tables and session generator of one tier
+
+import argparse
+import numpy
+import os
+import sys
+
+# training sessions of every tier, test sessions are a quarter
+TIERS = { 'tiny': 10000,
+          'small': 100000,
+          'medium': 1000000,
+          'full': 9249729 }
+# sessions generated with one random stream, the output does not
+# depend on anything else than the seed and the tier
+CHUNK_SESSIONS = 100000
+FIRST_ITEM = 214500000
+START_TIME = numpy.datetime64( '2014-04-01T00:00:00', 'ms' ).astype( numpy.int64 )
+TIME_SPAN = 183 * 24 * 3600 * 1000
+
+
+class SyntheticData:
+
+    def __init__( self, n_sessions, n_items=None, seed=2015, zipf_exponent=1.1 ):
+        """ Draw the item tables: ids, popularity, buy rates and
+        prices, n_items scales with the sessions by default
+        """
+        self.n_sessions = n_sessions
+        self.n_items = n_items or int( min( 60000, max( 1000, n_sessions // 150 ) ) )
+        self.seed = seed
+        random = numpy.random.RandomState( [ seed, 0 ] )
+
+        self.item_ids = ( FIRST_ITEM + random.choice( 4 * self.n_items, self.n_items,
+                                                      replace=False ) ).astype( numpy.int32 )
+        weights = 1.0 / numpy.arange( 1, self.n_items + 1 ) ** zipf_exponent
+        self.popularity = numpy.cumsum( weights ) / weights.sum()
+        self.buy_rates = random.beta( 0.5, 30.0, self.n_items )
+        self.prices = numpy.maximum( random.lognormal( 7.0, 1.0, self.n_items ), 1 ).astype( numpy.int64 )
+
+    def sessions( self, part, chunk, first_session, n_sessions ):
+        """ Generate n_sessions sessions with ids from first_session,
+        return click ( sessions, times, items ) and buy ( sessions,
+        times, items, prices, quantities ) arrays
+        """
+        random = numpy.random.RandomState( [ self.seed, part, chunk ] )
+        lengths = numpy.clip( numpy.round( random.lognormal( 0.9, 0.75, n_sessions ) ),
+                              1, 200 ).astype( numpy.int64 )
+        n_clicks = lengths.sum()
+        sessions = numpy.repeat( numpy.arange( first_session, first_session + n_sessions ),
+                                 lengths )
+        ranks = numpy.minimum( numpy.searchsorted( self.popularity, random.rand( n_clicks ) ),
+                               self.n_items - 1 )
+
+        # dwell times add up from a random session start
+        dwells = random.exponential( 60000.0, n_clicks ).astype( numpy.int64 )
+        starts = numpy.r_[ 0, numpy.cumsum( lengths )[ :-1 ] ]
+        dwells[ starts ] = START_TIME + random.randint( 0, TIME_SPAN, n_sessions )
+        times = numpy.cumsum( dwells )
+        times -= numpy.repeat( numpy.r_[ 0, times[ starts[ 1: ] - 1 ] ], lengths )
+
+        bought = numpy.flatnonzero( random.rand( n_clicks ) < self.buy_rates[ ranks ] )
+        buy_times = times[ bought ] + random.randint( 1000, 600000, len( bought ) )
+        quantities = random.randint( 1, 4, len( bought ) )
+        return ( sessions, times, self.item_ids[ ranks ] ), \
+               ( sessions[ bought ], buy_times, self.item_ids[ ranks[ bought ] ],
+                 self.prices[ ranks[ bought ] ], quantities )
+
+    def write( self, clicks_file, buys_file, part, first_session, n_sessions ):
+        """ Write n_sessions sessions to the clicks and buys files
+        """
+        with open( clicks_file, 'w' ) as clicks_stream, open( buys_file, 'w' ) as buys_stream:
+            for chunk, start in enumerate( xrange( 0, n_sessions, CHUNK_SESSIONS ) ):
+                size = min( CHUNK_SESSIONS, n_sessions - start )
+                clicks, buys = self.sessions( part, chunk, first_session + start, size )
+                stamps = numpy.datetime_as_string( clicks[1].astype( 'datetime64[ms]' ) )
+                clicks_stream.write( ''.join( '%d,%sZ,%d,0\n' % row for row in
+                                              zip( clicks[0].tolist(), stamps, clicks[2].tolist() ) ) )
+                stamps = numpy.datetime_as_string( buys[1].astype( 'datetime64[ms]' ) )
+                buys_stream.write( ''.join( '%d,%sZ,%d,%d,%d\n' % row for row in
+                                            zip( buys[0].tolist(), stamps, buys[2].tolist(),
+                                                 buys[3].tolist(), buys[4].tolist() ) ) )
+                sys.stdout.write( "\r\t\t progress:" + str( start + size ) )
+                sys.stdout.flush()
+
+    def generate( self, dir_2_store ):
+        """ Write training and test files of the tier to a directory
+        """
+        if not os.path.exists( dir_2_store ):
+            os.makedirs( dir_2_store )
+        print "\n\t Start generating", self.n_sessions, "training sessions"
+        self.write( dir_2_store + os.sep + 'yoochoose-clicks.dat',
+                    dir_2_store + os.sep + 'yoochoose-buys.dat',
+                    1, 1, self.n_sessions )
+        print "\n\t Start generating", self.n_sessions // 4, "test sessions"
+        self.write( dir_2_store + os.sep + 'yoochoose-test.dat',
+                    dir_2_store + os.sep + 'yoochoose-test-buys.dat',
+                    2, self.n_sessions + 1, self.n_sessions // 4 )
+        print "\n\t Generating Finished~~"
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Generate yoochoose-like data' )
+    parser.add_argument( '--tier', choices=sorted( TIERS ), default='small' )
+    parser.add_argument( '--seed', type=int, default=2015 )
+    parser.add_argument( '--output', default=None )
+    args = parser.parse_args()
+
+    data = SyntheticData( TIERS[ args.tier ], seed=args.seed )
+    data.generate( args.output or "../synthetic_datasets/" + args.tier )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#coding=utf8
+#
+# Filename:    test_parallel_prediction.py
+#
+# Parallel prediction against the serial do_task on synthetic data,
+# with and without a session filter.
+#
+# usage: python -m unittest discover -p 'test_*.py'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from instrumentation import METRICS
+from naive_bayes_method import NaiveBayesModelCreation, NaiveBayesPrediction
+from parallel_prediction import ParallelPrediction
+from session_filter import SessionFilter
+from session_store import SessionIngestion, SessionStore
+from synthetic_data import SyntheticData
+
+
+class ParallelPredictionTest( unittest.TestCase ):
+
+    @classmethod
+    def setUpClass( cls ):
+        METRICS.configure( live=False )
+        cls.work_dir = tempfile.mkdtemp()
+        data_dir = cls.work_dir + os.sep + 'data'
+        SyntheticData( 4000 ).generate( data_dir )
+        cls.train_dir = cls.work_dir + os.sep + 'training_store'
+        cls.tests_dir = cls.work_dir + os.sep + 'tests_store'
+        SessionIngestion( data_dir + os.sep + 'yoochoose-clicks.dat',
+                          data_dir + os.sep + 'yoochoose-buys.dat' ).ingest( cls.train_dir )
+        SessionIngestion( data_dir + os.sep + 'yoochoose-test.dat' ).ingest( cls.tests_dir )
+        model = NaiveBayesModelCreation( cls.train_dir )
+        model.create()
+        model.store_params( cls.work_dir )
+        cls.session_filter = SessionFilter( threshold=0.05 ).fit( SessionStore( cls.train_dir ) )
+
+    @classmethod
+    def tearDownClass( cls ):
+        shutil.rmtree( cls.work_dir )
+
+    def results( self, session_filter, parallel ):
+        """ Lines of the results file of one run, sorted
+        """
+        out_dir = tempfile.mkdtemp( dir=self.work_dir )
+        prediction = NaiveBayesPrediction( self.work_dir + os.sep + 'naive_bayes_params.bin',
+                                           self.tests_dir )
+        prediction.load_params()
+        prediction.session_filter = session_filter
+        if parallel:
+            ParallelPrediction( prediction, processes=2 ).do_task( out_dir )
+        else:
+            prediction.do_task( out_dir )
+        with open( out_dir + os.sep + prediction.results_name ) as fstream:
+            return sorted( fstream.readlines() )
+
+    def test_unfiltered( self ):
+        self.assertEqual( self.results( None, True ), self.results( None, False ) )
+
+    def test_filtered( self ):
+        serial = self.results( self.session_filter, False )
+        self.assertEqual( self.results( self.session_filter, True ), serial )
+        self.assertLess( len( serial ), len( self.results( None, False ) ) )
+
+
+if __name__ == "__main__":
+    unittest.main()
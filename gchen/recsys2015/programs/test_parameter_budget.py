@@ -0,0 +1,80 @@
+#coding=utf8
+#
+# Filename:    test_parameter_budget.py
+#
+# Model files of both methods stay within the byte budget of
+# set_budget, with and without a sketch.
+#
+# usage: python -m unittest discover -p 'test_*.py'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from instrumentation import METRICS
+from models import CREATION, PARAMS_FILES
+from session_store import SessionIngestion, SessionStore
+from synthetic_data import SyntheticData
+
+# pruned budgets of the synthetic store, the unpruned models take
+# about 400K ( sequence ) and 1.6M ( naive bayes ) bytes and the
+# item table of the sequence model about 36K, a quarter of a budget
+# goes to the sketch in the sketch tests
+BUDGETS = range( 40000, 200001, 2000 )
+SKETCH_BUDGETS = range( 64000, 200001, 2000 )
+
+
+class ParameterBudgetTest( unittest.TestCase ):
+
+    @classmethod
+    def setUpClass( cls ):
+        METRICS.configure( live=False )
+        cls.work_dir = tempfile.mkdtemp()
+        data_dir = cls.work_dir + os.sep + 'data'
+        SyntheticData( 4000 ).generate( data_dir )
+        cls.store_dir = cls.work_dir + os.sep + 'training_store'
+        SessionIngestion( data_dir + os.sep + 'yoochoose-clicks.dat',
+                          data_dir + os.sep + 'yoochoose-buys.dat' ).ingest( cls.store_dir )
+        store = SessionStore( cls.store_dir )
+        cls.counts = dict( ( model, CREATION[ model ]( cls.store_dir ).count_params( store ) )
+                           for model in CREATION )
+
+    @classmethod
+    def tearDownClass( cls ):
+        shutil.rmtree( cls.work_dir )
+
+    def model_bytes( self, model, max_bytes, sketch_bytes ):
+        creation = CREATION[ model ]( self.store_dir )
+        creation.merge_params( self.counts[ model ] )
+        creation.set_budget( max_bytes, sketch_bytes=sketch_bytes )
+        creation.unify_params()
+        model_dir = tempfile.mkdtemp( dir=self.work_dir )
+        creation.store_params( model_dir )
+        return os.path.getsize( model_dir + os.sep + PARAMS_FILES[ model ] )
+
+    def check_budgets( self, model, sketch_fraction, budgets ):
+        for max_bytes in budgets:
+            size = self.model_bytes( model, max_bytes, int( max_bytes * sketch_fraction ) )
+            self.assertLessEqual( size, max_bytes, '%s model of %d bytes over a budget of %d'
+                                                   % ( model, size, max_bytes ) )
+
+    def test_sequence( self ):
+        self.check_budgets( 'sequence', 0.0, BUDGETS )
+
+    def test_sequence_sketch( self ):
+        self.check_budgets( 'sequence', 0.25, SKETCH_BUDGETS )
+
+    def test_naive_bayes( self ):
+        self.check_budgets( 'naive_bayes', 0.0, BUDGETS )
+
+    def test_naive_bayes_sketch( self ):
+        self.check_budgets( 'naive_bayes', 0.25, SKETCH_BUDGETS )
+
+    def test_below_unpruned( self ):
+        # the item table of the sequence model alone is larger
+        self.assertRaises( AssertionError, self.model_bytes, 'sequence', 20000, 0 )
+
+
+if __name__ == "__main__":
+    unittest.main()